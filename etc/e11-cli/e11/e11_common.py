@@ -10,9 +10,13 @@ import uuid
 import json
 import copy
 import base64
+import threading
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
 from zoneinfo import ZoneInfo
 from decimal import Decimal
-from typing import Any, TYPE_CHECKING, Dict, List
+from typing import Any, TYPE_CHECKING, Dict, List, cast
 from datetime import datetime,timezone
 
 from pydantic import BaseModel, ConfigDict, field_validator
@@ -129,8 +133,43 @@ IMAGE_BUCKET_NAME   = S3_BUCKET
 # DynamoDB
 dynamodb_client : DynamoDBClient = boto3.client("dynamodb", region_name=AWS_REGION)
 dynamodb_resource : DynamoDBServiceResource = boto3.resource( 'dynamodb', region_name=AWS_REGION )
-users_table : DynamoDBTable   = dynamodb_resource.Table(USERS_TABLE_NAME)
-sessions_table: DynamoDBTable = dynamodb_resource.Table(SESSIONS_TABLE_NAME)
+
+class PooledTable:
+    """A DynamoDB Table for the main thread and for worker threads (e.g. SQS records processed
+    concurrently, each call in the helper thread that @timeout runs it in). boto3 clients are
+    thread-safe, but resources and the default session are not, so each call borrows a Table
+    that no other thread is using and gives it back when it returns. Building a Table (a Session
+    and a resource) is the costly part, so Tables are kept for reuse; there are only as many as
+    there have been calls at once. Use it like the Table it stands for.
+    """
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._free: list = []
+        self._lock = threading.Lock()
+
+    def _borrow(self) -> DynamoDBTable:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return boto3.session.Session().resource('dynamodb', region_name=AWS_REGION).Table(self.table_name)
+
+    def _give_back(self, table: DynamoDBTable):
+        with self._lock:
+            self._free.append(table)
+
+    def __getattr__(self, name):
+        # What a call returns (e.g. a batch_writer) may outlive the loan. That is safe, because
+        # it only uses the Table's client, and clients are thread-safe.
+        def call(*a, **k):
+            table = self._borrow()
+            try:
+                return getattr(table, name)(*a, **k)
+            finally:
+                self._give_back(table)
+        return call
+
+users_table : DynamoDBTable   = cast(DynamoDBTable, PooledTable(USERS_TABLE_NAME))
+sessions_table: DynamoDBTable = cast(DynamoDBTable, PooledTable(SESSIONS_TABLE_NAME))
 route53_client : Route53Client = boto3.client('route53', region_name=AWS_REGION)
 secretsmanager_client : SecretsManagerClient = boto3.client("secretsmanager", region_name=AWS_REGION)
 sqs_client :SQSClient = boto3.client("sqs", region_name=AWS_REGION)
@@ -160,6 +199,7 @@ class A:                        # pylint: disable=too-few-public-methods
     COURSE_KEY = 'course_key'
     BUCKET = 'bucket'           # for S3
     EMAIL = 'email'
+    EXPIRES = 'expires'                  # time_t
     HOSTNAME = 'hostname'
     HOST_REGISTERED = 'host_registered'
     LAB = 'lab'
@@ -178,6 +218,9 @@ class A:                        # pylint: disable=too-few-public-methods
     SK_IMAGE_PATTERN = SK_IMAGE_PREFIX + "{lab}#{now}"
     SK_ADMIN_LOG_PREFIX = 'admin-log#' # e11admin action log
     SK_LEADERBOARD_LOG_PREFIX = 'leaderboard-log#' # leaderboard-log
+    SK_QUEUE_PENDING_PREFIX = 'queue-pending#'   # queue-pending#{lab}: grade queued, not yet started
+    SK_QUEUE_INFLIGHT_PREFIX = 'queue-inflight#' # queue-inflight#{slot}: grade running
+    SK_QUEUE_DONE_PREFIX = 'queue-done#'         # queue-done#{message_id}: steps of a queued job that finished
     USER_ID = 'user_id'
     ADMIN_LOG_USER_ID = "__e11admin__"
     USER_REGISTERED = 'user_registered'
@@ -316,10 +359,56 @@ def create_new_user(email, claims=None):
     users_table.put_item(Item=user)  # USER CREATION POINT
     return User(**convert_dynamodb_item(user))
 
+# Users already looked up in this request, keyed by ('email', email) and ('user_id', user_id).
+# None outside of user_identity_map().
+_user_identity_map: ContextVar[dict[tuple[str, str], User] | None] = ContextVar("user_identity_map", default=None)
+
+@contextmanager
+def user_identity_map():
+    """Within the block, get_user_from_email() and get_user_from_user_id() look up each user
+    in DynamoDB once and then return the same record. Use it around one Lambda invocation or
+    one grading. Change the user record with update_user() so that the map does not go stale.
+    Nested blocks share the outermost map.
+    """
+    if _user_identity_map.get() is not None:
+        yield
+        return
+    token = _user_identity_map.set({})
+    try:
+        yield
+    finally:
+        _user_identity_map.reset(token)
+
+def _remember_user(user: User) -> User:
+    """Add user to the identity map, if there is one"""
+    users = _user_identity_map.get()
+    if users is not None:
+        users[('user_id', user.user_id)] = user
+        if user.email:
+            users[('email', user.email)] = user
+    return user
+
+def forget_user(user_id: str) -> None:
+    """Remove a user from the identity map, so that the next lookup reads DynamoDB"""
+    users = _user_identity_map.get()
+    if users is not None:
+        for k in [k for (k, user) in users.items() if user.user_id == user_id]:
+            del users[k]
+
+def update_user(user_id: str, **kwargs):
+    """Update the user record (sk='#') with users_table.update_item(**kwargs) and forget the cached copy."""
+    try:
+        return users_table.update_item(Key={A.USER_ID: user_id, A.SK: A.SK_USER}, **kwargs)
+    finally:
+        forget_user(user_id)
+
 def get_user_from_email(email) -> User:
     """Given an email address, get the DynamoDB user record from the users_table.
     Note - when the first session is created, we don't know the user-id.
     """
+    users = _user_identity_map.get()
+    if users is not None and ('email', email) in users:
+        return users[('email', email)]
     logger = get_logger()
     logger.debug("get_user_from_email: looking for email=%s", email)
     resp = users_table.query(
@@ -334,10 +423,13 @@ def get_user_from_email(email) -> User:
         raise EmailNotRegistered(email)
     item = resp["Items"][0]
     logger.debug("get_user_from_email - item=%s", item)
-    return User(**convert_dynamodb_item(item))
+    return _remember_user(User(**convert_dynamodb_item(item)))
 
 def get_user_from_user_id(user_id: str) -> User:
     """Get user record by user_id."""
+    users = _user_identity_map.get()
+    if users is not None and ('user_id', user_id) in users:
+        return users[('user_id', user_id)]
     logger = get_logger()
     logger.debug("get_user_from_user_id: looking for user_id=%s", user_id)
     resp = users_table.get_item(
@@ -347,7 +439,7 @@ def get_user_from_user_id(user_id: str) -> User:
         raise EmailNotRegistered(f"User {user_id} not found")
     item = resp["Item"]
     logger.debug("get_user_from_user_id - item=%s", item)
-    return User(**convert_dynamodb_item(item))
+    return _remember_user(User(**convert_dynamodb_item(item)))
 
 def add_user_log(event, user_id, message, **extra):
     """
@@ -478,6 +570,82 @@ def get_highest_grade_record(user, lab):
         return None
     return max(items, key=grade_record_rank)
 
+################################################################
+## grading queue
+##
+## Bookkeeping items that let the SQS grading path coalesce duplicate requests
+## for the same (user, lab) and cap the number of grades running at once for
+## one student. Both carry an expiration time so that a crashed worker cannot
+## wedge a student.
+
+# A queued grade's pending item is released when the grade starts or its message is dropped.
+# It also expires, in case the message goes to the dead letter queue: that happens within
+# maxReceiveCount x VisibilityTimeout (10 x 75 s in HomeBulkQueue) unless the queue is backed up.
+GRADE_PENDING_SECONDS = 900
+GRADE_INFLIGHT_SECONDS = 75     # HomeQueue VisibilityTimeout; a grade on Lambda cannot run longer
+GRADE_INFLIGHT_LIMIT = 1        # grades running at once per student
+
+def _put_if_expired(item) -> bool:
+    """Put item unless an unexpired item with the same key exists. Returns True if written."""
+    try:
+        users_table.put_item(Item=item,
+                             ConditionExpression='attribute_not_exists(#sk) OR #exp < :now',
+                             ExpressionAttributeNames={'#sk': A.SK, '#exp': A.EXPIRES},
+                             ExpressionAttributeValues={':now': int(time.time())})
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+            return False
+        raise
+    return True
+
+def claim_grade_pending(user_id, lab) -> bool:
+    """Record that a grade for (user_id, lab) is queued.
+    Returns False if one is already queued, in which case the caller should not queue another.
+    """
+    return _put_if_expired({A.USER_ID: user_id,
+                            A.SK: f'{A.SK_QUEUE_PENDING_PREFIX}{lab}',
+                            A.LAB: lab,
+                            A.EXPIRES: int(time.time()) + GRADE_PENDING_SECONDS})
+
+def release_grade_pending(user_id, lab):
+    """The queued grade has started; later requests for (user_id, lab) must queue a new one."""
+    users_table.delete_item(Key={A.USER_ID: user_id, A.SK: f'{A.SK_QUEUE_PENDING_PREFIX}{lab}'})
+
+def acquire_grade_slot(user_id, limit: int = GRADE_INFLIGHT_LIMIT,
+                       hold_seconds: int = GRADE_INFLIGHT_SECONDS) -> str | None:
+    """Acquire one of the student's `limit` in-flight slots for up to hold_seconds,
+    which must be at least as long as the grade can run.
+    Returns the slot's sort key, or None if all slots are busy.
+    """
+    for slot in range(limit):
+        sk = f'{A.SK_QUEUE_INFLIGHT_PREFIX}{slot}'
+        if _put_if_expired({A.USER_ID: user_id,
+                            A.SK: sk,
+                            A.EXPIRES: int(time.time()) + hold_seconds}):
+            return sk
+    return None
+
+def release_grade_slot(user_id, sk):
+    users_table.delete_item(Key={A.USER_ID: user_id, A.SK: sk})
+
+# SQS delivers a message at least once, so a job records each step it finishes under its
+# messageId and a redelivered message skips them. Kept for the longest SQS retention.
+QUEUE_DONE_SECONDS = 14 * 24 * 60 * 60
+
+def queue_steps_done(user_id, message_id) -> set:
+    """Return the names of the steps of the queued job message_id that have finished."""
+    resp = users_table.get_item(Key={A.USER_ID: user_id, A.SK: f'{A.SK_QUEUE_DONE_PREFIX}{message_id}'},
+                                ConsistentRead=True)
+    return set(resp.get('Item', {}).get('steps', set()))
+
+def record_queue_step(user_id, message_id, step):
+    """Record that step of the queued job message_id has finished."""
+    users_table.update_item(Key={A.USER_ID: user_id, A.SK: f'{A.SK_QUEUE_DONE_PREFIX}{message_id}'},
+                            UpdateExpression='ADD steps :step SET #exp = :exp',
+                            ExpressionAttributeNames={'#exp': A.EXPIRES},
+                            ExpressionAttributeValues={':step': {step},
+                                                       ':exp': int(time.time()) + QUEUE_DONE_SECONDS})
+
 ################################################################
 ## image stuff
 
@@ -492,6 +660,30 @@ def add_image(user_id, lab, bucket, key):
     ret = users_table.put_item(Item=item)
     get_logger().info("add_image user_id=%s bucket=%s key=%s ret=%s", user_id, bucket, key, ret)
 
+def image_sk(lab, key, uploaded: datetime) -> str:
+    """Return the sort key of an image uploaded to key at uploaded (its S3 LastModified).
+    It depends only on the upload, so recording an upload twice writes the same item.
+    S3 times are whole seconds, so the microseconds come from the key; this keeps images
+    uploaded in the same second apart.
+    """
+    when = uploaded.astimezone(timezone.utc).replace(microsecond=zlib.crc32(key.encode()) % 1_000_000)
+    return A.SK_IMAGE_PATTERN.format(lab=lab, now=when.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+
+def add_images(images):
+    """Add a batch of images, each (user_id, lab, bucket, key, uploaded), with BatchWriteItem.
+    The sort keys come from image_sk(), so adding an image again overwrites it.
+    """
+    with users_table.batch_writer(overwrite_by_pkeys=[A.USER_ID, A.SK]) as batch:
+        for (user_id, lab, bucket, key, uploaded) in images:
+            batch.put_item(Item={
+                A.USER_ID: user_id,
+                A.SK: image_sk(lab, key, uploaded),
+                A.BUCKET: bucket,
+                A.LAB: lab,
+                A.KEY: key,
+            })
+    get_logger().info("add_images count=%s", len(images))
+
 def get_images(user_id):
     kwargs = {'KeyConditionExpression' : (
 	Key(A.USER_ID).eq(user_id) &
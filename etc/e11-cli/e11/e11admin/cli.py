@@ -12,7 +12,7 @@ from pathlib import Path
 import boto3
 from boto3.dynamodb.conditions import Key,Attr
 from tabulate import tabulate
-from e11.e11_common import A,make_course_key,get_user_from_email
+from e11.e11_common import A,make_course_key,get_user_from_email,update_user
 
 from . import staff
 
@@ -33,6 +33,9 @@ Force a grade for a specific lab:
   Example: SQS_SECRET_ID=<secret-arn> AWS_PROFILE=fas AWS_REGION=us-east-1 \\
     e11admin force-grade student@example.com lab1
 
+Drain the grading queues locally (e.g. for an end-of-term bulk regrade):
+  e11admin grade-worker --workers 16 --exit-when-empty
+
 Access a student's VM via SSH:
   e11admin ssh <email>
 
@@ -153,8 +156,8 @@ def new_course_key(user_id):
     print("user:",json.dumps(dict(user),indent=4,default=str))
     newkey = make_course_key()
     print("new key:", newkey)
-    users_table.update_item(
-        Key={A.USER_ID:user.user_id, A.SK: A.SK_USER},
+    update_user(
+        user.user_id,
         UpdateExpression=f'SET {A.COURSE_KEY} = :new_course_key',
         ExpressionAttributeValues={ ':new_course_key': newkey}
     )
@@ -245,6 +248,14 @@ def main():
     ca.add_argument("--stage", action="store_true", help="use stage.csci-e-11.org")
     ca.set_defaults(func=staff.force_grades)
 
+    ca = subparsers.add_parser('grade-worker', help='Drain the grading queues on this machine instead of Lambda')
+    ca.add_argument("--workers", type=int, default=4, help="messages to grade at once")
+    ca.add_argument("--max-jobs", type=int, help="exit after this many messages")
+    ca.add_argument("--exit-when-empty", action="store_true", help="exit when the queues are empty")
+    ca.add_argument("--bulk-only", action="store_true", help="only read the bulk queue")
+    ca.add_argument("--stage", action="store_true", help="use stage.csci-e-11.org")
+    ca.set_defaults(func=staff.grade_worker)
+
     ca = subparsers.add_parser('canvas-grades', help='Create grade sheet for upload to Canvas')
     ca.add_argument(dest='lab', help='lab to grade')
     ca.add_argument("--template", help="Canvas exported grade sheet", type=Path, required=True)
@@ -29,7 +29,7 @@ from e11.e11core.constants import COURSE_DOMAIN
 from e11.e11_common import (dynamodb_client,dynamodb_resource,A,create_new_user,users_table,add_user_log,
                             add_admin_log,
                             get_user_from_email,queryscan_table,generate_direct_login_url,EmailNotRegistered,
-                            select_highest_grade_records)
+                            select_highest_grade_records,update_user)
 
 def enabled():
     return os.getenv('E11_STAFF','0')[0:1].upper() in ['Y','T','1']
@@ -71,15 +71,13 @@ def do_edit_email(args):
         print(f"Email {args.email} is not registered")
         sys.exit(1)
     if args.alt:
-        users_table.update_item( Key={ 'user_id': user.user_id,
-                                       'sk': '#'},
-                                 UpdateExpression="SET alt_email= :alt",
-                                 ExpressionAttributeValues={':alt':args.alt})
+        update_user( user.user_id,
+                     UpdateExpression="SET alt_email= :alt",
+                     ExpressionAttributeValues={':alt':args.alt})
         add_user_log( None, user.user_id, f"User alt_email updated to {args.alt}")
     elif args.remove:
-        users_table.update_item( Key={ 'user_id': user.user_id,
-                                       'sk': '#'},
-                                 UpdateExpression="REMOVE alt_email")
+        update_user( user.user_id,
+                     UpdateExpression="REMOVE alt_email")
         add_user_log( None, user.user_id, "User alt_email removed")
 
 
@@ -844,11 +842,14 @@ def update_path():
 
 def force_grades(args):
     (home,_) = update_path()
+    from home_app.sqs_support import LANE_BULK, LANE_INTERACTIVE # pylint: disable=import-error,import-outside-toplevel
     queue_name  = find_queue('home-queue', stage=args.stage)
+    bulk_queue_name = find_queue('home-bulk-queue', stage=args.stage)
     secret_name = find_secret("sqs-auth-secret")
-    print("sending message to",queue_name)
+    print("sending message to",queue_name,"or",bulk_queue_name)
     print("using secret",secret_name)
     os.environ['SQS_QUEUE_URL'] = queue_name
+    os.environ['SQS_BULK_QUEUE_URL'] = bulk_queue_name
     os.environ['SQS_SECRET_ID'] = secret_name
     message = f"Grading was manually queued by {args.who}"
 
@@ -878,12 +879,38 @@ def force_grades(args):
         for (email,score) in high_grades.items():
             if score<5.0:
                 print(email,score)
-                home.queue_grade(email, args.lab, message)
+                home.queue_grade(email, args.lab, message, lane=LANE_BULK)
                 count += 1
         print("Count:",count)
         sys.exit(0)
 
-    home.queue_grade(args.email,args.lab, message)
+    r = home.queue_grade(args.email,args.lab, message, lane=LANE_INTERACTIVE)
+    if r.get('coalesced'):
+        print(f"A grade for {args.email} {args.lab} is already queued.")
+
+def grade_worker(args):
+    """Drain the grading queues from this machine instead of Lambda."""
+    update_path()
+    from home_app import sqs_support # pylint: disable=import-error,import-outside-toplevel
+    os.environ['SQS_QUEUE_URL'] = find_queue('home-queue', stage=args.stage)
+    os.environ['SQS_BULK_QUEUE_URL'] = find_queue('home-bulk-queue', stage=args.stage)
+    os.environ['SQS_SECRET_ID'] = find_secret("sqs-auth-secret")
+    os.environ['SSH_SECRET_ID'] = find_secret("ssh")
+    lanes = [sqs_support.LANE_BULK] if args.bulk_only else [sqs_support.LANE_INTERACTIVE, sqs_support.LANE_BULK]
+
+    run = {'total': 0.0, 'max': 0.0}
+    def on_job(job):
+        print(f"{job['messageId']}  {job['lane']:11} {str(job['action']):8} "
+              f"queued {job['queue_seconds']:8.1f}s  ran {job['run_seconds']:6.1f}s"
+              f"{'  (will retry)' if job['retry'] else ''}")
+        run['total'] += job['run_seconds']
+        run['max'] = max(run['max'], job['run_seconds'])
+
+    print(f"grade worker: {args.workers} workers reading {', '.join(lanes)}")
+    jobs = sqs_support.run_grade_worker(workers=args.workers, lanes=lanes, max_jobs=args.max_jobs,
+                                        exit_when_empty=args.exit_when_empty, on_job=on_job)
+    if jobs:
+        print(f"{jobs} jobs; run seconds mean {run['total'] / jobs:.1f} max {run['max']:.1f}")
 
 def ssh_access(args):
     (_,api) = update_path()
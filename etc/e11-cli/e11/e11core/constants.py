@@ -34,6 +34,7 @@ POINTS_PER_LAB = 5.0
 API_PATH = "/api/v1"
 API_ENDPOINT = f'https://{COURSE_DOMAIN}{API_PATH}'
 STAGE_ENDPOINT = f'https://stage.{COURSE_DOMAIN}{API_PATH}'
+MAX_PRESIGNED_POSTS = 20         # the most presigned posts that the post-images action returns; copied in lab8_linux/post_dashboard.py
 
 # HTTP Status Codes
 HTTP_OK = 200
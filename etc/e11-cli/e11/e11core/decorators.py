@@ -1,11 +1,41 @@
+import contextvars
 import functools
 import signal
+import threading
 import time
 
+def _call_in_thread(seconds: int, f, a, k):
+    """Run f(*a, **k) in a daemon thread and wait up to seconds for it.
+    The thread runs in a copy of the caller's context, so it sees the same context variables.
+    On timeout the thread is abandoned, not interrupted.
+    """
+    result: dict = {}
+    ctx = contextvars.copy_context()
+    def target():
+        try:
+            result['value'] = ctx.run(f, *a, **k)
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            result['error'] = e
+    t = threading.Thread(target=target, name=f"timeout-{f.__name__}", daemon=True)
+    t.start()
+    t.join(seconds)
+    if t.is_alive():
+        raise TimeoutError(f"timed out after {seconds}s")
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
 def timeout(seconds: int):
+    """Raise TimeoutError if the function runs longer than seconds.
+    In the main thread this uses SIGALRM. Signals are only delivered to the main thread,
+    so in other threads (e.g. grading SQS records concurrently) the function runs in a
+    helper thread that is abandoned when time runs out.
+    """
     def deco(f):
         @functools.wraps(f)
         def wrapper(*a, **k):
+            if threading.current_thread() is not threading.main_thread():
+                return _call_in_thread(seconds, f, a, k)
             def handler(signum, frame):
                 raise TimeoutError(f"timed out after {seconds}s")
             old = signal.signal(signal.SIGALRM, handler)
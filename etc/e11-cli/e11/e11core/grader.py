@@ -14,7 +14,7 @@ from types import FunctionType
 
 import paramiko.ssh_exception
 
-from e11.e11_common import S3_BUCKET
+from e11.e11_common import S3_BUCKET, user_identity_map
 
 from .assertions import TestFail
 from .testrunner import TestRunner
@@ -197,8 +197,9 @@ def grade_student_vm(user_email, public_ip, lab:str, pkey_pem:str|None=None, key
     ctx.key_filename = key_filename
     ctx.grade_with_ssh = True
 
-    # grade the student VM
-    summary = discover_and_run(ctx)
+    # grade the student VM. The tests look up the student in DynamoDB once.
+    with user_identity_map():
+        summary = discover_and_run(ctx)
 
     # censor the private key
     ctx.pkey_pem = "<censored>"
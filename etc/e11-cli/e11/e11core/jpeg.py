@@ -0,0 +1,151 @@
+"""
+jpeg.py - pure-Python JPEG structure inspection.
+
+Walks the JPEG marker segments without decoding the image, so it needs only the
+head of the file (everything up to the Start of Scan) and its last few bytes.
+It has no dependencies outside the standard library so that the lab servers can share it:
+lab5/server/jpeg.py and lab6/server/jpeg.py are symlinks to this file.
+"""
+
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+SOI = 0xD8                      # Start of Image
+EOI = 0xD9                      # End of Image
+SOS = 0xDA                      # Start of Scan. Entropy-coded data follows.
+APP1 = 0xE1                     # EXIF lives here
+TEM = 0x01
+# Start of Frame markers, which have the image dimensions. C4 (DHT), C8 (JPG) and CC (DAC) are not frames.
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+EXIF_HEADER = b"Exif\x00\x00"
+
+# Bytes to read from the start and the end of an object to check its structure.
+# Header segments are at most 64KiB each; cameras put EXIF and a thumbnail in the first one.
+HEAD_BYTES = 128 * 1024
+TAIL_BYTES = 64                 # some encoders pad after EOI
+
+
+class Segment(NamedTuple):
+    """A marker segment. offset is where the payload starts in the data."""
+    marker: int
+    offset: int
+    payload: memoryview
+
+
+class JPEGInfo(NamedTuple):
+    width: int
+    height: int
+    has_exif: bool
+
+
+class JPEGError(ValueError):
+    """The data is not a well-formed JPEG"""
+
+
+def iter_segments(data) -> Iterator[Segment]:
+    """Yield the header segments of the JPEG in data, through the SOS segment.
+    Raises JPEGError if the data does not start with SOI or a segment is malformed or truncated.
+    """
+    view = memoryview(data)
+    n = len(view)
+    if n < 4 or view[0] != 0xFF or view[1] != SOI:
+        raise JPEGError("does not start with SOI")
+    i = 2
+    while True:
+        if i >= n or view[i] != 0xFF:
+            raise JPEGError(f"no marker at offset {i}")
+        # Skip any fill bytes
+        while i < n and view[i] == 0xFF:
+            i += 1
+        if i >= n:
+            raise JPEGError("truncated before SOS")
+        marker = view[i]
+        i += 1
+
+        # Standalone markers (no length)
+        if marker == TEM or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker in (SOI, EOI):
+            raise JPEGError(f"unexpected marker 0x{marker:02X} before SOS")
+
+        # All other markers have a 2-byte big-endian length that includes the length bytes
+        if i + 2 > n:
+            raise JPEGError("truncated segment length")
+        seglen = (view[i] << 8) | view[i + 1]
+        if seglen < 2:
+            raise JPEGError(f"invalid length {seglen} for marker 0x{marker:02X}")
+        if i + seglen > n:
+            raise JPEGError(f"truncated marker 0x{marker:02X} segment")
+        yield Segment(marker, i + 2, view[i + 2 : i + seglen])
+        i += seglen
+        if marker == SOS:
+            return
+
+
+def find_exif(data) -> Tuple[bool, str]:
+    """Return (has_exif, reason). EXIF is an APP1 segment whose payload starts with Exif\\0\\0."""
+    try:
+        for segment in iter_segments(data):
+            if segment.marker == APP1 and bytes(segment.payload[:len(EXIF_HEADER)]) == EXIF_HEADER:
+                return True, "found APP1 Exif"
+    except JPEGError as e:
+        return False, str(e)
+    return False, "reached SOS (no EXIF in header segments)"
+
+
+def inspect_head(head) -> JPEGInfo:
+    """Return the dimensions of the JPEG whose first bytes are head, and whether it has EXIF.
+    head must include the SOS segment. Raises JPEGError if the structure is invalid.
+    """
+    size: Optional[Tuple[int, int]] = None
+    has_exif = False
+    for segment in iter_segments(head):
+        if segment.marker in SOF_MARKERS:
+            if len(segment.payload) < 5:
+                raise JPEGError("truncated SOF")
+            p = segment.payload
+            size = ((p[3] << 8) | p[4], (p[1] << 8) | p[2])   # width, height
+        elif segment.marker == APP1 and bytes(segment.payload[:len(EXIF_HEADER)]) == EXIF_HEADER:
+            has_exif = True
+        elif segment.marker == SOS and size is None:
+            raise JPEGError("SOS before SOF")
+    if size is None or size[0] == 0 or size[1] == 0:
+        raise JPEGError("no image dimensions")
+    return JPEGInfo(size[0], size[1], has_exif)
+
+
+def strip_exif(data) -> bytes:
+    """Return data without its APP1 segments (EXIF and XMP metadata), without decoding the image.
+    The other segments and the entropy-coded data are spliced together, so this costs one copy.
+    Returns data unchanged if it has no APP1 segments. Raises JPEGError if the structure is invalid.
+    Note that the EXIF orientation is removed too, so a rotated photo will display unrotated.
+    """
+    view = memoryview(data)
+    pieces = []
+    start = 0
+    for segment in iter_segments(view):
+        if segment.marker == APP1:
+            # The segment starts with FF E1 and the two length bytes
+            pieces.append(view[start : segment.offset - 4])
+            start = segment.offset + len(segment.payload)
+    if not pieces:
+        return bytes(data)
+    pieces.append(view[start:])
+    return b"".join(pieces)
+
+
+def has_eoi(tail) -> bool:
+    """Return True if tail, the last bytes of a file, ends with EOI (allowing zero padding)"""
+    return bytes(tail).rstrip(b"\x00").endswith(b"\xFF\xD9")
+
+
+def validate_jpeg(head, tail) -> Tuple[bool, str]:
+    """Return (ok, reason) for a JPEG given its first HEAD_BYTES and last TAIL_BYTES.
+    For a small file, pass the whole file as both.
+    """
+    try:
+        info = inspect_head(head)
+    except JPEGError as e:
+        return False, str(e)
+    if not has_eoi(tail):
+        return False, "does not end with EOI"
+    return True, f"{info.width}x{info.height} JPEG"
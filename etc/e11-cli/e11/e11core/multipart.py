@@ -0,0 +1,121 @@
+"""
+multipart.py - streaming multipart/form-data encoder for uploading a file with a presigned POST.
+
+The body is the form fields, then the file, then the closing boundary. MultipartEncoder
+computes its length in advance and reads the file as it is sent, so an upload needs
+memory for one chunk, not for the whole body. It is a read-only binary file object,
+which requests streams as the body of a POST:
+
+    body = MultipartEncoder(fields, "file", "image.jpeg", data, "image/jpeg")
+    requests.post(url, data=body, headers=body.headers())
+
+adafruit_requests sends a file object 36 bytes at a time, so on CircuitPython send
+body.read() instead when the file is already in memory.
+
+It uses only what CircuitPython also has, so the MEMENTO programs can share it:
+lab8_memento/multipart.py and lab8_linux/multipart.py are symlinks to this file.
+"""
+
+import os
+import binascii
+
+CHUNK_SIZE = 8192               # bytes returned by each step of iterating over the body
+CRLF = b"\r\n"
+
+
+class MultipartEncoder:
+    """A multipart/form-data body with text fields and one file.
+    file_data is bytes, a bytearray or memoryview, or a file opened in binary mode.
+    The file is read from its current position to its end.
+    """
+    def __init__(self, fields, file_field, file_name, file_data,
+                 file_content_type="application/octet-stream", boundary=None):
+        if boundary is None:
+            boundary = "----E11FormBoundary" + binascii.hexlify(os.urandom(12)).decode("ascii")
+        self.boundary = boundary
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        dash_boundary = b"--" + boundary.encode("ascii")
+
+        head = bytearray()
+        for name, value in fields.items():
+            head.extend(dash_boundary + CRLF)
+            head.extend(('Content-Disposition: form-data; name="' + name + '"').encode("utf-8"))
+            head.extend(CRLF + CRLF + str(value).encode("utf-8") + CRLF)
+        head.extend(dash_boundary + CRLF)
+        head.extend(('Content-Disposition: form-data; name="' + file_field + '"; filename="'
+                     + file_name + '"').encode("utf-8") + CRLF)
+        head.extend(("Content-Type: " + file_content_type).encode("utf-8") + CRLF + CRLF)
+        tail = CRLF + dash_boundary + b"--" + CRLF
+
+        if hasattr(file_data, "read"):
+            file_start = file_data.tell()
+            file_data.seek(0, 2)
+            file_len = file_data.tell() - file_start
+        else:
+            file_data = memoryview(file_data)
+            file_start = 0
+            file_len = len(file_data)
+
+        # (offset in body, length, data, offset in data); data is a memoryview or a file
+        self._parts = [(0, len(head), memoryview(bytes(head)), 0),
+                       (len(head), file_len, file_data, file_start),
+                       (len(head) + file_len, len(tail), memoryview(tail), 0)]
+        self._length = len(head) + file_len + len(tail)
+        self._pos = 0
+
+    def __len__(self):
+        return self._length
+
+    def headers(self):
+        """Return the Content-Type and Content-Length headers for the body"""
+        return {"Content-Type": self.content_type, "Content-Length": str(self._length)}
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._length
+        self._pos = max(0, min(offset, self._length))
+        return self._pos
+
+    def readinto(self, buf):
+        """Fill buf with the next bytes of the body. Return the number of bytes, 0 at the end."""
+        view = memoryview(buf)
+        filled = 0
+        for (start, length, data, data_offset) in self._parts:
+            if filled == len(view) or self._pos >= self._length:
+                break
+            if self._pos >= start + length:
+                continue
+            skip = self._pos - start
+            count = min(length - skip, len(view) - filled)
+            if isinstance(data, memoryview):
+                view[filled : filled + count] = data[data_offset + skip : data_offset + skip + count]
+            else:
+                data.seek(data_offset + skip)
+                got = data.readinto(view[filled : filled + count])
+                if got != count:
+                    raise ValueError("file changed size during upload")
+            filled += count
+            self._pos += count
+        return filled
+
+    def read(self, size=-1):
+        """Return the next size bytes of the body, or the rest of it"""
+        remaining = self._length - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        buf = bytearray(size)
+        count = self.readinto(buf)
+        return bytes(buf[:count])
+
+    def __iter__(self):
+        self.seek(0)
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
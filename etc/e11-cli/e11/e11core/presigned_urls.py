@@ -0,0 +1,44 @@
+"""
+presigned_urls.py - a cache of S3 presigned GET URLs.
+
+A page that shows the same URL for an image each time lets the browser cache the image,
+so URLs are reused until they are close to expiring. It has no dependencies outside the
+standard library so that the lab servers can share it with lambda-home:
+lab5/server/presigned_urls.py and lab6/server/presigned_urls.py are symlinks to this file.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class PresignedUrlCache:
+    """Presigned GET URLs by (bucket, key). Each URL is good for expires_seconds and is
+    reused while it has more than min_remaining_seconds left. When there are more than
+    max_size, the least recently used URL is evicted.
+    """
+    def __init__(self, expires_seconds, min_remaining_seconds, max_size):
+        self.expires_seconds = expires_seconds
+        self.min_remaining_seconds = min_remaining_seconds
+        self.max_size = max_size
+        self.urls = OrderedDict()       # (bucket, key) -> (url, expires)
+        self.lock = threading.Lock()
+
+    def get(self, s3_client, bucket, key):
+        """Return a presigned GET URL for bucket/key that is good for at least min_remaining_seconds"""
+        now = time.time()
+        with self.lock:
+            entry = self.urls.get((bucket, key))
+            if entry is not None and entry[1] - now > self.min_remaining_seconds:
+                self.urls.move_to_end((bucket, key))
+                return entry[0]
+        url = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=self.expires_seconds)
+        with self.lock:
+            self.urls[(bucket, key)] = (url, now + self.expires_seconds)
+            self.urls.move_to_end((bucket, key))
+            while len(self.urls) > self.max_size:
+                self.urls.popitem(last=False)
+        return url
@@ -14,6 +14,9 @@ from e11.e11core.assertions import TestFail
 from e11.lab_tests.lincoln import lincoln_jpeg
 from e11.lab_tests.lab_common import (
     POST_IMAGE_TEST_TIMEOUT,
+    VALIDATION_WAIT_SECONDS,
+    VALIDATION_POLL_SECONDS,
+    get_database_tables,
     test_service_file_installed,
     test_service_active,
     test_previous_lab_service_stopped,
@@ -121,18 +124,28 @@ def test_not_a_jpeg( tr:TestRunner):
     if r2.status < 200 or r2.status > 300:
         raise TestFail("Presigned post did not upload to S3.")
 
-    # Let's get the list of files and make sure that it's there there!
+    # Images are validated in the background. Poll until the server deletes the
+    # message (it rejected the image) or get-images returns it (it validated the image).
     url2 = f"https://{tr.ctx.labdns}/api/get-images"
-    r3 = tr.http_get(url2)
-    if r3.status < 200 or r3.status >= 300:
-        raise TestFail(f"could not http GET to {url2} error={r3.status} {r3.text}")
-    rows = json.loads(r3.text)
-    count = 0
-    for row in rows:
-        if row['message']==msg:
-            logger.debug("Should not be present: %s",row)
-            count += 1
-
-    if count!=0:
-        raise TestFail(f"posted message magic number {magic} with bogus JPEG is still in in database and returned by {url2}")
+    t_end = time.time() + VALIDATION_WAIT_SECONDS
+    while True:
+        r3 = tr.http_get(url2)
+        if r3.status < 200 or r3.status >= 300:
+            raise TestFail(f"could not http GET to {url2} error={r3.status} {r3.text}")
+        rows = json.loads(r3.text)
+        count = 0
+        for row in rows:
+            if row['message']==msg:
+                logger.debug("Should not be present: %s",row)
+                count += 1
+
+        if count!=0:
+            raise TestFail(f"posted message magic number {magic} with bogus JPEG is still in in database and returned by {url2}")
+        get_database_tables(tr)
+        if not any(row['message']==msg for row in tr.ctx.table_rows['messages']):
+            break
+        if time.time() + VALIDATION_POLL_SECONDS > t_end:
+            raise TestFail(f"posted message magic number {magic} with bogus JPEG is still in the database "
+                           f"{VALIDATION_WAIT_SECONDS} seconds after it was uploaded. Is the image validator running?")
+        time.sleep(VALIDATION_POLL_SECONDS)
     return "Bogus JPEG that was uploaded is no longer in database"
@@ -57,7 +57,7 @@ def test_rekognition_enabled( tr:TestRunner ):
 
 @timeout(DEFAULT_TEST_TIMEOUT)
 def test_rekognition_celeb( tr:TestRunner ):
-    url = f"https://{tr.ctx.labdns}/api/get-images"
+    url = f"https://{tr.ctx.labdns}/api/get-images?limit=1000"   # search beyond the first page
     r = tr.http_get(url)
     if r.status < 200 or r.status >= 300:
         raise TestFail(f"could not http GET to {url} error={r.status} {r.text}")
@@ -69,7 +69,7 @@ def test_rekognition_celeb( tr:TestRunner ):
 
 @timeout(DEFAULT_TEST_TIMEOUT)
 def test_rekognition_text( tr:TestRunner ):
-    url = f"https://{tr.ctx.labdns}/api/get-images"
+    url = f"https://{tr.ctx.labdns}/api/get-images?limit=1000"   # search beyond the first page
     r = tr.http_get(url)
     if r.status < 200 or r.status >= 300:
         raise TestFail(f"could not http GET to {url} error={r.status} {r.text}")
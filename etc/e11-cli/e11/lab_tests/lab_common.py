@@ -2,7 +2,6 @@
 lab_common.py: common things for the lab tester.
 """
 
-from uuid import uuid4
 import time
 import urllib
 import urllib.parse
@@ -15,6 +14,7 @@ import yaml.scanner
 from e11.e11core.utils import get_logger
 from e11.e11core.decorators import retry, timeout
 from e11.e11core.testrunner import TestRunner
+from e11.e11core.multipart import MultipartEncoder
 from e11.e11core.assertions import TestFail,assert_contains
 from e11.e11core.constants import VERSION
 from e11.lab_tests.nicols import nicols_jpeg
@@ -30,51 +30,12 @@ AUTO_GRADER_KEY_LINE = (
 DEFAULT_TEST_TIMEOUT = 5
 PRESIGNED_POST_TIMEOUT = 10
 POST_IMAGE_TIMEOUT = 20
+VALIDATION_WAIT_SECONDS = 10    # images are validated in the background after they are uploaded
+VALIDATION_POLL_SECONDS = 2
 POST_IMAGE_TEST_TIMEOUT = POST_IMAGE_TIMEOUT + PRESIGNED_POST_TIMEOUT + DEFAULT_TEST_TIMEOUT
 
 logger = get_logger()
 
-def make_multipart_body(fields: dict[str, str], file_field: str, file_name:str, file_bytes:bytes) -> tuple[bytes, str]:
-    """
-    fields: regular form fields (name -> value)
-    file_field: form field name for the file (e.g., "file" or "image")
-    file_name: name for upload
-    file_bytes: the data itself
-
-    Returns (body_bytes, content_type_header_value)
-    """
-    boundary = f"----PythonFormBoundary{uuid4().hex}"
-    boundary_bytes = boundary.encode("ascii")
-    crlf = b"\r\n"
-
-    parts: list[bytes] = []
-
-    # Text fields
-    for name, value in fields.items():
-        parts.append(b"--" + boundary_bytes + crlf)
-        header = f'Content-Disposition: form-data; name="{name}"'.encode("utf-8")
-        parts.append(header + crlf + crlf)
-        parts.append(str(value).encode("utf-8") + crlf)
-
-    # File field
-    mime_type, _ = mimetypes.guess_type(file_name)
-    if not mime_type:
-        mime_type = "application/octet-stream"
-
-    file_header = ( f'Content-Disposition: form-data; name="{file_field}"; filename="{file_name}"' ).encode("utf-8")
-    parts.append(b"--" + boundary_bytes + crlf)
-    parts.append(file_header + crlf)
-    parts.append(f"Content-Type: {mime_type}".encode("utf-8") + crlf + crlf)
-    parts.append(file_bytes + crlf)
-
-    # Closing boundary
-    parts.append(b"--" + boundary_bytes + b"--" + crlf)
-
-    body = b"".join(parts)
-    content_type = f"multipart/form-data; boundary={boundary}"
-    return body, content_type
-
-
 def do_presigned_post(r1, tr, file_name, file_bytes):
     # Did we get a presigned post?
     obj = r1.json()
@@ -85,18 +46,18 @@ def do_presigned_post(r1, tr, file_name, file_bytes):
     s3_url = presigned_post["url"]
     s3_fields = presigned_post["fields"]
 
-    body, content_type = make_multipart_body(s3_fields,
-                                             file_field="file",
-                                             file_name=file_name,
-                                             file_bytes=file_bytes)
+    mime_type, _ = mimetypes.guess_type(file_name)
+    body = MultipartEncoder(s3_fields,
+                            file_field="file",
+                            file_name=file_name,
+                            file_data=file_bytes,
+                            file_content_type=mime_type or "application/octet-stream")
 
     r2 = tr.http_get(s3_url,
                       method='POST',
                       data = body,
                       timeout = PRESIGNED_POST_TIMEOUT,
-                      headers = { 'Content-Type':content_type,
-                                  'Content-Length': str(len(body))
-                                 })
+                      headers = body.headers())
 
     return r2
 
@@ -318,17 +279,23 @@ def post_image( tr:TestRunner, image_bytes, image_name):
     if count==0:
         raise TestFail(f"posted {image_name} with magic number {magic} in the database but message not found.")
 
-    # Verify that get-images returns Lincoln
+    # Verify that get-images returns Lincoln.
+    # The server may still be validating it in the background, so poll for it.
     url2 = f"https://{tr.ctx.labdns}/api/get-images"
-    r3 = tr.http_get(url2)
-    if r3.status < 200 or r3.status >= 300:
-        raise TestFail(f"could not http GET to {url2} error={r3.status} {r3.text}")
     download_url = None
     count = 0
-    for row in r3.json():
-        if row['message']==msg and row.get('url'):
-            download_url = row['url']
-            count += 1
+    t_end = time.time() + VALIDATION_WAIT_SECONDS
+    while True:
+        r3 = tr.http_get(url2)
+        if r3.status < 200 or r3.status >= 300:
+            raise TestFail(f"could not http GET to {url2} error={r3.status} {r3.text}")
+        for row in r3.json():
+            if row['message']==msg and row.get('url'):
+                download_url = row['url']
+                count += 1
+        if count > 0 or time.time() + VALIDATION_POLL_SECONDS > t_end:
+            break
+        time.sleep(VALIDATION_POLL_SECONDS)
 
     if count==0:
         raise TestFail(f"posted message magic number {magic} in database but not returned by {url2}")
@@ -11,6 +11,9 @@ import os
 import re
 import sys
 import subprocess
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import dns
@@ -23,11 +26,13 @@ from email_validator import validate_email, EmailNotValidError
 
 from .support import authorized_keys_path,bot_access_check,bot_pubkey,config_path,get_public_ip,on_ec2,get_instanceId,DEFAULT_TIMEOUT,get_config
 
-from .e11core.constants import GRADING_TIMEOUT, API_ENDPOINT, STAGE_ENDPOINT, COURSE_KEY_LEN, LAB_MAX, COURSE_ROOT, POINTS_PER_LAB
+from .e11core.constants import GRADING_TIMEOUT, API_ENDPOINT, STAGE_ENDPOINT, COURSE_KEY_LEN, LAB_MAX, COURSE_ROOT, POINTS_PER_LAB, MAX_PRESIGNED_POSTS
 from .e11core.context import LabError,build_ctx, chdir_to_lab
 from .e11core.grader import collect_tests_in_definition_order,print_summary
 from .e11core.utils import get_logger,smash_email
 from .e11core import grader
+from .e11core import jpeg
+from .e11core.multipart import MultipartEncoder
 
 from .doctor import run_doctor
 
@@ -528,15 +533,71 @@ def do_report_tests(_):
 
         print()  # Blank line between labs
 
+LAB8_UPLOAD_ATTEMPTS = 3
+
+def lab8_upload_files(paths):
+    """Return the JPEG files to upload. A directory means the .jpeg files in it."""
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(path.glob("*.jpeg")))
+        elif not path.exists():
+            print(f"{path} does not exist")
+            sys.exit(1)
+        elif not str(path).endswith(".jpeg"):
+            print(f"{path} does end with .jpeg")
+            sys.exit(1)
+        else:
+            files.append(path)
+    return files
+
+# requests does not say that a Session is thread-safe, so each upload thread has its own.
+# It reuses that thread's TLS connections to S3 from one image to the next.
+_lab8_sessions = threading.local()
+
+def lab8_session():
+    """Return this thread's requests.Session for uploading to S3."""
+    if not hasattr(_lab8_sessions, 'session'):
+        _lab8_sessions.session = requests.Session()
+    return _lab8_sessions.session
+
+def lab8_upload_image(presigned_post, path, strip_exif, timeout):
+    """Upload path to S3 with presigned_post, retrying connection errors and S3 errors.
+    Return a message describing the result and whether it succeeded.
+    """
+    session = lab8_session()
+    stripped = None
+    if strip_exif:
+        try:
+            stripped = jpeg.strip_exif(path.read_bytes())
+        except jpeg.JPEGError as e:
+            return (f"{path} is not a valid JPEG: {e}", False)
+
+    message = ""
+    for attempt in range(LAB8_UPLOAD_ATTEMPTS):
+        time.sleep(attempt)
+        try:
+            # The file must come after the fields, and is streamed from disk.
+            with path.open('rb') as f:
+                body = MultipartEncoder(presigned_post['fields'], 'file', path.name,
+                                        f if stripped is None else stripped, 'image/jpeg')
+                r = session.post(presigned_post['url'], data=body, headers=body.headers(), timeout=timeout)
+        except requests.RequestException as e:
+            message = f"{path} upload failed: {e}"
+            continue
+        if r.status_code < 400:
+            return (f"{path} uploaded", True)
+        message = f"{path} upload failed: {r.status_code} {r.text}"
+        if r.status_code < 500:
+            break               # S3 rejected it; trying again will not help
+    return (message, False)
+
 def do_lab8(args):
     if args.upload:
-        if not args.upload.exists():
-            print(f"{args.upload} does not exist")
+        files = lab8_upload_files(args.upload)
+        if not files:
+            print("No .jpeg files to upload")
             sys.exit(1)
-        if not str(args.upload).endswith(".jpeg"):
-            print(f"{args.upload} does end with .jpeg")
-            sys.exit(1)
-        print("upload ",args.upload)
         cp = get_config()
         try:
             auth = {STUDENT_EMAIL:cp[STUDENT][STUDENT_EMAIL],
@@ -546,31 +607,32 @@ def do_lab8(args):
             sys.exit(1)
 
         ep = endpoint(args)
-        print(f"Uploading {args.upload} to {ep} timeout {args.timeout}...")
-        r = requests.post(ep, json={'action':'post-image', 'auth':auth},
-                          timeout = args.timeout )
-        result = r.json()
-        print(result)
-        presigned_data= result['presigned_post']
-        url = presigned_data['url']
-        fields = presigned_data['fields']
-        files = []
-
-        # Construct the multipart form data
-        # The 'file' MUST be the last element in the dictionary/list
-        for key, value in fields.items():
-            files.append((key, (None, value)))
-
-        # Add the actual file data
-        files.append(('file', (args.upload.name, args.upload.read_bytes())))
-
-        # Perform the POST to S3
-        # Note: No 'headers=headers' here; requests handles the Content-Type for multipart
-        r = requests.post(url, files=files, timeout=args.timeout)
-
-        print("Status Code:", r.status_code)
-        if r.status_code >= 400:
-            print("Error:", r.text)
+        print(f"Uploading {len(files)} file(s) to {ep} with {args.jobs} connections, timeout {args.timeout}...")
+        failures = 0
+        # The session reuses the TLS connection to the API; each upload thread has its own for S3.
+        # Presigned posts expire, so we get them a batch at a time, just before they are used.
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            for start in range(0, len(files), MAX_PRESIGNED_POSTS):
+                batch = files[start:start + MAX_PRESIGNED_POSTS]
+                r = session.post(ep, json={'action':'post-images', 'auth':auth, 'count':len(batch)},
+                                 timeout = args.timeout )
+                if r.status_code != 200:
+                    print("post-images failed:", r.status_code, r.text, file=sys.stderr)
+                    sys.exit(1)
+                result = r.json()
+                if result.get('error'):
+                    print("post-images failed:", result, file=sys.stderr)
+                    sys.exit(1)
+                futures = [pool.submit(lab8_upload_image, presigned_post, path,
+                                       args.strip_exif, args.timeout)
+                           for (presigned_post, path) in zip(result['presigned_posts'], batch)]
+                for future in as_completed(futures):
+                    (message, ok) = future.result()
+                    print(message)
+                    failures += 0 if ok else 1
+        print(f"{len(files) - failures} of {len(files)} uploaded")
+        if failures:
+            sys.exit(1)
 
 
 
@@ -660,7 +722,10 @@ def get_parser():
 
     # e11 lab8
     lab8_parser = subparsers.add_parser('lab8', help='Lab8 commands', parents=[shared_parser])
-    lab8_parser.add_argument("--upload", help="File to upload", type=Path)
+    lab8_parser.add_argument("--upload", help="JPEG files, or directories of them, to upload", type=Path, nargs='+')
+    lab8_parser.add_argument("--jobs", help="Number of images to upload at once", type=int, default=4)
+    lab8_parser.add_argument("--strip-exif", help="Remove the EXIF from the file before uploading it",
+                             action='store_true')
     lab8_parser.add_argument("--timeout", type=int, default=GRADING_TIMEOUT+5)
     lab8_parser.set_defaults(func=do_lab8)
 
@@ -7,11 +7,13 @@ authenticate with api_authenticate(payload), which returns the user directory.
 """
 
 import os
+import functools
 import json
 import sys
 import time
 import uuid
 import ipaddress
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Any, Dict, Optional
 
@@ -27,15 +29,15 @@ from e11.e11_common import (
     EmailNotRegistered,
     add_grade,
     add_user_log,
-    add_image,
+    add_images,
     DASHBOARD,
     DNS_TTL,
     delete_image,
     route53_client,
     get_user_from_email,
     get_highest_grade_record,
+    update_user,
     sessions_table,
-    users_table,
     S3_BUCKET,
     s3_client,
     HOSTED_ZONE_ID,
@@ -54,11 +56,13 @@ from e11.e11core.constants import (
     HTTP_INTERNAL_ERROR,
     JSON_CONTENT_TYPE,
     JPEG_MIME_TYPE,
+    MAX_PRESIGNED_POSTS,
     CORS_HEADER,
     CORS_WILDCARD,
     CONTENT_TYPE_HEADER
 )
 from e11.e11core.utils import get_logger
+from e11.e11core.presigned_urls import PresignedUrlCache
 from e11.main import __version__
 
 from .sessions import (
@@ -75,6 +79,16 @@ LastEvaluatedKey = "LastEvaluatedKey"  # pylint: disable=invalid-name
 
 MAX_IMAGE_SIZE_BYTES = 10_000_000
 
+# Presigned GET URLs are cached and reused until they are close to expiring,
+# so that a page shows the same URL for an image and the browser can cache it.
+PRESIGNED_URL_EXPIRES_SECONDS = 3600
+PRESIGNED_URL_MIN_REMAINING_SECONDS = 300
+PRESIGNED_URL_CACHE_SIZE = 1024
+
+UPLOAD_HEAD_WORKERS = 8         # head_object calls made at once for a batch of uploads
+_presigned_urls = PresignedUrlCache(PRESIGNED_URL_EXPIRES_SECONDS, PRESIGNED_URL_MIN_REMAINING_SECONDS,
+                                    PRESIGNED_URL_CACHE_SIZE)
+
 
 def _format_grade_event_timestamp(sk: str) -> str:
     timestamp = sk.split("#", 2)[2]
@@ -83,19 +97,26 @@ def _format_grade_event_timestamp(sk: str) -> str:
         timestamp = timestamp.split(".", 1)[0]
     return timestamp
 
-def get_pkey_pem(key_name):
-    """Return the PEM key"""
-    try:
-        ssh_secret_id = os.environ["SSH_SECRET_ID"]
-    except KeyError as e:
-        raise RuntimeError("SSH_SECRET_ID not defined") from e
+@functools.lru_cache(maxsize=1)
+def _get_ssh_keys(ssh_secret_id):
+    """Return the SSH keys secret as a dictionary in the form {key_name:value}.
+    Results are cached so that warm Lambdas and the grade worker do not fetch it for every grade.
+    """
     try:
         secret = secretsmanager_client.get_secret_value(SecretId=ssh_secret_id)
     except ClientError as e:
         LOGGER.exception("SecureId=%s", ssh_secret_id)
         raise RuntimeError("Unable to retrieve SSH secret from Secrets Manager") from e
     json_key = secret.get("SecretString")
-    keys = json.loads(json_key)  # dictionary in the form of {key_name:value}
+    return json.loads(json_key)
+
+def get_pkey_pem(key_name):
+    """Return the PEM key"""
+    try:
+        ssh_secret_id = os.environ["SSH_SECRET_ID"]
+    except KeyError as e:
+        raise RuntimeError("SSH_SECRET_ID not defined") from e
+    keys = _get_ssh_keys(ssh_secret_id)
     try:
         return keys[key_name]
     except KeyError:
@@ -117,11 +138,10 @@ def make_presigned_post(bucket, key, email):
         ExpiresIn = 120 )
 
 def make_presigned_url(bucket, key):
-    """Return the S3 presigned URL"""
-    return s3_client.generate_presigned_url(
-        'get_object',
-        Params={'Bucket':bucket, 'Key':key},
-        ExpiresIn = 120)
+    """Return an S3 presigned URL that is good for at least PRESIGNED_URL_MIN_REMAINING_SECONDS.
+    A URL is reused until then, evicting the least recently used URL if the cache is full.
+    """
+    return _presigned_urls.get(s3_client, bucket, key)
 
 class APINotAuthenticated(Exception):
     def __init__(self, msg):
@@ -189,7 +209,7 @@ def api_register(event, payload):
     hostname = smash_email(email)
 
     # update the user record in table to match registration information
-    users_table.update_item( Key={ "user_id": user.user_id, "sk": user.sk, },
+    update_user( user.user_id,
         UpdateExpression=f"SET {A.PUBLIC_IP} = :ip, {A.HOSTNAME} = :hn, {A.HOST_REGISTERED} = :t, {A.PREFERRED_NAME} = :preferred_name",
         ExpressionAttributeValues={
             ":ip": public_ip,
@@ -446,13 +466,69 @@ def api_post_image(event, payload):
     LOGGER.info("event=%s payload=%s user=%s presigned_post=%s",event, payload, user,presigned_post)
     return resp_json(HTTP_OK, {"presigned_post":presigned_post})
 
+def api_post_images(event, payload):
+    """For lab 8 - like api_post_image, but return payload['count'] presigned posts,
+    so that a client can upload a batch of images with one API call."""
+    user = validate_payload( payload )
+    try:
+        count = int(payload.get("count", 1))
+    except (TypeError, ValueError):
+        return resp_json(HTTP_BAD_REQUEST, {"error": "count must be an integer"})
+    if not 1 <= count <= MAX_PRESIGNED_POSTS:
+        return resp_json(HTTP_BAD_REQUEST, {"error": f"count must be between 1 and {MAX_PRESIGNED_POSTS}"})
+    presigned_posts = [make_presigned_post(S3_BUCKET, "images/" + str(uuid.uuid4()) + ".jpeg", user.email)
+                       for _ in range(count)]
+    LOGGER.info("event=%s user=%s count=%s", event, user, count)
+    return resp_json(HTTP_OK, {"presigned_posts":presigned_posts})
+
 def api_upload_callback(bucket, key):
+    """Record one upload. Uploads normally arrive in batches through the upload queue (see sqs_support)."""
     LOGGER.info("api_upload_callback(%s,%s)",bucket, key)
-    # Get the metadata
-    r = s3_client.head_object(Bucket=bucket, Key=key)
-    email = r.get('Metadata',{}).get('email','')
-    user = get_user_from_email(email) # email is already validated at this point (see above)
-    add_image( user.user_id, 'lab8', bucket, key )
+    api_upload_callbacks([(bucket, key)])
+
+def _upload_metadata(obj):
+    """Return (email, LastModified) from the metadata of an uploaded (bucket, key), ('', None) if it
+    was deleted, or None if S3 failed and it should be tried again."""
+    (bucket, key) = obj
+    try:
+        r = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return ('', None)
+        LOGGER.warning("head_object(%s,%s): %s", bucket, key, e)
+        return None
+    return (r.get('Metadata',{}).get('email',''), r['LastModified'])
+
+def api_upload_callbacks(objects):
+    """Record a batch of uploads, each (bucket, key), in the users table.
+    The objects' metadata is read concurrently, each user is looked up once,
+    and the images are written with BatchWriteItem. Recording an upload again (SQS
+    may deliver it twice) rewrites the same item.
+    Returns the objects that should be tried again.
+    """
+    LOGGER.info("api_upload_callbacks(%d objects)", len(objects))
+    with ThreadPoolExecutor(max_workers=max(1, min(UPLOAD_HEAD_WORKERS, len(objects)))) as pool:
+        metadata = list(pool.map(_upload_metadata, objects))
+
+    retry = []
+    users: Dict[str, Any] = {}
+    images = []
+    for ((bucket, key), found) in zip(objects, metadata):
+        if found is None:
+            retry.append((bucket, key))
+            continue
+        (email, uploaded) = found
+        if email not in users:
+            try:
+                users[email] = get_user_from_email(email) if email else None
+            except EmailNotRegistered:
+                users[email] = None
+        if users[email] is None:
+            LOGGER.warning("upload %s/%s: no user for email=%r", bucket, key, email)
+            continue
+        images.append((users[email].user_id, 'lab8', bucket, key, uploaded))
+    add_images(images)
+    return retry
 
 def api_delete_image(payload):
     """Delete the specified session. If the user knows the sid, that's good enough (we don't require that the sid be sealed)."""
@@ -521,6 +597,9 @@ def dispatch(method, action, event, context, payload):
         case ("POST", "post-image"):
             return api_post_image(event, payload)
 
+        case ("POST", "post-images"):
+            return api_post_images(event, payload)
+
         case ("POST", "heartbeat"):
             return api_heartbeat(event, context)
 
@@ -48,7 +48,10 @@ from e11.e11_common import (
     LAB_CONFIG,
     LAB_TIMEZONE,
     get_user_from_user_id,
+    user_identity_map,
     add_user_log,
+    claim_grade_pending,
+    release_grade_pending,
 )
 
 from e11.e11core.constants import (
@@ -79,6 +82,7 @@ from .sqs_support import (
     is_sqs_event,
     handle_sqs_event,
     sqs_send_signed_message,
+    LANE_INTERACTIVE,
 )
 
 from .sessions import (
@@ -518,17 +522,19 @@ def do_login_direct(event):
         return resp_text(HTTP_INTERNAL_ERROR, "Internal server error")
 
 
-def queue_grade(email: str, lab: str, note: None) -> Dict[str, Any]:
+def queue_grade(email: str, lab: str, note: None, lane: str = LANE_INTERACTIVE) -> Dict[str, Any]:
     """
     Queue a grading request for a student's lab via SQS.
+    If a grade for the same student and lab is already queued, the request is coalesced into it.
 
     Args:
         email: Student email address
         lab: Lab name (e.g., 'lab0', 'lab1')
         note: Optional note that is displayed to student
+        lane: sqs_support.LANE_INTERACTIVE or sqs_support.LANE_BULK
 
     Returns:
-        SQS send_message response (includes MessageId)
+        SQS send_message response (includes MessageId), or {'coalesced': True} if nothing was sent.
 
     Raises:
         EmailNotRegistered: If the email is not registered
@@ -536,6 +542,10 @@ def queue_grade(email: str, lab: str, note: None) -> Dict[str, Any]:
     # Get the user to retrieve their course_key for authentication
     user = get_user_from_email(email)
 
+    if not claim_grade_pending(user.user_id, lab):
+        LOGGER.info("Grade request for email=%s lab=%s already queued; coalesced", email, lab)
+        return {"coalesced": True}
+
     # Create the payload that api_grader expects
     payload = {
         "auth": {
@@ -547,8 +557,12 @@ def queue_grade(email: str, lab: str, note: None) -> Dict[str, Any]:
     }
 
     # Send the signed message to SQS
-    LOGGER.info("Queueing grade request for email=%s lab=%s", email, lab)
-    result = sqs_send_signed_message(action="grade", method="POST", payload=payload)
+    LOGGER.info("Queueing grade request for email=%s lab=%s lane=%s", email, lab, lane)
+    try:
+        result = sqs_send_signed_message(action="grade", method="POST", payload=payload, lane=lane)
+    except Exception:
+        release_grade_pending(user.user_id, lab)
+        raise
     LOGGER.info("Queued grade request MessageId=%s", result.get("MessageId"))
     return result
 
@@ -605,9 +619,11 @@ def safe_dump_environment():
 
 
 # pylint: disable=too-many-return-statements, disable=too-many-branches, disable=unused-argument
+@user_identity_map()
 def lambda_handler(event, context):
     """called by lambda.
     break out the HTTP method, the HTTP path, and the JSON body as a payload.
+    Each user is read from DynamoDB at most once per invocation (see user_identity_map).
     """
 
     # Check for upload
@@ -17,31 +17,66 @@ To send an authenticated message:
 Alternatively, you can rely on AWS IAM policies to restrict who can send messages to the queue,
 which provides authentication at the infrastructure level. However, HMAC provides an additional
 layer of validation that the message content hasn't been tampered with.
+
+Lanes:
+There are two queues. The interactive lane (SQS_QUEUE_URL) carries grades that a student is waiting for.
+The bulk lane (SQS_BULK_QUEUE_URL) carries staff-initiated regrades; its event source mapping has a
+low MaximumConcurrency so that a bulk regrade cannot starve the interactive lane.
+
+Grade requests are coalesced per (user, lab): while one is queued, another is not sent.
+At most GRADE_INFLIGHT_LIMIT grades run at once for a student; extra ones are put back on the queue.
+
+Uploads:
+A third queue (UPLOAD_QUEUE_ARN) carries the S3 "Object Created" events for lab8 images from EventBridge.
+Its messages are not signed; only the EventBridge rule can send to it. They are recorded a batch at a time.
 """
 
 import functools
 import json
 import os
-from typing import Any, Dict, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from itsdangerous import Signer, BadSignature
 
 from e11.e11core.utils import get_logger
-from e11.e11_common import sqs_client, secretsmanager_client
+from e11.e11_common import (sqs_client, secretsmanager_client, get_user_from_email,
+                            acquire_grade_slot, release_grade_slot, release_grade_pending, EmailNotRegistered,
+                            GRADE_INFLIGHT_SECONDS,
+                            user_identity_map)
 
 from . import api
 
 LOGGER = get_logger("home")
 #SQS_QUEUE_ARN = os.environ.get("SQS_QUEUE_ARN", "")
 
-def sqs_queue_url():
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANE_QUEUE_URL_VARS = {LANE_INTERACTIVE: "SQS_QUEUE_URL",
+                       LANE_BULK: "SQS_BULK_QUEUE_URL"}
+INFLIGHT_RETRY_SECONDS = 30    # how long a grade waits when the student already has one running
+SQS_MAX_WORKERS = int(os.environ.get("SQS_MAX_WORKERS", "4"))  # records of one batch processed at once
+SQS_START_MARGIN_SECONDS = 30  # a record is not started with less than this left before the Lambda times out
+
+def sqs_queue_url(lane: str = LANE_INTERACTIVE):
+    var = LANE_QUEUE_URL_VARS[lane]
     try:
-        return os.environ["SQS_QUEUE_URL"]
+        return os.environ[var]
     except KeyError:
-        LOGGER.exception("Environment variable SQS_QUEUE_URL not set")
+        LOGGER.exception("Environment variable %s not set", var)
         raise
 
+def record_lane(record: Dict[str, Any]) -> str:
+    """Return the lane of the queue that delivered an SQS event record."""
+    if "lane" in record:        # from sqs_receive_records()
+        return record["lane"]
+    bulk_arn = os.environ.get("SQS_BULK_QUEUE_ARN")
+    if bulk_arn and record.get("eventSourceARN") == bulk_arn:
+        return LANE_BULK
+    return LANE_INTERACTIVE
+
 def sqs_secret_id():
     try:
         return os.environ["SQS_SECRET_ID"]
@@ -180,7 +215,8 @@ def validate_sqs_message_auth(body: Dict[str, Any]) -> bool:
         raise
 
 def sqs_send_message(message_body: str, *, delay_seconds: int = 0,
-                     message_attributes: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+                     message_attributes: Optional[Dict[str, Any]] = None,
+                     lane: str = LANE_INTERACTIVE) -> Dict[str, Any]:
     """
     Send one message to the stack-owned queue.
 
@@ -188,12 +224,13 @@ def sqs_send_message(message_body: str, *, delay_seconds: int = 0,
         message_body: JSON string of the message body (can be created with sign_sqs_message())
         delay_seconds: Optional delay before message becomes visible
         message_attributes: Optional SQS message attributes
+        lane: LANE_INTERACTIVE or LANE_BULK
 
     Returns:
         boto3's response (includes MessageId).
     """
     kwargs: Dict[str, Any] = {
-        "QueueUrl": sqs_queue_url(),
+        "QueueUrl": sqs_queue_url(lane),
         "MessageBody": message_body,
     }
     if delay_seconds:
@@ -206,7 +243,8 @@ def sqs_send_message(message_body: str, *, delay_seconds: int = 0,
 
 def sqs_send_signed_message(action: str, method: str, payload: Optional[Dict[str, Any]] = None,
                            *, delay_seconds: int = 0,
-                           message_attributes: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+                           message_attributes: Optional[Dict[str, Any]] = None,
+                           lane: str = LANE_INTERACTIVE) -> Dict[str, Any]:
     """
     Send a signed SQS message to the queue.
 
@@ -218,12 +256,65 @@ def sqs_send_signed_message(action: str, method: str, payload: Optional[Dict[str
         payload: Optional payload data
         delay_seconds: Optional delay before message becomes visible
         message_attributes: Optional SQS message attributes
+        lane: LANE_INTERACTIVE or LANE_BULK
 
     Returns:
         boto3's response (includes MessageId).
     """
     signed_body = sign_sqs_message(action, method, payload)
-    return sqs_send_message(signed_body, delay_seconds=delay_seconds, message_attributes=message_attributes)
+    return sqs_send_message(signed_body, delay_seconds=delay_seconds,
+                            message_attributes=message_attributes, lane=lane)
+
+
+def sqs_defer_record(record: Dict[str, Any], delay_seconds: int) -> None:
+    """Make a record that will be reported as a batch item failure visible again after delay_seconds
+    rather than after the queue's full VisibilityTimeout.
+    """
+    try:
+        sqs_client.change_message_visibility(QueueUrl=sqs_queue_url(record_lane(record)),
+                                             ReceiptHandle=record.get("receiptHandle"),
+                                             VisibilityTimeout=int(delay_seconds))
+    except ClientError as e:
+        LOGGER.warning("SQS messageId=%s: could not change visibility: %s", record.get("messageId"), e)
+
+
+def _message_to_record(msg: Dict[str, Any], lane: str) -> Dict[str, Any]:
+    """Convert a message from sqs_client.receive_message() into the record format of a Lambda SQS event."""
+    return {
+        "messageId": msg.get("MessageId"),
+        "receiptHandle": msg.get("ReceiptHandle"),
+        "body": msg.get("Body", ""),
+        "attributes": msg.get("Attributes", {}),
+        "messageAttributes": msg.get("MessageAttributes", {}),
+        "eventSource": "aws:sqs",
+        "lane": lane,
+    }
+
+
+def sqs_receive_records(*, lane: str = LANE_INTERACTIVE, max_messages: int = 10, wait_seconds: int = 10,
+                        visibility_timeout: int = 60) -> List[Dict[str, Any]]:
+    """
+    Long-poll for up to wait_seconds and return up to max_messages messages.
+
+    Returns:
+        List of records in the same format as the Records of a Lambda SQS event, so that they
+        can be given to process_sqs_record(). Each record also has the 'lane' it came from.
+    """
+    resp = sqs_client.receive_message(
+        QueueUrl=sqs_queue_url(lane),
+        MaxNumberOfMessages=int(max_messages),
+        WaitTimeSeconds=int(wait_seconds),
+        VisibilityTimeout=int(visibility_timeout),
+        AttributeNames=["All"],
+        MessageAttributeNames=["All"],
+    )
+    return [_message_to_record(msg, lane) for msg in resp.get("Messages") or []]
+
+
+def sqs_delete_record(record: Dict[str, Any]) -> None:
+    """Delete a record received with sqs_receive_records(). (Lambda does this for us.)"""
+    sqs_client.delete_message(QueueUrl=sqs_queue_url(record.get("lane", LANE_INTERACTIVE)),
+                              ReceiptHandle=record["receiptHandle"])
 
 
 def sqs_receive_one(*, wait_seconds: int = 10, visibility_timeout: int = 60,
@@ -240,19 +331,12 @@ def sqs_receive_one(*, wait_seconds: int = 10, visibility_timeout: int = 60,
         SQS message dict (with 'body', 'messageId', etc.) or None if no message received.
         If validate_auth=True and validation fails, raises ValueError.
     """
-    resp = sqs_client.receive_message(
-        QueueUrl=sqs_queue_url(),
-        MaxNumberOfMessages=1,
-        WaitTimeSeconds=int(wait_seconds),
-        VisibilityTimeout=int(visibility_timeout),
-        AttributeNames=["All"],
-        MessageAttributeNames=["All"],
-    )
-    msgs = resp.get("Messages") or []
-    if not msgs:
+    records = sqs_receive_records(max_messages=1, wait_seconds=wait_seconds,
+                                  visibility_timeout=visibility_timeout)
+    if not records:
         return None
 
-    msg = msgs[0]  # type: ignore[assignment]
+    msg = records[0]
 
     # Validate authentication if requested
     if validate_auth:
@@ -265,7 +349,44 @@ def sqs_receive_one(*, wait_seconds: int = 10, visibility_timeout: int = 60,
             LOGGER.error("SQS messageId=%s: Invalid JSON in body: %s", msg.get("messageId"), e)
             raise ValueError("Invalid JSON in SQS message body") from e
 
-    return msg  # type: ignore[return-value]
+    return msg
+
+
+def is_upload_record(record: Dict[str, Any]) -> bool:
+    """Return True if an SQS event record came from the upload queue."""
+    upload_arn = os.environ.get("UPLOAD_QUEUE_ARN")
+    return bool(upload_arn) and record.get("eventSourceARN") == upload_arn
+
+
+def upload_object(record: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """Return the (bucket, key) of the S3 "Object Created" event in an upload queue record, or None."""
+    try:
+        body = json.loads(record.get("body", ""))
+        bucket = body["detail"]["bucket"]["name"]
+        key = body["detail"]["object"]["key"]
+    except (json.JSONDecodeError, TypeError, KeyError):
+        return None
+    if body.get("source") != "aws.s3" or body.get("detail-type") != "Object Created":
+        return None
+    return (bucket, key)
+
+
+def handle_upload_records(records: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Record the uploads in a batch of upload queue records. Return the batchItemFailures."""
+    objects: Dict[Tuple[str, str], List[str]] = {}     # (bucket, key) -> messageIds
+    for record in records:
+        obj = upload_object(record)
+        if obj is None:
+            LOGGER.error("SQS messageId=%s: not an S3 Object Created event: %s",
+                         record.get("messageId"), record.get("body"))
+            continue
+        objects.setdefault(obj, []).append(record.get("messageId"))
+    try:
+        retry = api.api_upload_callbacks(list(objects))
+    except ClientError as e:
+        LOGGER.warning("upload batch of %d failed; will be retried: %s", len(objects), e)
+        retry = list(objects)
+    return [{"itemIdentifier": msg_id} for obj in retry for msg_id in objects[obj]]
 
 
 def is_sqs_event(event: Dict[str, Any]) -> bool:
@@ -277,73 +398,273 @@ def is_sqs_event(event: Dict[str, Any]) -> bool:
     )
 
 
-# pylint: disable=unused-argument
+def _grade_owner(payload: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Return the user_id of the student that a grade payload is for, or None if it cannot be found.
+    A payload without a valid student is rejected by api.dispatch.
+    """
+    try:
+        return get_user_from_email(payload["auth"]["email"]).user_id  # type: ignore[index]
+    except (TypeError, KeyError, EmailNotRegistered):
+        return None
+
+
+def _release_grade_pending_for(payload: Optional[Dict[str, Any]]) -> None:
+    """Release the queue-pending item of a grade whose message is dropped without running it,
+    so that the next request for the lab is queued instead of coalesced into nothing.
+    Messages that cannot be parsed are left to GRADE_PENDING_SECONDS.
+    """
+    try:
+        owner = _grade_owner(payload)
+        if owner is not None:
+            release_grade_pending(owner, payload.get("lab"))  # type: ignore[union-attr]
+    except ClientError as e:
+        LOGGER.warning("could not release a pending grade: %s", e)
+
+
+@user_identity_map()
+def process_sqs_record(record: Dict[str, Any], context: Any, *,
+                       hold_seconds: int = GRADE_INFLIGHT_SECONDS) -> bool:
+    """
+    Authenticate one SQS record and run it through api.dispatch.
+    Records run on worker threads, so each one has its own user identity map.
+    A grade holds the student's in-flight slot for up to hold_seconds, which must be at least
+    as long as the record can run: the queue's visibility timeout.
+
+    Returns:
+        True if the record should be retried (reported in batchItemFailures), False if it
+        is finished, either because it succeeded or because retrying it would not help.
+    """
+    msg_id = record.get("messageId")
+    body_str = record.get("body", "")
+    LOGGER.info("SQS messageId=%s body_len=%s", msg_id, len(body_str))
+
+    # 1. Parse JSON
+    try:
+        body = json.loads(body_str) if body_str else {}
+    except json.JSONDecodeError as e:
+        LOGGER.error("SQS messageId=%s: Invalid JSON in body: %s", msg_id, e)
+        # Letting this 'succeed' here means Lambda will delete this broken message.
+        return False
+
+    # 2. Authenticate
+    # Authenticate the SQS message
+    try:
+        authenticated = validate_sqs_message_auth(body)
+    except (BadSignature, ValueError) as e:
+        LOGGER.error("SQS messageId=%s: %s", msg_id, e)
+        authenticated = False
+    if not authenticated:
+        LOGGER.error("SQS messageId=%s: Authentication failed", msg_id)
+        # Same here: don't retry a message that will always fail auth.
+        # Releasing a (forged) grade's pending item can at worst let a duplicate grade be queued.
+        if body.get("action") == "grade":
+            _release_grade_pending_for(body.get("payload"))
+        return False
+
+    # Create a minimal event structure for api.dispatch
+    # SQS events don't have requestContext, so we create a minimal one
+    method = body.get("method", "POST")
+    sqs_event = {
+        "requestContext": {
+            "stage": "sqs",
+            "http": {
+                "method": method,
+                "sourceIp": record.get("attributes", {}).get("SenderId", "sqs-internal")
+            }
+        },
+        "source": "sqs",
+        "messageId": msg_id,
+        "receiptHandle": record.get("receiptHandle"),
+    }
+    action  = body.get("action", "")
+    payload = body.get("payload")  # Can be None
+
+    # Call api.dispatch with the action and method from the message
+    slot_owner = None
+    slot = None
+    pending = action == "grade"     # the grade's queue-pending item has not been released
+    try:
+        # 3. Grades: limit how many run at once for one student
+        if action == "grade":
+            slot_owner = _grade_owner(payload)
+        if slot_owner is not None:
+            slot = acquire_grade_slot(slot_owner, hold_seconds=hold_seconds)
+            if slot is None:
+                LOGGER.info("SQS messageId=%s: grade already in flight for user_id=%s; deferring",
+                            msg_id, slot_owner)
+                sqs_defer_record(record, INFLIGHT_RETRY_SECONDS)
+                return True
+            # From here on, a new request for this lab must be queued rather than coalesced into this one.
+            release_grade_pending(slot_owner, payload.get("lab"))
+            pending = False
+
+        api.dispatch(method, action, sqs_event, context, payload)
+        return False
+
+    except ClientError as e:
+        if e.response.get('Error',{}).get('Code','') == 'ProvisionedThroughputExceededException':
+            LOGGER.warning("Throttled by DynamoDB. Adding to retry list.")
+            return True
+        LOGGER.error("Permanent AWS error: %s", e)
+        # Don't retry; let it be deleted.
+        if pending:
+            _release_grade_pending_for(payload)
+        return False
+    except Exception:  # pylint: disable=broad-exception-caught
+        LOGGER.exception("Unexpected bug in code. SQS messageId=%s", msg_id)
+        # Don't retry
+        if pending:
+            _release_grade_pending_for(payload)
+        return False
+    finally:
+        if slot is not None:
+            release_grade_slot(slot_owner, slot)
+
+
+def _remaining_seconds(context: Any) -> Optional[float]:
+    """Seconds left in this Lambda invocation, or None if there is no limit."""
+    get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if get_remaining is None:
+        return None
+    remaining = get_remaining()
+    if not isinstance(remaining, (int, float)):
+        return None
+    return remaining / 1000.0
+
+
+@functools.lru_cache(maxsize=1)
+def _record_pool() -> ThreadPoolExecutor:
+    """The threads that process SQS records. They are kept for the life of the container,
+    like the DynamoDB Tables they borrow (see e11_common.PooledTable)."""
+    return ThreadPoolExecutor(max_workers=SQS_MAX_WORKERS, thread_name_prefix="sqs-record")
+
+
+def _process_sqs_record_by(record: Dict[str, Any], context: Any, start_by: Optional[float]) -> bool:
+    """process_sqs_record() if it is not past start_by (a time.monotonic() value). Otherwise
+    return True, so that the record is redelivered."""
+    if start_by is not None and time.monotonic() > start_by:
+        LOGGER.warning("SQS messageId=%s: not started before the Lambda deadline; will be retried",
+                       record.get("messageId"))
+        return True
+    return process_sqs_record(record, context)
+
+
 def handle_sqs_event(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     """
     Process SQS-triggered deliveries.
     Note: with an SQS event source mapping, messages are deleted automatically
     if your handler completes successfully (no exception).
 
+    Records in a batch are processed concurrently on up to SQS_MAX_WORKERS threads.
+    A record that has not started SQS_START_MARGIN_SECONDS before the Lambda times out
+    is not started; it is reported in batchItemFailures so that it is redelivered.
+    Records that have started are always waited for, so a redelivered record is never
+    still running in this container.
+
     Each SQS message body should be JSON containing:
     - 'action': the API action to dispatch
     - 'method': the HTTP method (typically 'POST')
     - 'payload': optional payload data (if None, will be set to None)
     - 'auth_token': optional authentication token for SQS message validation
     """
-    results = []
-    batch_item_failures = []
-    for record in event.get("Records", []):
-        msg_id = record.get("messageId")
-        body_str = record.get("body", "")
-        LOGGER.info("SQS messageId=%s body_len=%s", msg_id, len(body_str))
-
-        # 1. Parse JSON
-        try:
-            body = json.loads(body_str) if body_str else {}
-        except json.JSONDecodeError as e:
-            LOGGER.error("SQS messageId=%s: Invalid JSON in body: %s", msg_id, e)
-            # DO NOT add to batch_item_failures.
-            # Letting this 'succeed' here means Lambda will delete this broken message.
-            continue
+    records = event.get("Records", [])
+    if records and all(is_upload_record(record) for record in records):
+        return {"batchItemFailures": handle_upload_records(records), "ok": True}
+
+    remaining = _remaining_seconds(context)
+    start_by = None if remaining is None else time.monotonic() + remaining - SQS_START_MARGIN_SECONDS
+    futures = [(record, _record_pool().submit(_process_sqs_record_by, record, context, start_by))
+               for record in records]
+    batch_item_failures = [{"itemIdentifier": record.get("messageId")}
+                           for record, future in futures if future.result()]
+    return {"batchItemFailures": batch_item_failures, "ok": True}  # ok is for test
 
-        # 2. Authenticate
-        # Authenticate the SQS message
-        if not validate_sqs_message_auth(body):
-            LOGGER.error("SQS messageId=%s: Authentication failed", msg_id)
-            # Same here: don't retry a message that will always fail auth.
-            continue
 
-        # Create a minimal event structure for api.dispatch
-        # SQS events don't have requestContext, so we create a minimal one
-        method = body.get("method", "POST")
-        sqs_event = {
-            "requestContext": {
-                "stage": "sqs",
-                "http": {
-                    "method": method,
-                    "sourceIp": record.get("attributes", {}).get("SenderId", "sqs-internal")
-                }
-            },
-            "source": "sqs",
-            "messageId": msg_id,
-            "receiptHandle": record.get("receiptHandle"),
-        }
-        action  = body.get("action", "")
-        payload = body.get("payload")  # Can be None
-
-        # Call api.dispatch with the action and method from the message
+################################################################
+## grade worker
+##
+## Drains the queues outside of Lambda (e11admin grade-worker), e.g. for end-of-term
+## bulk regrades on a large machine without Lambda's concurrency or time limits.
+
+WORKER_VISIBILITY_TIMEOUT = 300   # a worker is not limited to the Lambda timeout
+
+def run_grade_worker(*, workers: int = 4, lanes: Sequence[str] = (LANE_INTERACTIVE, LANE_BULK),
+                     wait_seconds: int = 20, max_jobs: Optional[int] = None, exit_when_empty: bool = False,
+                     on_job: Optional[Callable[[Dict[str, Any]], None]] = None) -> int:
+    """
+    Long-poll the queues and process their messages with `workers` threads.
+    A message is received whenever a thread is free, so one slow grade does not hold up the others.
+    Earlier lanes have priority: later lanes are only read when the earlier ones are empty.
+    A grade holds the student's in-flight slot for WORKER_VISIBILITY_TIMEOUT, the time that
+    its message is hidden from other workers.
+
+    Args:
+        workers: number of messages processed at once
+        lanes: lanes to read, in priority order
+        wait_seconds: how long to long-poll the first lane when every lane is empty
+        max_jobs: stop after this many messages (None for no limit)
+        exit_when_empty: stop when every lane is empty
+        on_job: called with each job report as it finishes: messageId, lane, action, retry,
+                queue_seconds (time since it was sent) and run_seconds
+
+    Returns:
+        The number of messages processed.
+    """
+    def run_job(record):
+        t0 = time.time()
         try:
-            result = api.dispatch(method, action, sqs_event, context, payload)
-            results.append({"messageId": msg_id, "result": result})
-
-        except ClientError as e:
-            if e.response.get('Error',{}).get('Code','') == 'ProvisionedThroughputExceededException':
-                LOGGER.warning("Throttled by DynamoDB. Adding to retry list.")
-                batch_item_failures.append({"itemIdentifier": msg_id})
-            else:
-                LOGGER.error("Permanent AWS error: %s", e)
-                # Don't add to batch_item_failures; let it be deleted.
-        except Exception:  # pylint: disable=broad-exception-caught
-            LOGGER.exception("Unexpected bug in code. SQS messageId=%s", msg_id)
-            # Don't retry
-    return {"batchItemFailures": batch_item_failures, "ok": True}  # ok is for test
+            action = json.loads(record["body"]).get("action")
+        except (json.JSONDecodeError, AttributeError):
+            action = None
+        retry = process_sqs_record(record, None, hold_seconds=WORKER_VISIBILITY_TIMEOUT)
+        if not retry:
+            try:
+                sqs_delete_record(record)
+            except (BotoCoreError, ClientError) as e:
+                LOGGER.warning("grade worker: could not delete messageId=%s; it will be redelivered: %s",
+                               record["messageId"], e)
+        sent = int(record["attributes"].get("SentTimestamp", t0 * 1000)) / 1000.0
+        job = {"messageId": record["messageId"],
+               "lane": record["lane"],
+               "action": action,
+               "retry": retry,
+               "queue_seconds": round(t0 - sent, 3),
+               "run_seconds": round(time.time() - t0, 3)}
+        LOGGER.info("grade worker job %s", job)
+        if on_job:
+            on_job(job)
+
+    def log_failure(future):
+        if (e := future.exception()) is not None:
+            LOGGER.error("grade worker job failed", exc_info=e)
+
+    def receive(want):
+        for lane in lanes:
+            if records := sqs_receive_records(lane=lane, max_messages=min(want, 10), wait_seconds=0,
+                                              visibility_timeout=WORKER_VISIBILITY_TIMEOUT):
+                return records
+        if exit_when_empty:
+            return []
+        return sqs_receive_records(lane=lanes[0], max_messages=min(want, 10), wait_seconds=wait_seconds,
+                                   visibility_timeout=WORKER_VISIBILITY_TIMEOUT)
+
+    started = 0
+    running: set = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="grade-worker") as pool:
+        while max_jobs is None or started < max_jobs:
+            if len(running) == workers:
+                (_, running) = wait(running, return_when=FIRST_COMPLETED)
+                continue
+            want = workers - len(running)
+            if max_jobs is not None:
+                want = min(want, max_jobs - started)
+            records = receive(want)
+            if not records and exit_when_empty:
+                break
+            for record in records:
+                future = pool.submit(run_job, record)
+                future.add_done_callback(log_failure)
+                running.add(future)
+            started += len(records)
+            running = {future for future in running if not future.done()}
+    return started
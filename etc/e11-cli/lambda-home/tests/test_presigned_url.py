@@ -0,0 +1,80 @@
+"""
+Tests for the presigned URL cache in api.make_presigned_url and the post-images action.
+"""
+
+import json
+import uuid
+
+from e11.e11_common import create_new_user
+from e11.e11core.presigned_urls import PresignedUrlCache
+from home_app import api
+
+
+class FakeS3Client:
+    """Records generate_presigned_url calls and returns a different URL for each."""
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        self.calls.append((operation, Params, ExpiresIn))
+        return f"https://{Params['Bucket']}.example/{Params['Key']}?sig={len(self.calls)}"
+
+
+def _setup(monkeypatch, now, size=api.PRESIGNED_URL_CACHE_SIZE):
+    fake = FakeS3Client()
+    monkeypatch.setattr(api, "s3_client", fake)
+    monkeypatch.setattr(api, "_presigned_urls", PresignedUrlCache(
+        api.PRESIGNED_URL_EXPIRES_SECONDS, api.PRESIGNED_URL_MIN_REMAINING_SECONDS, size))
+    monkeypatch.setattr(api.time, "time", lambda: now[0])
+    return fake
+
+
+def test_presigned_url_reused_until_near_expiry(monkeypatch):
+    now = [1_000_000.0]
+    fake = _setup(monkeypatch, now)
+
+    url = api.make_presigned_url("bucket", "images/a.jpeg")
+    assert fake.calls == [("get_object", {"Bucket": "bucket", "Key": "images/a.jpeg"},
+                           api.PRESIGNED_URL_EXPIRES_SECONDS)]
+
+    # Still valid for more than the minimum: the same URL
+    now[0] += api.PRESIGNED_URL_EXPIRES_SECONDS - api.PRESIGNED_URL_MIN_REMAINING_SECONDS - 1
+    assert api.make_presigned_url("bucket", "images/a.jpeg") == url
+    assert len(fake.calls) == 1
+
+    # Close to expiring: a new URL
+    now[0] += 2
+    assert api.make_presigned_url("bucket", "images/a.jpeg") != url
+    assert len(fake.calls) == 2
+
+
+def test_presigned_url_cache_is_per_object_and_bounded(monkeypatch):
+    now = [1_000_000.0]
+    fake = _setup(monkeypatch, now, size=2)
+
+    url_a = api.make_presigned_url("bucket", "a")
+    url_b = api.make_presigned_url("bucket", "b")
+    assert url_a != url_b
+    assert api.make_presigned_url("other", "a") != url_a
+    assert len(fake.calls) == 3
+
+    # ("bucket", "a") was least recently used and was evicted
+    assert list(api._presigned_urls.urls) == [("bucket", "b"), ("other", "a")]
+    assert api.make_presigned_url("bucket", "b") == url_b
+    assert api.make_presigned_url("bucket", "a") != url_a
+    assert len(fake.calls) == 4
+
+
+def test_post_images(fake_aws, dynamodb_local):
+    email = f"test-{uuid.uuid4().hex[:8]}@example.com"
+    user = create_new_user(email, {"email": email, "preferred_name": "Test User"})
+    auth = {"email": email, "course_key": user["course_key"]}
+
+    response = api.dispatch("POST", "post-images", {}, None, {"auth": auth, "count": 3})
+    assert response["statusCode"] == 200
+    assert len(json.loads(response["body"])["presigned_posts"]) == 3
+
+    for count in (0, api.MAX_PRESIGNED_POSTS + 1, "many"):
+        response = api.dispatch("POST", "post-images", {}, None, {"auth": auth, "count": count})
+        assert response["statusCode"] == 400
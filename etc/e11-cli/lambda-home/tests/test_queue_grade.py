@@ -3,12 +3,14 @@ Test for queue_grade function and SQS message processing.
 """
 
 import json
+import time
 import uuid
 from unittest.mock import MagicMock
 
 import pytest
+from botocore.exceptions import ClientError
 
-from e11.e11_common import A, create_new_user
+from e11.e11_common import A, create_new_user, get_user_from_email, acquire_grade_slot, release_grade_slot
 from home_app import home, sqs_support
 
 
@@ -18,6 +20,8 @@ class MockSQSClient:
     def __init__(self):
         self.messages = []  # List of messages sent
         self.message_counter = 0
+        self.visibility_changes = []
+        self.deleted = []
 
     def send_message(self, QueueUrl, MessageBody, **kwargs):
         """Store the message and return a response."""
@@ -35,21 +39,27 @@ class MockSQSClient:
         }
 
     def receive_message(self, **kwargs):
-        """Return a stored message if available."""
-        if self.messages:
-            msg = self.messages.pop(0)
-            return {
-                "Messages": [{
-                    "MessageId": msg["MessageId"],
-                    "Body": msg["Body"],
-                    "ReceiptHandle": f"receipt-{msg['MessageId']}",
-                    "Attributes": {"SenderId": "test-sender"}
-                }]
-            }
-        return {"Messages": []}
+        """Return stored messages for the queue, if available."""
+        wanted = [msg for msg in self.messages if msg["QueueUrl"] == kwargs["QueueUrl"]]
+        wanted = wanted[:kwargs.get("MaxNumberOfMessages", 1)]
+        for msg in wanted:
+            self.messages.remove(msg)
+        return {
+            "Messages": [{
+                "MessageId": msg["MessageId"],
+                "Body": msg["Body"],
+                "ReceiptHandle": f"receipt-{msg['MessageId']}",
+                "Attributes": {"SenderId": "test-sender", "SentTimestamp": str(int(time.time() * 1000))}
+            } for msg in wanted]
+        }
 
     def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
-        """Mock delete - no-op."""
+        """Record deletes."""
+        self.deleted.append(ReceiptHandle)
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        """Record visibility changes."""
+        self.visibility_changes.append((QueueUrl, ReceiptHandle, VisibilityTimeout))
 
 
 class MockSecretsManager:
@@ -272,3 +282,140 @@ def test_queue_grade_handles_sqs_event(mock_sqs, mock_secrets_manager, test_user
     email = mock_ses[0]
     assert test_user["email"] in email["Destination"]["ToAddresses"]
     assert "lab0" in email["Message"]["Subject"]["Data"].lower() or "grading" in email["Message"]["Subject"]["Data"].lower()
+
+
+def test_send_signed_message_uses_lane_queue(mock_sqs, mock_secrets_manager, monkeypatch):
+    """Bulk lane messages go to the bulk queue; interactive is the default."""
+    bulk_url = "https://sqs.us-east-1.amazonaws.com/123456789/test-bulk-queue"
+    monkeypatch.setenv("SQS_BULK_QUEUE_URL", bulk_url)
+    sqs_support.sqs_send_signed_message("ping", "POST", {})
+    sqs_support.sqs_send_signed_message("ping", "POST", {}, lane=sqs_support.LANE_BULK)
+    assert mock_sqs.messages[0]["QueueUrl"] == "https://sqs.us-east-1.amazonaws.com/123456789/test-queue"
+    assert mock_sqs.messages[1]["QueueUrl"] == bulk_url
+
+
+def test_record_lane(monkeypatch):
+    monkeypatch.setenv("SQS_BULK_QUEUE_ARN", "arn:aws:sqs:us-east-1:123456789:test-bulk-queue")
+    assert sqs_support.record_lane({"eventSourceARN": "arn:aws:sqs:us-east-1:123456789:test-bulk-queue"}) == "bulk"
+    assert sqs_support.record_lane({"eventSourceARN": "arn:aws:sqs:us-east-1:123456789:test-queue"}) == "interactive"
+    assert sqs_support.record_lane({}) == "interactive"
+
+
+def test_queue_grade_coalesces(mock_sqs, mock_secrets_manager, test_user, fake_aws):
+    """A second request for the same (user, lab) is not sent while the first is queued."""
+    r1 = home.queue_grade(test_user["email"], "lab1", note='first')
+    r2 = home.queue_grade(test_user["email"], "lab1", note='second')
+    r3 = home.queue_grade(test_user["email"], "lab2", note='other lab')
+    assert "MessageId" in r1
+    assert r2 == {"coalesced": True}
+    assert "MessageId" in r3
+    assert len(mock_sqs.messages) == 2
+
+
+def test_dropped_grade_message_releases_pending(mock_sqs, mock_secrets_manager, test_user, fake_aws):
+    """A grade message that is dropped without grading does not leave later requests coalesced into it."""
+    home.queue_grade(test_user["email"], "lab1", note='first')
+    body = json.loads(mock_sqs.messages[0]["Body"])
+    body["auth_token"] = "forged.signature"
+    record = {"messageId": "forged", "body": json.dumps(body), "receiptHandle": "receipt-forged",
+              "attributes": {"SenderId": "test-sender"}, "eventSource": "aws:sqs"}
+    assert sqs_support.process_sqs_record(record, None) is False
+
+    assert "MessageId" in home.queue_grade(test_user["email"], "lab1", note='second')
+    assert len(mock_sqs.messages) == 2
+
+
+def test_handle_sqs_event_defers_grade_in_flight(mock_sqs, mock_secrets_manager, test_user, fake_aws):
+    """A grade for a student who already has one running is deferred, not dispatched."""
+    result = home.queue_grade(test_user["email"], "lab0", note='test')
+    user = get_user_from_email(test_user["email"])
+    slot = acquire_grade_slot(user.user_id)
+    assert slot is not None
+    try:
+        sqs_event = {"Records": [{"messageId": result["MessageId"],
+                                  "body": mock_sqs.messages[0]["Body"],
+                                  "receiptHandle": "receipt-1",
+                                  "attributes": {"SenderId": "test-sender"},
+                                  "eventSource": "aws:sqs"}]}
+        response = home.handle_sqs_event(sqs_event, MagicMock())
+    finally:
+        release_grade_slot(user.user_id, slot)
+    assert response["batchItemFailures"] == [{"itemIdentifier": result["MessageId"]}]
+    assert mock_sqs.visibility_changes[0][1:] == ("receipt-1", sqs_support.INFLIGHT_RETRY_SECONDS)
+
+
+def _signed_record(msg_id, action="ping"):
+    return {"messageId": msg_id,
+            "body": sqs_support.sign_sqs_message(action, "POST", {}),
+            "receiptHandle": f"receipt-{msg_id}",
+            "attributes": {"SenderId": "test-sender"},
+            "eventSource": "aws:sqs"}
+
+
+def test_handle_sqs_event_processes_batch_concurrently(mock_sqs, mock_secrets_manager, monkeypatch):
+    """Records of one batch are dispatched in parallel."""
+    dispatched = []
+    def slow_dispatch(method, action, event, context, payload):
+        time.sleep(0.5)
+        dispatched.append(event["messageId"])
+    monkeypatch.setattr(sqs_support.api, "dispatch", slow_dispatch)
+
+    event = {"Records": [_signed_record(f"m{i}") for i in range(3)]}
+    t0 = time.monotonic()
+    response = sqs_support.handle_sqs_event(event, None)
+    assert time.monotonic() - t0 < 1.2
+    assert response["batchItemFailures"] == []
+    assert sorted(dispatched) == ["m0", "m1", "m2"]
+
+
+def test_handle_sqs_event_retries_records_past_deadline(mock_sqs, mock_secrets_manager, monkeypatch):
+    """A record that cannot start before the Lambda deadline is reported as a failure.
+    Records that have started are waited for."""
+    finished = []
+    def dispatch(method, action, event, context, payload):
+        time.sleep(1)
+        finished.append(event["messageId"])
+    monkeypatch.setattr(sqs_support.api, "dispatch", dispatch)
+
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = (sqs_support.SQS_START_MARGIN_SECONDS + 0.5) * 1000
+    started = [f"m{i}" for i in range(sqs_support.SQS_MAX_WORKERS)]
+    event = {"Records": [_signed_record(msg_id) for msg_id in started] + [_signed_record("late")]}
+    response = sqs_support.handle_sqs_event(event, context)
+    assert response["batchItemFailures"] == [{"itemIdentifier": "late"}]
+    assert sorted(finished) == started
+
+
+def test_grade_worker_drains_queues_in_priority_order(mock_sqs, mock_secrets_manager, monkeypatch):
+    """The grade worker reads the interactive lane first and deletes what it processes."""
+    monkeypatch.setenv("SQS_BULK_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/123456789/test-bulk-queue")
+    dispatched = []
+    def dispatch(method, action, event, context, payload):
+        dispatched.append(action)
+    monkeypatch.setattr(sqs_support.api, "dispatch", dispatch)
+
+    sqs_support.sqs_send_signed_message("ping", "POST", {}, lane=sqs_support.LANE_BULK)
+    sqs_support.sqs_send_signed_message("version", "POST", {})
+    jobs = []
+    assert sqs_support.run_grade_worker(workers=1, exit_when_empty=True, on_job=jobs.append) == 2
+
+    assert dispatched == ["version", "ping"]
+    assert [job["lane"] for job in jobs] == ["interactive", "bulk"]
+    assert not any(job["retry"] for job in jobs)
+    assert mock_sqs.deleted == ["receipt-test-msg-2", "receipt-test-msg-1"]
+    assert mock_sqs.messages == []
+
+
+def test_grade_worker_survives_failed_delete(mock_sqs, mock_secrets_manager, monkeypatch):
+    """A message that cannot be deleted is logged and left to be redelivered; the worker goes on."""
+    monkeypatch.setenv("SQS_BULK_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/123456789/test-bulk-queue")
+    monkeypatch.setattr(sqs_support.api, "dispatch", lambda method, action, event, context, payload: None)
+    def delete_message(QueueUrl, ReceiptHandle, **kwargs):
+        raise ClientError({"Error": {"Code": "ReceiptHandleIsInvalid"}}, "DeleteMessage")
+    monkeypatch.setattr(mock_sqs, "delete_message", delete_message)
+
+    sqs_support.sqs_send_signed_message("ping", "POST", {})
+    sqs_support.sqs_send_signed_message("version", "POST", {})
+    jobs = []
+    assert sqs_support.run_grade_worker(workers=1, exit_when_empty=True, on_job=jobs.append) == 2
+    assert [job["action"] for job in jobs] == ["ping", "version"]
@@ -739,7 +739,7 @@ def test_api_dispatch_routes_all_actions():
     # Test that all known actions are handled (structure check only)
     known_actions = [
         "ping", "ping-mail", "register", "grade", "delete-session",
-        "delete-image", "check-access", "check-me", "post-image",
+        "delete-image", "check-access", "check-me", "post-image", "post-images",
         "heartbeat", "version"
     ]
 
@@ -0,0 +1,70 @@
+"""
+Tests for batched processing of S3 upload events from the upload queue.
+"""
+
+import json
+import uuid
+from datetime import datetime, timezone
+
+from e11.e11_common import A, create_new_user, get_images
+from home_app import api, sqs_support
+
+UPLOAD_QUEUE_ARN = "arn:aws:sqs:us-east-1:000000000000:test-upload-queue"
+
+
+def _upload_record(key, bucket="test-bucket", msg_id=None):
+    body = {"source": "aws.s3",
+            "detail-type": "Object Created",
+            "detail": {"bucket": {"name": bucket}, "object": {"key": key}}}
+    return {"messageId": msg_id or key,
+            "body": json.dumps(body),
+            "eventSource": "aws:sqs",
+            "eventSourceARN": UPLOAD_QUEUE_ARN}
+
+
+def test_upload_records_are_batched(monkeypatch):
+    monkeypatch.setenv("UPLOAD_QUEUE_ARN", UPLOAD_QUEUE_ARN)
+    batches = []
+
+    def fake_callbacks(objects):
+        batches.append(objects)
+        return [("test-bucket", "images/b.jpeg")]
+
+    monkeypatch.setattr(api, "api_upload_callbacks", fake_callbacks)
+    bad = {"messageId": "bad", "body": "not json", "eventSource": "aws:sqs", "eventSourceARN": UPLOAD_QUEUE_ARN}
+    event = {"Records": [_upload_record("images/a.jpeg"),
+                         _upload_record("images/b.jpeg"),
+                         _upload_record("images/b.jpeg", msg_id="b-again"),   # delivered twice
+                         bad]}
+    result = sqs_support.handle_sqs_event(event, None)
+
+    # One call for the whole batch; the malformed record is dropped, not retried
+    assert batches == [[("test-bucket", "images/a.jpeg"), ("test-bucket", "images/b.jpeg")]]
+    assert result["batchItemFailures"] == [{"itemIdentifier": "images/b.jpeg"}, {"itemIdentifier": "b-again"}]
+
+
+def test_grade_queue_records_are_not_upload_records(monkeypatch):
+    monkeypatch.setenv("UPLOAD_QUEUE_ARN", UPLOAD_QUEUE_ARN)
+    record = _upload_record("images/a.jpeg")
+    assert sqs_support.is_upload_record(record)
+    record["eventSourceARN"] = "arn:aws:sqs:us-east-1:000000000000:test-home-queue"
+    assert not sqs_support.is_upload_record(record)
+
+
+def test_api_upload_callbacks(fake_aws, dynamodb_local, monkeypatch):
+    email = f"test-{uuid.uuid4().hex[:8]}@example.com"
+    user = create_new_user(email, {"email": email, "preferred_name": "Test User"})
+    metadata = {"images/1.jpeg": email, "images/2.jpeg": email, "images/3.jpeg": "nobody@example.com"}
+    uploaded = datetime(2025, 11, 1, 12, 0, 0, tzinfo=timezone.utc)    # S3 times are whole seconds
+    monkeypatch.setattr(api.s3_client, "head_object",
+                        lambda Bucket, Key: {"Metadata": {"email": metadata[Key]}, "LastModified": uploaded})
+
+    retry = api.api_upload_callbacks([("test-bucket", key) for key in metadata])
+    assert retry == []
+    images = get_images(user[A.USER_ID])
+    assert sorted(image[A.KEY] for image in images) == ["images/1.jpeg", "images/2.jpeg"]
+    assert len({image[A.SK] for image in images}) == 2
+
+    # A redelivered upload event does not add the image again
+    assert api.api_upload_callbacks([("test-bucket", "images/1.jpeg")]) == []
+    assert len(get_images(user[A.USER_ID])) == 2
@@ -0,0 +1,42 @@
+"""
+Tests for the request-scoped user identity map in e11_common.
+"""
+
+import uuid
+
+from e11.e11_common import (A, create_new_user, get_user_from_email, get_user_from_user_id,
+                            update_user, user_identity_map, users_table)
+
+
+def _set_preferred_name(name):
+    return {"UpdateExpression": f"SET {A.PREFERRED_NAME} = :name",
+            "ExpressionAttributeValues": {":name": name}}
+
+
+def test_user_identity_map(fake_aws, dynamodb_local):
+    email = f"test-{uuid.uuid4().hex[:8]}@example.com"
+    user_id = create_new_user(email, {"email": email}).user_id
+
+    # Outside of the map every lookup reads DynamoDB
+    assert get_user_from_email(email) is not get_user_from_email(email)
+
+    with user_identity_map():
+        user = get_user_from_email(email)
+        assert get_user_from_email(email) is user
+        assert get_user_from_user_id(user_id) is user
+
+        # A change made behind the map's back is not seen...
+        users_table.update_item(Key={A.USER_ID: user_id, A.SK: A.SK_USER},
+                                **_set_preferred_name("Behind"))
+        assert get_user_from_email(email).preferred_name is None
+
+        # ...but one made with update_user() is
+        update_user(user_id, **_set_preferred_name("Updated"))
+        assert get_user_from_user_id(user_id).preferred_name == "Updated"
+        assert get_user_from_email(email).preferred_name == "Updated"
+
+        # Nested blocks share the outer map
+        with user_identity_map():
+            assert get_user_from_email(email) is get_user_from_user_id(user_id)
+
+    assert get_user_from_email(email) is not get_user_from_email(email)
@@ -0,0 +1,188 @@
+"""
+Load test for the leaderboard.
+
+Runs flask_app against DynamoDB Local with a fleet of simulated MEMENTOs, each of
+which registers and then updates on the same schedule as lab7_memento/code_leaderboard_client.py
+(an update, then an 11-second countdown). Reports latency percentiles and error rates
+for each endpoint and the DynamoDB read and write capacity units consumed.
+
+The simulated clients register with GET /api/register, which does not need a users table;
+registering with an email and course key (POST) also grades the lab and sends email.
+
+Note that all of the clients share one process, and therefore one leaderboard cache.
+On Lambda, each concurrent execution environment has its own cache.
+
+Usage (from lambda-leaderboard, with DynamoDB Local running; see `make start_local_dynamodb` in ..):
+    poetry run python bench/load_test.py --clients 100 --seconds 120
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+import statistics
+from collections import defaultdict
+from os.path import dirname, join, abspath
+
+import boto3
+from botocore.exceptions import ClientError
+
+DYNAMODB_LOCAL_ENDPOINT = 'http://localhost:8000/'
+LOAD_TEST_TABLE = 'LeaderboardLoadTest'
+MEMENTO_COUNTDOWN = 11          # seconds between updates in code_leaderboard_client.py
+READ_OPERATIONS = {'Scan', 'Query', 'GetItem', 'BatchGetItem'}
+
+class Stats:
+    """Thread-safe collection of request latencies and DynamoDB consumed capacity."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list) # endpoint -> [seconds]
+        self.errors = defaultdict(int)     # endpoint -> count
+        self.operations = defaultdict(int) # DynamoDB operation -> count
+        self.rcu = 0.0
+        self.wcu = 0.0
+
+    def add_request(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def add_capacity(self, operation, consumed):
+        units = sum(float(c.get('CapacityUnits', 0)) for c in consumed)
+        with self.lock:
+            self.operations[operation] += 1
+            if operation in READ_OPERATIONS:
+                self.rcu += units
+            else:
+                self.wcu += units
+
+
+def percentile(values, pct):
+    """Return the pct'th percentile of values"""
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100, method='inclusive')[pct - 1]
+
+
+def track_capacity(client, stats):
+    """Ask DynamoDB for the capacity consumed by each call made with client and add it to stats."""
+    def add_return_consumed_capacity(params, **kwargs):
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+    def record_consumed_capacity(http_response, parsed, model, **kwargs):
+        consumed = parsed.get('ConsumedCapacity', [])
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        stats.add_capacity(model.name, consumed)
+
+    for operation in ('Scan', 'Query', 'GetItem', 'PutItem', 'UpdateItem', 'DeleteItem'):
+        client.meta.events.register(f'provide-client-params.dynamodb.{operation}', add_return_consumed_capacity)
+        client.meta.events.register(f'after-call.dynamodb.{operation}', record_consumed_capacity)
+
+
+def create_table(dynamodb, table_name):
+    """Create an empty leaderboard table, deleting any left over from an earlier run."""
+    table = dynamodb.Table(table_name)
+    try:
+        table.delete()
+        table.wait_until_not_exists()
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+    table = dynamodb.create_table(TableName=table_name,
+                                  KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}],
+                                  AttributeDefinitions=[{'AttributeName': 'name', 'AttributeType': 'S'}],
+                                  BillingMode='PAY_PER_REQUEST')
+    table.wait_until_exists()
+    return table
+
+
+def run_client(app, stats, t_end, countdown):
+    """Simulate one MEMENTO until t_end."""
+    client = app.test_client()
+
+    def timed(endpoint, method, **kwargs):
+        t0 = time.time()
+        try:
+            response = method(endpoint, **kwargs)
+            ok = response.status_code == 200
+        except Exception:     # pylint: disable=broad-exception-caught
+            response = None
+            ok = False
+        stats.add_request(endpoint, time.time() - t0, ok)
+        return response.json if ok else None
+
+    # MEMENTOs are powered on over a countdown, not all at once
+    time.sleep(random.uniform(0, countdown))
+    registration = timed('/api/register', client.get)
+    if registration is None:
+        return
+    version = None
+    while time.time() < t_end:
+        post_data = {'opaque': registration['opaque']}
+        if version is not None:
+            post_data['since'] = version
+        data = timed('/api/update', client.post, data=post_data)
+        if data is not None:
+            version = data.get('version')
+        time.sleep(countdown)
+
+
+def report(stats, clients, seconds):
+    """Print the results"""
+    print(f"\n{clients} clients for {seconds} seconds\n")
+    print(f"{'endpoint':<16} {'requests':>8} {'errors':>7} {'error%':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint, latencies in sorted(stats.latencies.items()):
+        errors = stats.errors[endpoint]
+        print(f"{endpoint:<16} {len(latencies):>8} {errors:>7} {100 * errors / len(latencies):>7.2f} "
+              f"{1000 * percentile(latencies, 50):>8.1f} {1000 * percentile(latencies, 95):>8.1f} "
+              f"{1000 * percentile(latencies, 99):>8.1f}")
+    requests = sum(len(latencies) for latencies in stats.latencies.values())
+    print("\nDynamoDB operations: " +
+          ", ".join(f"{operation}={count}" for operation, count in sorted(stats.operations.items())))
+    print(f"DynamoDB consumed: RCU={stats.rcu:.1f} WCU={stats.wcu:.1f} "
+          f"({stats.rcu / max(requests, 1):.2f} RCU and {stats.wcu / max(requests, 1):.2f} WCU per request)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Leaderboard load test against DynamoDB Local",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100, help='number of simulated MEMENTOs')
+    parser.add_argument('--seconds', type=int, default=60, help='how long to run')
+    parser.add_argument('--countdown', type=float, default=MEMENTO_COUNTDOWN, help='seconds between updates')
+    parser.add_argument('--endpoint', default=os.environ.get('AWS_ENDPOINT_URL_DYNAMODB', DYNAMODB_LOCAL_ENDPOINT))
+    parser.add_argument('--table', default=LOAD_TEST_TABLE, help='table to create for the test')
+    args = parser.parse_args()
+
+    # flask_app creates its table resource when it is imported
+    os.environ['AWS_ENDPOINT_URL_DYNAMODB'] = args.endpoint
+    os.environ['LEADERBOARD_TABLE'] = args.table
+    for (var, value) in (('AWS_ACCESS_KEY_ID', 'minioadmin'),
+                         ('AWS_SECRET_ACCESS_KEY', 'minioadmin'),
+                         ('AWS_DEFAULT_REGION', 'us-east-1')):
+        os.environ.setdefault(var, value)
+    here = dirname(abspath(__file__))
+    sys.path[:0] = [join(here, '..', 'src'), join(here, '..', '..')]
+    from leaderboard_app import flask_app # pylint: disable=import-outside-toplevel
+    flask_app.app.logger.setLevel(logging.WARNING)
+
+    create_table(boto3.resource('dynamodb', endpoint_url=args.endpoint), args.table)
+    stats = Stats()
+    track_capacity(flask_app.dynamodb.meta.client, stats)
+
+    t_end = time.time() + args.seconds
+    threads = [threading.Thread(target=run_client, args=(flask_app.app, stats, t_end, args.countdown), daemon=True)
+               for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(stats, args.clients, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
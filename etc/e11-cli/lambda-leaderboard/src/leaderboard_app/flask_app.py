@@ -3,20 +3,23 @@ Leaerboard Fask Application (src/app.py).
 """
 import time
 import os
+import json
 import logging
 import random
+import threading
 from datetime import datetime
 from os.path import dirname
 from functools import lru_cache
 import base64
 
-from flask import Flask, request, jsonify, render_template, abort
+from flask import Flask, Response, request, jsonify, render_template, abort, stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
 from botocore.exceptions import ClientError
 import boto3
 from itsdangerous import Serializer,BadSignature,BadData
 
-from e11.e11_common import (get_user_from_email, get_grade, add_user_log, add_leaderboard_log, add_grade, send_email2)
+from e11.e11_common import (get_user_from_email, get_grade, add_user_log, add_leaderboard_log, add_grade, send_email2,
+                            EmailNotRegistered, queue_steps_done, record_queue_step)
 from e11.e11core import grader
 
 __version__ = '1.0.0'
@@ -34,6 +37,18 @@ dynamodb = boto3.resource( 'dynamodb')
 leaderboard_table = dynamodb.Table(os.environ.get('LEADERBOARD_TABLE', DEFAULT_LEADERBOARD_TABLE))
 SECRET_KEY = 'to be changed'    # for its dangerous
 MAX_ITEMS = 100                 # we have 90 students in the class
+LEADERBOARD_CACHE_SECONDS = 5   # a scan of the leaderboard is reused for this long
+DELTA_OVERLAP_MS = (LEADERBOARD_CACHE_SECONDS + 2) * 1000  # deltas resend this much before 'since'; see leaderboard_delta()
+HEARTBEAT_WRITE_SECONDS = INACTIVE_SECONDS // 4  # last_seen is only rewritten when older than this
+LEADER_TTL_SECONDS = 3600       # DynamoDB TTL ('expires') removes leaders not seen for this long
+WATCH_SECONDS = 20              # longest that /api/watch holds a request open
+# /api/watch long-polling and /api/events streaming only work off Lambda. The deployed
+# leaderboard runs on Lambda, so there /api/watch answers at once and clients poll.
+WATCH_REQUESTS = 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ  # on Lambda a held request ties up an execution environment
+WATCH_CHECK_SECONDS = 1         # how often a held request checks for a change
+STREAM_SECONDS = 300            # an /api/events stream closes after this long; EventSource reconnects
+STREAM_EVENTS = 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ  # HTTP API buffers Lambda responses, so SSE cannot stream there
+LEADERBOARD_QUEUE_URL = os.environ.get('LEADERBOARD_QUEUE_URL')  # registrations are graded from here; inline if not set
 NO_MESSAGE = None
 
 app = Flask(__name__, template_folder=TEMPLATE_DIR)
@@ -103,12 +118,8 @@ def leader_is_active(leader):
     now = int(time.time())
     return (now - int(leader.get('last_seen',0))) < INACTIVE_SECONDS
 
-def get_leaderboard():
-    """
-    Get the leaders in the leaderboard.
-    Note if each is active or inactive.
-    Return sorted by when first seen.
-    """
+def scan_leaderboard():
+    """Return every leader in the leaderboard table."""
     try:
         leaders = []
         start_key = None
@@ -130,7 +141,56 @@ def get_leaderboard():
         raise
 
     # Convert DynamoDB responses to a bunch of dictionaries
-    leaders = [dict(leader) for leader in leaders]
+    return [dict(leader) for leader in leaders]
+
+# Every client polls, so rather than scanning the table on every request, each
+# process keeps the last scan for LEADERBOARD_CACHE_SECONDS. Writes made by this
+# process are merged into it, so a caller always sees its own update.
+_snapshot_lock = threading.Lock()
+_snapshot = {'time': 0.0, 'leaders': {}, 'version': 0}   # leaders by name
+
+def invalidate_leaderboard_cache():
+    """Make the next get_leaderboard() scan the table."""
+    with _snapshot_lock:
+        _snapshot['time'] = 0.0
+
+def remember_leader(leader):
+    """Merge a leader that this process wrote into the cached snapshot."""
+    with _snapshot_lock:
+        _snapshot['leaders'][leader['name']] = dict(leader)
+
+def leader_expires(leader):
+    """Return when a leader expires. Rows written before 'expires' existed expire LEADER_TTL_SECONDS after last_seen."""
+    return int(leader.get('expires', int(leader.get('last_seen', 0)) + LEADER_TTL_SECONDS))
+
+def leader_is_expired(leader):
+    """Return true if a leader has expired. DynamoDB deletes expired items lazily, so scans can still return them."""
+    return leader_expires(leader) <= int(time.time())
+
+def leader_changed(leader):
+    """Return when (in msec) a leader last changed as clients see it:
+    when its row was written, when it became inactive, or when it expired.
+    """
+    now_ms = int(time.time() * 1000)
+    changed = int(leader.get('updated', int(leader.get('last_seen', 0)) * 1000))
+    for event_ms in ((int(leader.get('last_seen', 0)) + INACTIVE_SECONDS) * 1000,
+                     leader_expires(leader) * 1000):
+        if event_ms <= now_ms:
+            changed = max(changed, event_ms)
+    return changed
+
+def get_leaderboard(include_expired=False):
+    """
+    Get the leaders in the leaderboard, scanning at most once every LEADERBOARD_CACHE_SECONDS.
+    Note if each is active or inactive.
+    Return sorted by when first seen.
+    """
+    with _snapshot_lock:
+        if time.time() - _snapshot['time'] >= LEADERBOARD_CACHE_SECONDS:
+            _snapshot['leaders'] = {leader['name']:leader for leader in scan_leaderboard()}
+            _snapshot['time'] = time.time()
+        leaders = [dict(leader) for leader in _snapshot['leaders'].values()
+                   if include_expired or not leader_is_expired(leader)]
 
     # Figure out who is active and inactive
     for leader in leaders:
@@ -138,6 +198,96 @@ def get_leaderboard():
 
     return sorted_leaders(leaders)
 
+def leaderboard_version(leaders):
+    """Return the leaderboard version: the time (in msec) of its most recent change.
+    leaders must include the expired leaders. The version never decreases, even when
+    DynamoDB deletes the leader that last changed.
+    """
+    version = max((leader_changed(leader) for leader in leaders), default=0)
+    with _snapshot_lock:
+        _snapshot['version'] = max(_snapshot['version'], version)
+        return _snapshot['version']
+
+def leaderboard_delta(since):
+    """Return (version, changed, expired) where changed are the leaders that changed after
+    version `since` and expired are the names of the leaders that expired after it. Both
+    also include what changed in the DELTA_OVERLAP_MS before `since`.
+    Clients should also drop leaders whose 'expires' has passed, since DynamoDB may
+    delete a row before a client hears that it expired.
+    """
+    all_leaders = get_leaderboard(include_expired=True)
+    version = leaderboard_version(all_leaders)
+    # `since` may come from a snapshot (here or in another process) that was up to
+    # LEADERBOARD_CACHE_SECONDS old and missed rows written just before it, and the
+    # clocks of the processes that wrote `updated` differ a little. Resending what
+    # changed in the DELTA_OVERLAP_MS before `since` covers both; clients merge by name.
+    after = since - DELTA_OVERLAP_MS if since else 0
+    changed = [leader for leader in all_leaders
+               if not leader_is_expired(leader) and leader_changed(leader) > after]
+    expired = [leader['name'] for leader in all_leaders
+               if leader_is_expired(leader) and leader_expires(leader) * 1000 > after]
+    return (version, changed, expired)
+
+
+def wait_for_change(since, seconds):
+    """Wait up to seconds for the leaderboard to change after version since.
+    Returns leaderboard_delta(since).
+    """
+    t_end = time.time() + seconds
+    while True:
+        (version, changed, expired) = leaderboard_delta(since)
+        if version > since or time.time() + WATCH_CHECK_SECONDS > t_end:
+            return (version, changed, expired)
+        time.sleep(WATCH_CHECK_SECONDS)
+
+def delta_response(since, version, changed, expired):
+    """Return the body of a response to a client that has version since."""
+    if version <= since and not changed and not expired:
+        return {'unchanged':True, 'message':NO_MESSAGE, 'now':int(time.time()), 'version':version}
+    return {'changed':changed, 'expired':expired, 'message':NO_MESSAGE, 'now':int(time.time()), 'version':version}
+
+
+def write_leader(this_leader, stored):
+    """Write this_leader, which is the row stored in the table (or None if there is none) with
+    a new last_seen. Heartbeats are coalesced: nothing is written if the stored row is recent
+    enough and otherwise unchanged. Returns the row as now stored.
+    """
+    now = this_leader['last_seen']
+    if (stored is not None
+        and now - int(stored['last_seen']) < HEARTBEAT_WRITE_SECONDS
+        and stored.get('ip_address') == this_leader['ip_address']
+        and stored.get('user_agent') == this_leader['user_agent']):
+        return stored
+
+    this_leader = {**this_leader, 'expires': now + LEADER_TTL_SECONDS, 'updated': int(time.time() * 1000)}
+    try:
+        if stored is not None:
+            try:
+                leaderboard_table.update_item(
+                    Key={'name': this_leader['name']},
+                    UpdateExpression='SET last_seen=:ls, #ex=:ex, updated=:up, ip_address=:ip, user_agent=:ua',
+                    ConditionExpression='attribute_exists(#n)',
+                    ExpressionAttributeNames={'#n': 'name', '#ex': 'expires'},
+                    ExpressionAttributeValues={':ls': now,
+                                               ':ex': this_leader['expires'],
+                                               ':up': this_leader['updated'],
+                                               ':ip': this_leader['ip_address'],
+                                               ':ua': this_leader['user_agent']})
+                return this_leader
+            except ClientError as err:
+                if err.response.get('Error',{}).get('Code') != 'ConditionalCheckFailedException':
+                    raise
+                # Removed by TTL since it was scanned; write the whole row
+        leaderboard_table.put_item(Item=this_leader)
+    except ClientError as err:
+        app.logger.error(
+            "Couldn't write leader: %s: %s",
+            err.response.get('Error',{}).get('Code','n/a'),
+            err.response.get('Error',{}).get('Message','n/a')
+        )
+        raise
+    return this_leader
+
 
 def update_leaderboard(*,data,ip_address,user_agent):
     """Given a name that's already been validated,
@@ -152,43 +302,23 @@ def update_leaderboard(*,data,ip_address,user_agent):
                    'user_agent':user_agent}
     app.logger.debug("this_leader=%s",this_leader)
 
-    # Update this leader on the leaderboard
-    try:
-        leaderboard_table.put_item(Item=this_leader) # replaces if already there
-    except ClientError as err:
-        app.logger.error(
-            "Couldn't put_item on leaders: %s: %s",
-            err.response.get('Error',{}).get('Code','n/a'),
-            err.response.get('Error',{}).get('Message','n/a')
-        )
-        raise
-
-    # Get the leaderboard (will include this_leader, and this_leader should be active)
+    # Get the leaderboard, which may predate this write, and merge in this_leader
     leaders = get_leaderboard()
+    stored = next((leader for leader in leaders if leader['name'] == this_leader['name']), None)
+    if stored is not None:
+        stored = {k: v for (k, v) in stored.items() if k != 'active'}
+    this_leader = write_leader(this_leader, stored)
+    remember_leader(this_leader)
+    leaders = [leader for leader in leaders if leader['name'] != this_leader['name']]
+    leaders = sorted_leaders(leaders + [{**this_leader, 'active': leader_is_active(this_leader)}])
 
     me = [leader for leader in leaders if leader['name']==this_leader['name']]
     assert len(me)==1
     assert me[0]['active'] is True
 
-
-    # If the number of leaders on the leaderboard is more than MAX_ITEMS, delete all the inactives
-    to_delete = []
+    # Inactive leaders are removed by DynamoDB TTL. If there are too many to display, only show the active ones.
     if len(leaders) > MAX_ITEMS:
-        to_delete.extend([leader for leader in leaders if not leader['active']])
         leaders = [leader for leader in leaders if leader['active']]
-
-    # Delete all in to_delete from DynamoDB
-    try:
-        with leaderboard_table.batch_writer() as batch:
-            for leader in to_delete:
-                batch.delete_item(Key={'name':leader['name']})
-    except ClientError as err:
-        app.logger.error(
-            "Couldn't delete_item on leaders: %s: %s",
-            err.response.get('Error',{}).get('Code','n/a'),
-            err.response.get('Error',{}).get('Message','n/a')
-        )
-        raise
     return leaders
 
 
@@ -231,6 +361,8 @@ def root():
                          ip_address=ip_address,
                          FAVICO=icon_data,
                          __version__=__version__,
+                         STREAM_EVENTS=STREAM_EVENTS,
+                         WATCH_REQUESTS=WATCH_REQUESTS,
                          DEPLOYMENT_TIMESTAMP = os.getenv("DEPLOYMENT_TIMESTAMP","n/a") )
 
 @app.route('/api/register', methods=['GET'])
@@ -244,7 +376,7 @@ def api_get_register():
 @app.route('/api/register', methods=['POST'])
 def api_post_register():
     """POST METHOD:
-    Check the posted email and class key. If they are correct, grade the assignment.
+    Check the posted email and class key. If they are correct, queue the assignment to be graded.
     Then return the registration of the name and secret key. Store hashed key in database"""
     email = request.form.get('email','')
     course_key = request.form.get('course_key','')
@@ -255,16 +387,36 @@ def api_post_register():
     if user.course_key != course_key:
         abort(404, 'invalid course_key')
 
-    # register the user
+    # register the user. Grading and email happen in the background.
     registration = new_registration()
+    queue_registration({'email': email,
+                        'name': registration['name'],
+                        'user_agent': str(request.user_agent),
+                        'client_ip': get_client_ip_address()})
+    return  jsonify(registration)
 
-    # Note that this user registered
-    name  = registration['name']
-    user_agent = str(request.user_agent)
-    add_user_log(None, user.user_id, f"registered on leaderboard with name={name} and user_agent={user_agent}")
-    add_leaderboard_log(user.user_id, get_client_ip_address(), name, user_agent)
+# Registrations are graded from LeaderboardQueue so that /api/register does not wait for
+# DynamoDB and SES. See handle_sqs_event() and leaderboard.lambda_handler().
+
+def grade_registration(*, email, name, user_agent, client_ip, message_id=None):
+    """Log that the user registered on the leaderboard, grade lab7 and email the grade.
+    message_id is the SQS messageId; steps that finished on an earlier delivery of it are skipped.
+    Raises EmailNotRegistered if there is no user with email.
+    """
+    user = get_user_from_email(email)
+    done = queue_steps_done(user.user_id, message_id) if message_id else set()
 
-    # Right now this just sends through the grade, but the correct way to do this is to request a grade through SQS
+    def once(step, func, *args, **kwargs):
+        if step in done:
+            app.logger.info("SQS messageId=%s: %s already done", message_id, step)
+            return
+        func(*args, **kwargs)
+        if message_id:
+            record_queue_step(user.user_id, message_id, step)
+
+    once('user-log', add_user_log, None, user.user_id,
+         f"registered on leaderboard with name={name} and user_agent={user_agent}")
+    once('leaderboard-log', add_leaderboard_log, user.user_id, client_ip, name, user_agent)
 
     tests = [{'name':'Post to API',
               'status':'pass',
@@ -296,19 +448,108 @@ def api_post_register():
                'ctx':{},
                'error':False}
 
-    add_grade(user, LAB, request.remote_addr, summary)
+    once('grade', add_grade, user, LAB, client_ip, summary)
     (subject, body) = grader.create_email(summary)
-    send_email2(to_addrs=user.emails(),
-               email_subject = subject,
-               email_body=body)
+    once('email', send_email2, to_addrs=user.emails(), email_subject=subject, email_body=body)
 
-    return  jsonify(registration)
+@lru_cache(maxsize=1)
+def get_sqs_client():
+    return boto3.client('sqs')
+
+def queue_registration(job):
+    """Send a registration to LEADERBOARD_QUEUE_URL to be graded.
+    If there is no queue, or it cannot be reached, grade it now so that the grade is not lost.
+    """
+    if LEADERBOARD_QUEUE_URL:
+        try:
+            get_sqs_client().send_message(QueueUrl=LEADERBOARD_QUEUE_URL, MessageBody=json.dumps(job))
+            return
+        except ClientError:
+            app.logger.exception("could not queue registration for %s; grading now", job['email'])
+    else:
+        app.logger.info("LEADERBOARD_QUEUE_URL not set; grading registration for %s now", job['email'])
+    grade_registration(**job)
+
+def handle_sqs_event(event, context): # pylint: disable=unused-argument
+    """Grade the registrations in an SQS batch. Failed records are retried by SQS
+    and then go to the dead letter queue. Registrations that can never be graded
+    (an unknown email or a malformed body) are dropped rather than retried.
+    """
+    failures = []
+    for record in event.get('Records', []):
+        try:
+            grade_registration(**json.loads(record['body']), message_id=record['messageId'])
+        except (EmailNotRegistered, ValueError, TypeError) as e:
+            app.logger.error("SQS messageId=%s: dropping registration that cannot be graded: %s",
+                             record.get('messageId'), e)
+        except Exception:   # pylint: disable=broad-exception-caught
+            app.logger.exception("SQS messageId=%s: could not grade registration", record.get('messageId'))
+            failures.append({'itemIdentifier': record['messageId']})
+    return {'batchItemFailures': failures}
+
+@app.route('/api/leaderboard', methods=['GET'])
+def api_leaderboard():
+    """Return the whole leaderboard. The ETag is the leaderboard version, so
+    a GET with If-None-Match returns 304 Not Modified until the leaderboard changes.
+    """
+    now = int(time.time())
+    (version, _, _) = leaderboard_delta(0)
+    response = jsonify({'leaderboard':get_leaderboard(), 'version':version, 'now':now})
+    response.set_etag(str(version))
+    return response.make_conditional(request)
 
 @app.route('/api/update', methods=['POST'])
 def api_update():   # pylint disable=missing-function-docstring
+    """Heartbeat for a registered leader.
+    Without 'since', returns the whole leaderboard and its version.
+    With 'since' (a version from an earlier response), returns {'unchanged':True} if there
+    have been no changes, otherwise just the leaders that 'changed' and the names that 'expired'.
+    """
     now = int(time.time())      # because callers may not have reliable time
     data = validate_registration(request.form['opaque'])
     leaders = update_leaderboard(data=data, ip_address=request.remote_addr,
                                  user_agent=str(request.user_agent))
-    # and return to the caller
-    return jsonify({'leaderboard':leaders,'message':NO_MESSAGE, 'now':now})
+    since = request.form.get('since', type=int)
+    if since is None:
+        (version, _, _) = leaderboard_delta(0)
+        # and return to the caller
+        return jsonify({'leaderboard':leaders,'message':NO_MESSAGE, 'now':now, 'version':version})
+    return jsonify(delta_response(since, *leaderboard_delta(since)))
+
+@app.route('/api/watch', methods=['POST'])
+def api_watch():
+    """Long-poll: like /api/update with 'since', but holds the request open until the
+    leaderboard changes or 'timeout' seconds (at most WATCH_SECONDS) pass.
+    'opaque' is optional; if provided, the request is also a heartbeat for that leader.
+    Requests are only held where WATCH_REQUESTS; on Lambda this answers at once, so poll /api/update there.
+    """
+    if 'opaque' in request.form:
+        data = validate_registration(request.form['opaque'])
+        update_leaderboard(data=data, ip_address=request.remote_addr,
+                           user_agent=str(request.user_agent))
+    since = request.form.get('since', 0, type=int)
+    seconds = min(request.form.get('timeout', WATCH_SECONDS, type=float), WATCH_SECONDS) if WATCH_REQUESTS else 0
+    return jsonify(delta_response(since, *wait_for_change(since, seconds)))
+
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    """Server-sent events: a 'leaderboard' event, in the format of a /api/update delta response,
+    each time the leaderboard changes. The event id is the version, so a reconnecting
+    EventSource resumes where it left off. Only streams where responses are not buffered (see STREAM_EVENTS).
+    """
+    since = int(request.headers.get('Last-Event-ID') or request.args.get('since', 0, type=int))
+
+    def events(since):
+        yield f"retry: {WATCH_CHECK_SECONDS * 1000}\n\n"
+        t_end = time.time() + STREAM_SECONDS
+        while time.time() < t_end:
+            (version, changed, expired) = wait_for_change(since, min(WATCH_SECONDS, t_end - time.time()))
+            if version > since:
+                body = app.json.dumps(delta_response(since, version, changed, expired))
+                yield f"id: {version}\nevent: leaderboard\ndata: {body}\n\n"
+                since = version
+            else:
+                yield ": keepalive\n\n"
+
+    return Response(stream_with_context(events(since)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -1,7 +1,13 @@
 """
-Lambda handler for AWS API Gateway
+Lambda handler for AWS API Gateway and for LeaderboardQueue
 """
 
 from apig_wsgi import make_lambda_handler
 from . import flask_app
-lambda_handler = make_lambda_handler(flask_app.app)
+http_handler = make_lambda_handler(flask_app.app)
+
+def lambda_handler(event, context):
+    """SQS events grade registrations; everything else is an HTTP API request."""
+    if 'Records' in event:
+        return flask_app.handle_sqs_event(event, context)
+    return http_handler(event, context)
@@ -2,11 +2,17 @@
 Test the leaderboard.
 """
 
+import json
 import logging
+import threading
+import time
+
 import pytest
 from flask import render_template
 
+from leaderboard_app import flask_app
 from leaderboard_app.flask_app import app
+from leaderboard_app.leaderboard import lambda_handler
 
 
 @pytest.fixture
@@ -41,3 +47,190 @@ def test_client_request(app_context, dynamodb_local):
         for leader in leaderboard:
             logging.error(leader)
         raise RuntimeError("not in leaderboard")
+
+
+def test_update_reuses_cached_scan(app_context, dynamodb_local, monkeypatch):
+    """Polls within LEADERBOARD_CACHE_SECONDS share one scan, and each caller sees its own update."""
+    scans = []
+    real_scan = flask_app.leaderboard_table.scan
+    def counting_scan(**kwargs):
+        scans.append(kwargs)
+        return real_scan(**kwargs)
+    monkeypatch.setattr(flask_app.leaderboard_table, "scan", counting_scan)
+    flask_app.invalidate_leaderboard_cache()
+
+    client = app.test_client()
+    reg1 = client.get('/api/register').json
+    reg2 = client.get('/api/register').json
+    r1 = client.post('/api/update', data=reg1)
+    r2 = client.post('/api/update', data=reg2)
+    assert r1.status_code == 200 and r2.status_code == 200
+    assert len(scans) == 1
+
+    names = [leader['name'] for leader in r2.json['leaderboard']]
+    assert reg1['name'] in names
+    assert reg2['name'] in names
+
+
+def test_heartbeats_are_coalesced(app_context, dynamodb_local, monkeypatch):
+    """A second update soon after the first does not write to DynamoDB."""
+    writes = []
+    for method in ("put_item", "update_item"):
+        real = getattr(flask_app.leaderboard_table, method)
+        def spy(real=real, method=method, **kwargs):
+            writes.append(method)
+            return real(**kwargs)
+        monkeypatch.setattr(flask_app.leaderboard_table, method, spy)
+
+    client = app.test_client()
+    reg = client.get('/api/register').json
+    assert client.post('/api/update', data=reg).status_code == 200
+    assert client.post('/api/update', data=reg).status_code == 200
+    assert writes == ["put_item"]
+
+
+def test_expired_leaders_are_not_shown(app_context, dynamodb_local):
+    """Leaders past their TTL are hidden even before DynamoDB deletes them."""
+    now = int(time.time())
+    flask_app.leaderboard_table.put_item(Item={'name': 'expired leader', 'first_seen': now - 7200,
+                                               'last_seen': now - 7200, 'expires': now - 3600,
+                                               'ip_address': '1.2.3.4', 'user_agent': 'test'})
+    flask_app.invalidate_leaderboard_cache()
+    names = [leader['name'] for leader in flask_app.get_leaderboard()]
+    assert 'expired leader' not in names
+
+
+def test_update_since_returns_delta(app_context, dynamodb_local):
+    """With 'since', /api/update returns only what changed after that version."""
+    client = app.test_client()
+    reg1 = client.get('/api/register').json
+    reg2 = client.get('/api/register').json
+    v1 = client.post('/api/update', data=reg1).json['version']
+
+    # Leaders that changed just before 'since' are resent, in case 'since' came from a stale snapshot
+    r = client.post('/api/update', data={**reg1, 'since': v1}).json
+    assert r['version'] == v1
+    assert [leader['name'] for leader in r['changed']] == [reg1['name']]
+
+    r = client.post('/api/update', data={**reg1, 'since': v1 + flask_app.DELTA_OVERLAP_MS}).json
+    assert r['unchanged'] is True
+
+    r = client.post('/api/update', data={**reg2, 'since': v1}).json
+    assert r['version'] > v1
+    assert reg2['name'] in [leader['name'] for leader in r['changed']]
+    assert r['expired'] == []
+
+
+def test_delta_resends_rows_missed_by_a_stale_snapshot(monkeypatch):
+    """A row that another process wrote just before 'since', but that was not in the
+    snapshot 'since' came from, is still sent once it is scanned."""
+    now = int(time.time())
+    mine = {'name': 'MINE', 'first_seen': now, 'last_seen': now, 'expires': now + 3600,
+            'updated': now * 1000}
+    theirs = {**mine, 'name': 'THEIRS', 'updated': now * 1000 - 2000}
+    monkeypatch.setattr(flask_app, 'get_leaderboard', lambda include_expired=False: [mine])
+    (since, _, _) = flask_app.leaderboard_delta(0)
+    monkeypatch.setattr(flask_app, 'get_leaderboard', lambda include_expired=False: [mine, theirs])
+    r = flask_app.delta_response(since, *flask_app.leaderboard_delta(since))
+    assert 'THEIRS' in [leader['name'] for leader in r['changed']]
+
+
+def test_leaderboard_get_honors_etag(app_context, dynamodb_local):
+    """GET /api/leaderboard returns 304 when If-None-Match matches the version."""
+    client = app.test_client()
+    reg = client.get('/api/register').json
+    client.post('/api/update', data=reg)
+    r1 = client.get('/api/leaderboard')
+    assert r1.status_code == 200
+    assert r1.headers['ETag'] == f'"{r1.json["version"]}"'
+    r2 = client.get('/api/leaderboard', headers={'If-None-Match': r1.headers['ETag']})
+    assert r2.status_code == 304
+
+
+def test_watch_returns_when_leaderboard_changes(app_context, dynamodb_local):
+    """/api/watch holds the request until another leader's update changes the version."""
+    client = app.test_client()
+    reg1 = client.get('/api/register').json
+    reg2 = client.get('/api/register').json
+    v1 = client.post('/api/update', data=reg1).json['version']
+
+    r = client.post('/api/watch', data={'since': v1, 'timeout': 0.1}).json
+    assert r['version'] == v1
+
+    results = []
+    watcher = threading.Thread(target=lambda: results.append(
+        app.test_client().post('/api/watch', data={'since': v1, 'timeout': 10}).json))
+    t0 = time.time()
+    watcher.start()
+    client.post('/api/update', data=reg2)
+    watcher.join()
+    assert time.time() - t0 < 10
+    assert results[0]['version'] > v1
+    assert reg2['name'] in [leader['name'] for leader in results[0]['changed']]
+
+
+def test_watch_does_not_hold_requests_on_lambda(monkeypatch):
+    """Where WATCH_REQUESTS is off (Lambda), /api/watch answers at once."""
+    monkeypatch.setattr(flask_app, 'WATCH_REQUESTS', False)
+    monkeypatch.setattr(flask_app, 'get_leaderboard', lambda include_expired=False: [])
+    since = int(time.time() * 1000) + 60_000    # newer than any version other tests left behind
+    t0 = time.time()
+    r = app.test_client().post('/api/watch', data={'since': since, 'timeout': 10}).json
+    assert time.time() - t0 < flask_app.WATCH_CHECK_SECONDS
+    assert r['unchanged'] is True
+
+
+def test_events_stream_leaderboard(app_context, dynamodb_local):
+    """/api/events sends the changes since Last-Event-ID as a server-sent event."""
+    client = app.test_client()
+    reg = client.get('/api/register').json
+    version = client.post('/api/update', data=reg).json['version']
+    r = client.get('/api/events', headers={'Last-Event-ID': str(version - 1)}, buffered=False)
+    assert r.mimetype == 'text/event-stream'
+    chunks = r.response
+    assert next(chunks).decode().startswith('retry:')
+    event = next(chunks).decode()
+    r.close()
+    assert event.startswith(f'id: {version}\nevent: leaderboard\ndata: ')
+    data = json.loads(event.split('data: ', 1)[1])
+    assert reg['name'] in [leader['name'] for leader in data['changed']]
+
+
+def test_registration_is_queued(monkeypatch):
+    """With LEADERBOARD_QUEUE_URL set, registrations are sent to SQS, not graded."""
+    sent = []
+
+    class FakeSQS:
+        def send_message(self, **kwargs):
+            sent.append(kwargs)
+
+    def fail_grading(**job):
+        raise AssertionError(f"graded in the request: {job}")
+
+    monkeypatch.setattr(flask_app, 'LEADERBOARD_QUEUE_URL', 'https://sqs.example/leaderboard-queue')
+    monkeypatch.setattr(flask_app, 'get_sqs_client', FakeSQS)
+    monkeypatch.setattr(flask_app, 'grade_registration', fail_grading)
+    job = {'email': 'student@example.com', 'name': 'HAPPY TEST', 'user_agent': 'magic', 'client_ip': '10.0.0.1'}
+    flask_app.queue_registration(job)
+    assert sent[0]['QueueUrl'] == 'https://sqs.example/leaderboard-queue'
+    assert json.loads(sent[0]['MessageBody']) == job
+
+
+def test_sqs_event_reports_failed_registrations(dynamodb_local):
+    """A registration whose grading fails (here, DynamoDB Local has no users table) is reported back to SQS to be retried."""
+    body = json.dumps({'email': 'nobody@example.com', 'name': 'HAPPY TEST', 'user_agent': 'magic', 'client_ip': '10.0.0.1'})
+    event = {'Records': [{'messageId': 'm1', 'body': body}]}
+    assert lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': 'm1'}]}
+
+
+def test_sqs_event_drops_registrations_that_cannot_be_graded(monkeypatch):
+    """Unknown emails and malformed bodies are not retried."""
+    def unknown(email):
+        raise flask_app.EmailNotRegistered(email)
+
+    monkeypatch.setattr(flask_app, 'get_user_from_email', unknown)
+    body = json.dumps({'email': 'nobody@example.com', 'name': 'HAPPY TEST', 'user_agent': 'magic', 'client_ip': '10.0.0.1'})
+    event = {'Records': [{'messageId': 'm1', 'body': body},
+                         {'messageId': 'm2', 'body': 'not json'},
+                         {'messageId': 'm3', 'body': json.dumps({'email': 'nobody@example.com'})}]}
+    assert lambda_handler(event, None) == {'batchItemFailures': []}
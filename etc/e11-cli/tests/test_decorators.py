@@ -1,5 +1,7 @@
 """Tests for e11.e11core.decorators module."""
+import contextvars
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
@@ -56,6 +58,42 @@ class TestTimeout:
         assert documented_function.__name__ == "documented_function"
         assert documented_function.__doc__ == "This is a test function."
 
+    def test_timeout_in_worker_thread(self):
+        """Test that timeout works outside the main thread, where SIGALRM cannot be used."""
+        @timeout(1)
+        def slow_function():
+            time.sleep(2)
+
+        @timeout(1)
+        def fast_function(x):
+            return x * 2
+
+        @timeout(1)
+        def failing_function():
+            raise ValueError("boom")
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            with pytest.raises(TimeoutError, match="timed out after 1s"):
+                pool.submit(slow_function).result()
+            assert pool.submit(fast_function, 21).result() == 42
+            with pytest.raises(ValueError, match="boom"):
+                pool.submit(failing_function).result()
+
+    def test_timeout_in_worker_thread_sees_context_variables(self):
+        """Test that the helper thread runs in the caller's context."""
+        var = contextvars.ContextVar("var", default="unset")
+
+        @timeout(1)
+        def get_var():
+            return var.get()
+
+        def in_worker():
+            var.set("set")
+            return get_var()
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            assert pool.submit(in_worker).result() == "set"
+
 
 class TestRetry:
     """Test cases for retry decorator."""
@@ -0,0 +1,46 @@
+"""
+Test the pure-Python JPEG inspector with the grading fixtures.
+"""
+
+from e11.e11core import jpeg
+from e11.lab_tests.lincoln import lincoln_jpeg
+from e11.lab_tests.livingroom import livingroom_jpeg
+
+
+def test_inspect_head():
+    data = lincoln_jpeg()
+    info = jpeg.inspect_head(data[:jpeg.HEAD_BYTES])
+    assert (info.width, info.height) == (360, 532)
+    assert info.has_exif
+    assert not jpeg.inspect_head(livingroom_jpeg()).has_exif
+
+
+def test_validate_jpeg_from_head_and_tail():
+    data = livingroom_jpeg()
+    assert jpeg.validate_jpeg(data[:4096], data[-jpeg.TAIL_BYTES:]) == (True, "640x480 JPEG")
+    # truncated upload: the tail is real data, but not the end of the image
+    truncated_tail = data[-jpeg.TAIL_BYTES - 100:-100]
+    assert len(truncated_tail) == jpeg.TAIL_BYTES
+    assert jpeg.validate_jpeg(data[:4096], truncated_tail) == (False, "does not end with EOI")
+    # not a JPEG
+    assert jpeg.validate_jpeg(b"X" * 65536, b"X" * 64) == (False, "does not start with SOI")
+    # head ends before the SOS
+    assert jpeg.validate_jpeg(data[:100], data)[0] is False
+
+
+def test_find_exif():
+    assert jpeg.find_exif(lincoln_jpeg())[0] is True
+    assert jpeg.find_exif(livingroom_jpeg())[0] is False
+
+
+def test_strip_exif():
+    data = lincoln_jpeg()
+    stripped = jpeg.strip_exif(data)
+    assert jpeg.find_exif(stripped)[0] is False
+    assert not any(segment.marker == jpeg.APP1 for segment in jpeg.iter_segments(stripped))
+    assert jpeg.validate_jpeg(stripped, stripped)[0] is True
+    assert len(stripped) < len(data)
+    # The image data is untouched
+    assert data.endswith(stripped[-1000:])
+    # Nothing to strip
+    assert jpeg.strip_exif(livingroom_jpeg()) == livingroom_jpeg()
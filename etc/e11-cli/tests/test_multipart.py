@@ -0,0 +1,52 @@
+"""
+Test the streaming multipart/form-data encoder.
+"""
+
+import io
+import email.parser
+
+from e11.e11core.multipart import MultipartEncoder
+from e11.lab_tests.lincoln import lincoln_jpeg
+
+FIELDS = {"key": "images/0123.jpeg", "Content-Type": "image/jpeg"}
+
+
+def _parse(content_type, body):
+    """Return [(name, filename, payload)] for a multipart/form-data body"""
+    msg = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    return [(part.get_param("name", header="content-disposition"),
+             part.get_param("filename", header="content-disposition"),
+             part.get_payload(decode=True)) for part in msg.get_payload()]
+
+
+def test_multipart_body():
+    data = lincoln_jpeg()
+    body = MultipartEncoder(FIELDS, "file", "image.jpeg", data, "image/jpeg")
+    encoded = b"".join(body)
+    assert len(encoded) == len(body) == int(body.headers()["Content-Length"])
+    assert body.headers()["Content-Type"] == body.content_type
+    assert _parse(body.content_type, encoded) == [("key", None, b"images/0123.jpeg"),
+                                                  ("Content-Type", None, b"image/jpeg"),
+                                                  ("file", "image.jpeg", data)]
+
+
+def test_multipart_file_object_reads():
+    data = lincoln_jpeg()
+    expected = b"".join(MultipartEncoder(FIELDS, "file", "image.jpeg", data, boundary="X"))
+
+    # The file is read from its current position
+    f = io.BytesIO(b"skip" + data)
+    f.read(4)
+    body = MultipartEncoder(FIELDS, "file", "image.jpeg", f, boundary="X")
+    assert len(body) == len(expected)
+
+    # Reads of any size, as requests and adafruit_requests make them
+    assert b"".join(iter(lambda: body.read(36), b"")) == expected
+    assert body.read() == b""
+    body.seek(0)
+    buf = bytearray(1000)
+    assert body.readinto(buf) == 1000 and bytes(buf) == expected[:1000]
+    assert body.tell() == 1000
+    assert body.read() == expected[1000:]
+    body.seek(-10, 2)
+    assert body.read() == expected[-10:]
@@ -6,15 +6,87 @@ STUDENTS - You do not need to modify this file.
 
 """
 
-from flask import request, abort
+import sys
+
+from flask import request, abort, jsonify, make_response
 from . import apikey
 from . import db
 
+# get-messages and get-images return a page of at most `limit` rows, newest first.
+# To get the next page, pass the smallest id you have as `before_id`.
+# To get just the rows added since a poll, pass the largest id you have as `since`.
+# Responses have an ETag that changes when the rows do; send it back with If-None-Match
+# and the server answers 304 Not Modified without running the query.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MESSAGE_FIELDS = ("message_id", "message", "created", "created_by")
+
+
+def get_page_args():
+    """Return (limit, before_id, since) for the current Flask request.
+    before_id and since are None if not provided.
+    """
+    limit = request.values.get("limit", type=int, default=DEFAULT_PAGE_SIZE)
+    if limit is None or limit < 1:
+        abort(400, description="limit must be a positive integer")
+    before_id = request.values.get("before_id", type=int)
+    since = request.values.get("since", type=int)
+    return (min(limit, MAX_PAGE_SIZE), before_id, since)
+
+
+def not_modified(etag):
+    """Return a 304 response if the request's If-None-Match includes etag, otherwise None"""
+    if etag is None or not request.if_none_match.contains(etag):
+        return None
+    response = make_response("", 304)
+    response.set_etag(etag)
+    return response
+
+
+def with_etag(body, etag):
+    """Return body as a JSON response with etag. Browsers must revalidate it on every poll."""
+    response = jsonify(body)
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def page_etag(version, limit, before_id, fields):
+    """Return an ETag for a page of rows: the version of the rows and the arguments that select the page.
+    `since` is left out, so a poll that sends the ETag of its last response gets a 304 until the rows change.
+    """
+    return f"{version}-{limit}-{before_id or ''}-{'.'.join(fields)}"
+
+
+def messages_etag(limit, before_id, fields):
+    """Return an ETag for a page of messages. It changes when any message is posted, edited or deleted."""
+    return page_etag(db.table_version("messages"), limit, before_id, fields)
+
 
-def get_messages():
-    """Return an array of dicts for all the messages"""
+def get_fields(allowed):
+    """Return the fields requested with fields=a,b,c for the current Flask request.
+    Abort if one is not allowed. Returns all of the allowed fields if none are requested.
+    """
+    fields = request.values.get("fields", type=str, default="")
+    if not fields:
+        return allowed
+    fields = tuple(field.strip() for field in fields.split(","))
+    for field in fields:
+        if field not in allowed:
+            abort(400, description=f"unknown field {field}")
+    return fields
+
+
+def get_messages(limit=DEFAULT_PAGE_SIZE, before_id=None, fields=MESSAGE_FIELDS, since=None):
+    """Return up to limit messages older than before_id and newer than since, newest first.
+    message_id is the rowid and increases as messages are posted, so this is an index range scan.
+    """
     conn = db.get_db_conn()
-    return conn.execute("SELECT * FROM messages ORDER BY created DESC")
+    columns = ",".join(field for field in fields if field in MESSAGE_FIELDS) # fields are validated
+    return conn.execute(f"SELECT {columns} FROM messages WHERE message_id < ? AND message_id > ? "
+                        "ORDER BY message_id DESC LIMIT ?",
+                        (sys.maxsize if before_id is None else before_id, since or 0, limit))
 
 
 def post_message(api_key_id, message):
@@ -32,12 +104,25 @@ def post_message(api_key_id, message):
     return cur.lastrowid  # return the row inserted into images
 
 
+def get_api_token():
+    """Return the API token from an 'Authorization: Bearer' header or the api_token value, or None"""
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):].strip()
+    return request.values.get("api_token", type=str, default="") or None
+
+
 def validate_api_key_request():
-    """Validate the API_KEY and API_SECRET_KEY for the current Flask request.
+    """Validate the API_KEY and API_SECRET_KEY, or the API token from /api/token,
+    for the current Flask request.
     Abort if invalid. Return the api_key_id if valid
     :returns: api_key_id of the api_key if the api_key and api_secret_key are valid.
 
     """
+    api_token = get_api_token()
+    if api_token:
+        return apikey.validate_api_token(api_token)
+
     api_key = request.values.get("api_key", type=str, default="")
     if not api_key:
         abort(401, description="api_key not provided")
@@ -59,7 +144,26 @@ def init_app(app):
         post_message(api_key_id, request.values.get("message"))
         return "OK", 200
 
+    @app.route("/api/token", methods=["POST"])
+    def api_token():
+        """Exchange the api_key and api_secret_key for a token that authenticates
+        requests for apikey.API_TOKEN_MAX_AGE seconds without re-hashing the secret key.
+        Send it as 'Authorization: Bearer <token>' or as the api_token value.
+        """
+        api_key = request.values.get("api_key", type=str, default="")
+        api_secret_key = request.values.get("api_secret_key", type=str, default="")
+        if not api_key or not api_secret_key:
+            abort(401, description="api_key and api_secret_key must be provided")
+        return {"api_token": apikey.new_api_token(api_key, api_secret_key),
+                "expires_in": apikey.API_TOKEN_MAX_AGE}
+
     @app.route("/api/get-messages", methods=["GET"])
     def api_get_messages():
+        """Return a page of messages. Takes optional limit, before_id, since and fields (see above)."""
+        (limit, before_id, since) = get_page_args()
+        fields = get_fields(MESSAGE_FIELDS)
+        etag = messages_etag(limit, before_id, fields)
+        if response := not_modified(etag):
+            return response
         # Get the messages and expand every sqlite3.Row object into a dictionary
-        return [dict(message) for message in get_messages()]
+        return with_etag([dict(message) for message in get_messages(limit, before_id, fields, since)], etag)
@@ -19,18 +19,28 @@ STUDENTS - You do not need to make changes in this file, but you should read it.
 
 import sys
 import os
+import io
 import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import click
+from PIL import Image, ImageOps
 
 from botocore.exceptions import ClientError
 
+import flask
 from flask import request, jsonify, abort
 
 from . import db
 from . import message_controller
+from .presigned_urls import PresignedUrlCache
 from .image_validate import (
+    JPEG_MIME_TYPE,
+    MAX_IMAGE_SIZE_BYTES,
     S3_BUCKET,
+    get_range,
     make_presigned_post,
     s3_client,
     validate_image_data_length,
@@ -89,29 +99,234 @@ def create_bucket_and_apply_cors():
     s3_client.put_bucket_cors(Bucket=S3_BUCKET, CORSConfiguration=CORS_CONFIGURATION)
     click.echo(f"CORS policy applied to {S3_BUCKET}")
 
-def list_images():
-    """Return an array of dicts for all the images.
-    NOTE: For a production system, we would want to include OFFSET and
-    LIMIT to restrict to ~100 responses.
-    """
-    conn = db.get_db_conn()
-    rows = conn.execute(
-        """
+# post-image checks that the bucket exists at most every BUCKET_CHECK_SECONDS in each server
+# process. The check is also forgotten when an S3 operation fails with NoSuchBucket.
+BUCKET_CHECK_SECONDS = 300
+_bucket_checked = {'until': 0}
+
+def bucket_error(app):
+    """Return an error message if S3_BUCKET cannot be used, or None if it can."""
+    if time.time() < _bucket_checked['until']:
+        return None
+    try:
+        s3_client.head_bucket(Bucket=S3_BUCKET)
+    except ClientError as e:
+        error_code = int(e.response["Error"]["Code"])
+        if error_code == 404:
+            return f"S3 bucket '{S3_BUCKET}' does not exist. Did you create it?"
+        # Log the detailed error server-side, return generic error to user.
+        app.logger.error("S3 error occurred: %s", e, exc_info=True)
+        return "An internal S3 error has occurred"
+    _bucket_checked['until'] = time.time() + BUCKET_CHECK_SECONDS
+    return None
+
+def forget_bucket_check(e):
+    """Check the bucket again on the next post-image if e is NoSuchBucket"""
+    if isinstance(e, ClientError) and e.response["Error"]["Code"] == "NoSuchBucket":
+        _bucket_checked['until'] = 0
+
+# Fields that get-images can return. url, thumb_url, celeb and detected_text are added by api_list_images().
+IMAGE_FIELDS = ("message_id", "created", "message", "image_id", "s3key", "validated",
+                "celeb", "detected_text", "message_age_seconds", "image_age_seconds", "url", "thumb_url")
+
+# Presigned GET urls expire after an hour, so the images ETag changes every half hour
+# to make clients fetch new ones.
+URL_EXPIRES_SECONDS = 3600
+URL_REFRESH_SECONDS = 1800
+
+# presign_get() reuses a URL while it has more than URL_REFRESH_SECONDS left, so that
+# the board shows the same URL for an image and the browser can cache the image.
+# A client keeps the URLs until the ETag changes, which is at most URL_REFRESH_SECONDS later.
+PRESIGNED_URL_CACHE_SIZE = 4096
+_presigned_urls = PresignedUrlCache(URL_EXPIRES_SECONDS, URL_REFRESH_SECONDS, PRESIGNED_URL_CACHE_SIZE)
+
+def images_etag(limit, before_id, fields):
+    """Return an ETag for a page of images. It changes when any image or message changes
+    (including when the background validator finishes an image) and every URL_REFRESH_SECONDS."""
+    version = f"{db.table_version('images')}.{db.table_version('messages')}.{int(time.time() // URL_REFRESH_SECONDS)}"
+    return message_controller.page_etag(version, limit, before_id, fields)
+
+IMAGE_ROWS_SQL = """
         SELECT message_id,messages.created AS created,
-               messages.message AS message, image_id,s3key, validated,
+               messages.message AS message, image_id,s3key, thumb_s3key, validated,
                celeb_json, detected_text_json,
                strftime('%s', 'now') - strftime('%s', messages.created) AS message_age_seconds,
                strftime('%s', 'now') - strftime('%s', images.created) AS image_age_seconds
-        FROM messages
-        LEFT JOIN images
-        WHERE messages.message_id = images.linked_message_id;
+        FROM images
+        JOIN messages ON messages.message_id = images.linked_message_id
         """
+
+def list_images(limit=message_controller.DEFAULT_PAGE_SIZE, before_id=None, since=None):
+    """Return an array of dicts for up to limit validated images older than before_id
+    and newer than since, newest first, with their messages.
+    """
+    conn = db.get_db_conn()
+    rows = conn.execute(
+        IMAGE_ROWS_SQL + """
+        WHERE image_id < ? AND image_id > ? AND validated
+        ORDER BY image_id DESC
+        LIMIT ?
+        """,
+        (sys.maxsize if before_id is None else before_id, since or 0, limit),
     ).fetchall()
 
     # .fetchall() returns a list of SQLIte3 Row objects.
     # Turn this into an array of dict() objects so that they can be modified.
     return [dict(row) for row in rows]
 
+def get_image_row(image_id):
+    """Return the list_images() dict for image_id, validated or not, or None if it was deleted."""
+    conn = db.get_db_conn()
+    row = conn.execute(IMAGE_ROWS_SQL + "WHERE image_id=?", (image_id,)).fetchone()
+    return dict(row) if row else None
+
+def pending_image_ids():
+    """Return the image_ids that have not been validated."""
+    conn = db.get_db_conn()
+    return [row['image_id'] for row in conn.execute("SELECT image_id FROM images WHERE NOT validated")]
+
+################################################################
+##
+# Background validation.
+# Images are validated (and, in lab6, sent to Rekognition) by a thread pool in each
+# server process, not in get-images. post-image queues each new image.
+# A worker checks whether the client has uploaded the image to S3 yet. If it has, the worker
+# calls validate_image_table_row(), which sets validated or deletes the image, and makes a
+# thumbnail of each validated image. If it has not, the worker queues it again after
+# UPLOAD_RECHECK_SECONDS, so an image that is never uploaded does not hold a worker.
+# Images queued by a process that has since exited are picked up by get-images, which
+# looks for them at most every PENDING_RESCAN_SECONDS. `flask validate-worker` validates
+# the pending images from the command line.
+##
+
+VALIDATE_WORKERS = 4
+UPLOAD_GRACE_SECONDS = 120      # the presigned post is good for this long (see make_presigned_post)
+UPLOAD_RECHECK_SECONDS = 2      # how often to check whether a pending image has been uploaded
+PENDING_RESCAN_SECONDS = 60     # how often get-images looks for images that no process has queued
+
+# Thumbnails are stored next to the originals (images/x.jpeg -> thumbs/x.jpeg) and are
+# what the board displays. Their longest side is THUMBNAIL_PIXELS.
+THUMBNAIL_PIXELS = 480
+THUMBNAIL_QUALITY = 80
+
+_validator = {'pid': None, 'pool': None, 'queued': set(), 'rescanned': 0.0}
+_validator_lock = threading.Lock()
+
+def upload_pending(row):
+    """Return True if the row's S3 object has not been uploaded yet, but still can be.
+    After the upload grace period, a missing object is deleted by validation.
+    """
+    if (row['image_age_seconds'] or 0) >= UPLOAD_GRACE_SECONDS:
+        return False
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=row['s3key'])
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return True
+        raise
+    return False
+
+def thumbnail_s3key(s3key):
+    """Return the s3key for the thumbnail of s3key"""
+    return "thumbs/" + s3key.rsplit("/", 1)[-1]
+
+def make_thumbnail(data):
+    """Return a JPEG thumbnail of the JPEG in data, rotated as its EXIF says.
+    The thumbnail has no EXIF.
+    """
+    with Image.open(io.BytesIO(data)) as im:
+        # Let the JPEG decoder scale by up to 8x as it decodes, which is much faster than decoding it all
+        im.draft("RGB", (THUMBNAIL_PIXELS, THUMBNAIL_PIXELS))
+        thumb = ImageOps.exif_transpose(im).convert("RGB")
+    thumb.thumbnail((THUMBNAIL_PIXELS, THUMBNAIL_PIXELS))
+    buf = io.BytesIO()
+    thumb.save(buf, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return buf.getvalue()
+
+def create_thumbnail(app, row):
+    """Make the thumbnail for a validated image row, store it in S3 and record it in the database.
+    Uses the image that validation already read (row['image']) if there is one. Otherwise reads
+    the object, unless it is larger than MAX_IMAGE_SIZE_BYTES; the board then shows the original.
+    """
+    data = row.get('image')
+    if data is None:
+        try:
+            (data, size, _) = get_range(S3_BUCKET, row['s3key'], f"bytes=0-{MAX_IMAGE_SIZE_BYTES - 1}")
+        except ClientError as e:
+            app.logger.warning("image_id=%s: cannot read %s: %s", row['image_id'], row['s3key'], e)
+            return
+        if size > MAX_IMAGE_SIZE_BYTES:
+            app.logger.warning("image_id=%s: %s bytes is too large for a thumbnail", row['image_id'], size)
+            return
+    thumb_s3key = thumbnail_s3key(row['s3key'])
+    s3_client.put_object(Bucket=S3_BUCKET, Key=thumb_s3key, Body=make_thumbnail(data),
+                         ContentType=JPEG_MIME_TYPE)
+    conn = db.get_db_conn()
+    conn.execute("UPDATE images SET thumb_s3key=? WHERE image_id=?", (thumb_s3key, row['image_id']))
+    conn.commit()
+    app.logger.info("image_id=%s thumbnail %s", row['image_id'], thumb_s3key)
+
+def validate_image_id(app, image_id):
+    """Validate image_id if it has been uploaded. Runs in the validator pool."""
+    try:
+        with app.app_context():
+            row = get_image_row(image_id)
+            if row is None or row['validated']:
+                return
+            if upload_pending(row):
+                recheck = threading.Timer(UPLOAD_RECHECK_SECONDS, queue_validation, (app, image_id))
+                recheck.daemon = True
+                recheck.start()
+                return
+            row = validate_image_table_row(app, db.get_db_conn(), row)
+            if row is not None:
+                create_thumbnail(app, row)
+    except Exception as e:      # pylint: disable=broad-exception-caught
+        forget_bucket_check(e)
+        app.logger.exception("validation of image_id=%s failed", image_id)
+    finally:
+        with _validator_lock:
+            _validator['queued'].discard(image_id)
+
+def queue_validation(app, image_id):
+    """Validate image_id in the background, unless it is already queued."""
+    with _validator_lock:
+        if _validator['pid'] != os.getpid():
+            # Threads do not survive a fork, so each gunicorn worker makes its own pool
+            _validator.update(pid=os.getpid(), queued=set(),
+                              pool=ThreadPoolExecutor(max_workers=VALIDATE_WORKERS,
+                                                      thread_name_prefix="validate"))
+        if image_id in _validator['queued']:
+            return
+        _validator['queued'].add(image_id)
+        pool = _validator['pool']
+    pool.submit(validate_image_id, app, image_id)
+
+def queue_pending_images(app):
+    """Queue the images that have not been validated, at most every PENDING_RESCAN_SECONDS."""
+    with _validator_lock:
+        if time.time() - _validator['rescanned'] < PENDING_RESCAN_SECONDS:
+            return
+        _validator['rescanned'] = time.time()
+    for image_id in pending_image_ids():
+        queue_validation(app, image_id)
+
+@click.command("validate-worker")
+@click.option("--once", is_flag=True, help="validate the pending images and exit")
+@click.option("--interval", default=5, help="seconds between checks for pending images")
+@flask.cli.with_appcontext
+def validate_worker_command(once, interval):
+    """Validate pending images, checking every interval seconds."""
+    app = flask.current_app._get_current_object()   # pylint: disable=protected-access
+    while True:
+        for image_id in pending_image_ids():
+            queue_validation(app, image_id)
+        if once:
+            if _validator['pool'] is not None:
+                _validator['pool'].shutdown(wait=True)
+            return
+        time.sleep(interval)
+
 def get_image_info(image_id):
     """Return a dict for a specific image."""
     conn = db.get_db_conn()
@@ -133,12 +348,8 @@ def new_image(api_key_id, linked_message_id, s3key):
     return cur.lastrowid  # return the row inserted into images
 
 def presign_get(s3key):
-    """For an s3key, created a presigned GET URL"""
-    url = s3_client.generate_presigned_url(
-        "get_object",                                # the S3 command to sign
-        Params={"Bucket": S3_BUCKET, "Key": s3key}, # command parameters
-        ExpiresIn=3600 )                             # valid for an hour
-    return url
+    """For an s3key, return a presigned GET URL that is good for at least URL_REFRESH_SECONDS"""
+    return _presigned_urls.get(s3_client, S3_BUCKET, s3key)
 
 def init_app(app):
     """Initialize the app and register the paths."""
@@ -155,16 +366,7 @@ def init_app(app):
         """
 
         # If the bucket does not exist, tell the user
-        try:
-            s3_client.head_bucket(Bucket=S3_BUCKET)
-        except ClientError as e:
-            error_code = int(e.response["Error"]["Code"])
-            if error_code == 404:
-                error_message = f"S3 bucket '{S3_BUCKET}' does not exist. Did you create it?"
-            else:
-                # Log the detailed error server-side, return generic error to user.
-                app.logger.error("S3 error occurred: %s", e, exc_info=True)
-                error_message = "An internal S3 error has occurred"
+        if error_message := bucket_error(app):
             return {"error": error_message}
 
         # Validate the API key
@@ -190,6 +392,8 @@ def init_app(app):
         presigned_post = make_presigned_post(S3_BUCKET, s3key)
         # Finally, record the image in the database and get its image_id
         image_id = new_image(api_key_id, message_id, s3key)
+        # and validate it in the background once the client has uploaded it
+        queue_validation(app, image_id)
 
         # Return the presigned_post and the image_id to the client
         app.logger.info(
@@ -202,26 +406,26 @@ def init_app(app):
 
     @app.route("/api/get-images", methods=["GET"])
     def api_list_images():
-        """Return an array of JSON records for each image.
-        Transform the s3key into a presigned GET url.
-
-        Note: This interface returns *all* of the images. A
-        production system would return just some of them.
+        """Return an array of JSON records for a page of images.
+        Transform the s3key into a presigned GET url, and the thumbnail s3key into thumb_url.
+        thumb_url is the original if the thumbnail has not been made.
+        Takes optional limit, before_id, since and fields (see message_controller).
+        Only validated images are returned. Images are validated in the background.
         """
 
         app.logger.info("get-images")
-        conn = db.get_db_conn()
-        rows = list_images()
-
-        # Validate all of the images (delete the ones that do not validate)
-        rows = [validate_image_table_row(app, conn, row) for row in rows]
-
-        # Filter out the images that are None or that validated
-        rows = [row for row in rows if (row and row['validated'])]
+        queue_pending_images(app)
+        (limit, before_id, since) = message_controller.get_page_args()
+        fields = message_controller.get_fields(IMAGE_FIELDS)
+        etag = images_etag(limit, before_id, fields)
+        if response := message_controller.not_modified(etag):
+            return response
+        rows = list_images(limit, before_id, since)
 
         # Add a signed URL to the s3key and expand the JSON if present
         for row in rows:
             row['url'] = presign_get(row['s3key'])
+            row['thumb_url'] = presign_get(row['thumb_s3key']) if row['thumb_s3key'] else row['url']
 
             try:
                 row['celeb'] = json.loads(row['celeb_json'])
@@ -234,7 +438,9 @@ def init_app(app):
             except (KeyError, TypeError, ValueError) as e:
                 app.logger.error("detected_text_json error: %s",e)
             del row['detected_text_json']
-        return rows
+        return message_controller.with_etag(
+            [{field: row[field] for field in fields if field in row} for row in rows], etag)
 
-    # Finally, add the command to the CLI
+    # Finally, add the commands to the CLI
     app.cli.add_command(create_bucket_and_apply_cors)
+    app.cli.add_command(validate_worker_command)
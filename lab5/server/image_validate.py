@@ -7,21 +7,27 @@ For lab 6 - you will add the AI routines
 
 """
 
-import io
 import socket
 import json
+import sqlite3
 
 import boto3
-from botocore.exceptions import BotoCoreError
-from PIL import Image,UnidentifiedImageError
+from botocore.exceptions import BotoCoreError, ClientError
 
 from . import db
+from . import jpeg
 
 S3_BUCKET_PREFIX = socket.gethostname().replace(".", "-")
 S3_BUCKET_SUFFIX = "-images-bucket"
 S3_BUCKET = S3_BUCKET_PREFIX + db.get_lab_name() + S3_BUCKET_SUFFIX
 MAX_IMAGE_SIZE_BYTES = 4 * 1024 * 1024
 JPEG_MIME_TYPE = "image/jpeg"
+STRIP_EXIF = False      # set to True to remove the EXIF (including location) from uploaded images
+
+# Rekognition results are cached by image and VALIDATOR_VERSION.
+# STUDENTS - add one to VALIDATOR_VERSION whenever you change the lab6 code in
+# validate_image_table_row(), so that results from the old code are not reused.
+VALIDATOR_VERSION = 1
 
 s3_client   = boto3.client("s3")
 
@@ -33,13 +39,83 @@ def safe_get_object(bucket, s3key):
         return None
     return r['Body'].read()
 
+def get_range(bucket, s3key, byte_range):
+    """Return (bytes, object size, content hash) for an HTTP byte range of an S3 object.
+    The content hash is the object's S3 ETag. Objects uploaded with a presigned POST are
+    uploaded in a single part, so this is the MD5 of the image. It is None for an empty object.
+    """
+    try:
+        r = s3_client.get_object(Bucket=bucket, Key=s3key, Range=byte_range)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "InvalidRange":  # the object is empty
+            return (b"", 0, None)
+        raise
+    # ContentRange is "bytes first-last/size"; it is missing if S3 returned the whole object
+    size = int(r["ContentRange"].split("/")[1]) if "ContentRange" in r else r["ContentLength"]
+    return (r["Body"].read(), size, r["ETag"].strip('"'))
+
+def safe_get_jpeg_sample(bucket, s3key):
+    """Return (sample, size of the object, content hash), where sample is the head and tail of
+    an S3 object, or None if it does not exist. The sample is all that is_valid_jpeg() needs;
+    it is not a JPEG that can be decoded. Small objects are returned whole, so then len(sample) == size.
+    """
+    try:
+        (head, size, content_hash) = get_range(bucket, s3key, f"bytes=0-{jpeg.HEAD_BYTES - 1}")
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    if size <= len(head):
+        return (head, size, content_hash)
+    (tail, _, _) = get_range(bucket, s3key, f"bytes=-{jpeg.TAIL_BYTES}")
+    return (head + tail, size, content_hash)
+
+def get_cached_rekognition(app, conn, content_hash):
+    """Return (celeb_json, detected_text_json) for an image that was already
+    sent to Rekognition, or None.
+    """
+    try:
+        c = conn.cursor()
+        c.execute("SELECT celeb_json, detected_text_json FROM rekognition_cache "
+                  "WHERE content_hash=? AND code_version=?",
+                  (content_hash, str(VALIDATOR_VERSION)))
+        r = c.fetchone()
+    except sqlite3.OperationalError as e:
+        app.logger.warning("rekognition_cache: %s (run 'flask init-db' to create it)", e)
+        return None
+    return (r['celeb_json'], r['detected_text_json']) if r else None
+
+def cache_rekognition(app, conn, content_hash, celeb_json, detected_text_json):
+    """Remember the Rekognition results for an image"""
+    try:
+        c = conn.cursor()
+        c.execute("INSERT OR REPLACE INTO rekognition_cache "
+                  "(content_hash, code_version, celeb_json, detected_text_json) VALUES (?,?,?,?)",
+                  (content_hash, str(VALIDATOR_VERSION), celeb_json, detected_text_json))
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        app.logger.warning("rekognition_cache: %s (run 'flask init-db' to create it)", e)
+
 def is_valid_jpeg(buf: bytes) -> bool:
-    """Simple program to use Pillow to validate a JPEG image"""
+    """Check the JPEG structure (SOI, header segments, frame size and EOI) without decoding it.
+    buf can be the whole image or the sample from safe_get_jpeg_sample().
+    """
+    (ok, _) = jpeg.validate_jpeg(buf[:jpeg.HEAD_BYTES], buf[-jpeg.TAIL_BYTES:])
+    return ok
+
+def strip_exif_in_s3(app, bucket, s3key):
+    """Remove the EXIF from an S3 object without re-encoding it.
+    The object is only rewritten if it had EXIF.
+    """
+    data = safe_get_object(bucket, s3key)
+    if data is None:
+        return
     try:
-        img = Image.open(io.BytesIO(buf))
-        return img.format == "JPEG"
-    except (IOError,UnidentifiedImageError):
-        return False
+        stripped = jpeg.strip_exif(data)
+    except jpeg.JPEGError as e:
+        app.logger.warning("cannot strip EXIF from %s: %s", s3key, e)
+        return
+    if len(stripped) < len(data):
+        s3_client.put_object(Bucket=bucket, Key=s3key, Body=stripped, ContentType=JPEG_MIME_TYPE)
+        app.logger.info("stripped %d bytes of EXIF from %s", len(data) - len(stripped), s3key)
 
 def delete_row(app, conn, row):
     """If the image does not validate, you can use this to delete it in the database"""
@@ -62,7 +138,7 @@ def validate_image_data_length(app, image_data_length):
     # return image_data_length <= MAX_IMAGE_SIZE_BYTES
     return True
 
-# pylint: disable=too-many-locals
+# pylint: disable=too-many-locals,too-many-statements
 def validate_image_table_row(app, conn, row):
     """Given a row of images from the database query above,
     delete rows that do not have valid images."""
@@ -73,29 +149,34 @@ def validate_image_table_row(app, conn, row):
     message_id = row['message_id']
     image_id = row['image_id']
     s3key = row['s3key']
-    image = safe_get_object(S3_BUCKET, s3key)
-    if image is None:
+    # sample is just the head and tail of the JPEG, which is enough to validate it.
+    # image_size is the size of the whole object in S3.
+    found = safe_get_jpeg_sample(S3_BUCKET, s3key)
+    if found is None:
         app.logger.info("validate_images: message_id=%s image_id=%s "
                         "has no corresponding s3 object at s3key=%s",
                         message_id, image_id, s3key)
         delete_row(app, conn, row)
         return None
+    (sample, image_size, content_hash) = found
+    if len(sample) == image_size:
+        row['image'] = sample       # the whole object, which create_thumbnail() can use
 
-    app.logger.info("validate message_id=%s image_id=%s s3key=%s len(image)=%s",
-                    message_id, image_id, s3key, len(image))
+    app.logger.info("validate message_id=%s image_id=%s s3key=%s image_size=%s",
+                    message_id, image_id, s3key, image_size)
 
     #
     # Right now this just validates everything that is in S3.
     # Change this so that the JPEGs are on validated if they are valid JPEGs.
     #
     # You can check to see if it is valid with is_valid_jpeg():
-    # validated = is_valid_jpeg(data)
+    # validated = is_valid_jpeg(sample)
     #
     # For now, we will assume everything is validated
 
     #
     # == STUDENTS - START LAB5 MODIFICATIONS ==
-    # Fix this so that validated is set to True only if is_valid_jepg(image) is True
+    # Fix this so that validated is set to True only if is_valid_jepg(sample) is True
 
     validated = True
 
@@ -103,39 +184,63 @@ def validate_image_table_row(app, conn, row):
     # == STUDENTS - END LAB5 MODIFICATIONS ==
     #
 
+    # The client declared image_data_length in post-image. Check the size it actually uploaded.
+    if validated and not validate_image_data_length(app, image_size):
+        validated = False
+
+    if validated and STRIP_EXIF:
+        strip_exif_in_s3(app, S3_BUCKET, s3key)
+
     if validated and db.get_lab_name() != 'lab5':
-        celeb         = "Did not call rekognition yet."
-        detected_text = "Did not call rekognition yet."
-
-        ##### LAB6 - CELEBRITY RECOGNITION WITH AMAZON REKOGNITION #####
-        try:
-            # pylint: disable=unused-variable
-            rekognition_client = boto3.client("rekognition",
-                                              region_name=s3_client.meta.region_name)
-            # INSERT LAB6 CODE HERE
-        except BotoCoreError as e:
-            celeb = []
-            app.logger.error("rekognition error: %s",e)
-
-        ################################################################
-        ###### LAB6 - TEXT RECOGNITION WITH AMAZON REKOGNITION #####
-        try:
-            # STUDENTS - Get an A - text detection  goes here
-            # See:
-            #   - https://docs.aws.amazon.com/rekognition/latest/dg/text-detection.html
-            #   - https://docs.aws.amazon.com/rekognition/latest/dg/text-detecting-text-procedure.html          pylint: disable=line-too-long
-
-            detected_text = ""
-            # == STUDENTS - END LAB6 MODIFICATIONS ==
-
-        except BotoCoreError as e:
-            detected_text = []
-            app.logger.error("text rekognition error: %s",e)
-        ################################################################
+        # The same image is often posted more than once (the graders post the same ones every time).
+        # Reuse the Rekognition results for an image we have seen before.
+        cached = get_cached_rekognition(app, conn, content_hash) if content_hash else None
+        if cached is not None:
+            app.logger.info("image_id=%s: using cached rekognition results for %s", image_id, content_hash)
+            (celeb_json, detected_text_json) = cached
+        else:
+            rekognition_ok = True
+            # image is the whole JPEG, for Image={"Bytes": image}.
+            # Rekognition can also read it from S3 itself: Image={"S3Object": {"Bucket": S3_BUCKET, "Name": s3key}}
+            image = sample if len(sample) == image_size else safe_get_object(S3_BUCKET, s3key) # pylint: disable=unused-variable
+            row['image'] = image
+            celeb         = "Did not call rekognition yet."
+            detected_text = "Did not call rekognition yet."
+
+            ##### LAB6 - CELEBRITY RECOGNITION WITH AMAZON REKOGNITION #####
+            try:
+                # pylint: disable=unused-variable
+                rekognition_client = boto3.client("rekognition",
+                                                  region_name=s3_client.meta.region_name)
+                # INSERT LAB6 CODE HERE
+            except (BotoCoreError, ClientError) as e:
+                celeb = []
+                rekognition_ok = False
+                app.logger.error("rekognition error: %s",e)
+
+            ################################################################
+            ###### LAB6 - TEXT RECOGNITION WITH AMAZON REKOGNITION #####
+            try:
+                # STUDENTS - Get an A - text detection  goes here
+                # See:
+                #   - https://docs.aws.amazon.com/rekognition/latest/dg/text-detection.html
+                #   - https://docs.aws.amazon.com/rekognition/latest/dg/text-detecting-text-procedure.html          pylint: disable=line-too-long
+
+                detected_text = ""
+                # == STUDENTS - END LAB6 MODIFICATIONS ==
+
+            except (BotoCoreError, ClientError) as e:
+                detected_text = []
+                rekognition_ok = False
+                app.logger.error("text rekognition error: %s",e)
+            ################################################################
+
+            celeb_json         = json.dumps(celeb,default=str)
+            detected_text_json = json.dumps(detected_text,default=str)
+            if rekognition_ok and content_hash:
+                cache_rekognition(app, conn, content_hash, celeb_json, detected_text_json)
 
         # Update the database
-        celeb_json         = json.dumps(celeb,default=str)
-        detected_text_json = json.dumps(detected_text,default=str)
         c = conn.cursor()
         c.execute("UPDATE images set celeb_json=?,detected_text_json=? where image_id=?",
                   (celeb_json,detected_text_json,image_id))
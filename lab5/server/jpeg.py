@@ -0,0 +1 @@
+../../etc/e11-cli/e11/e11core/jpeg.py
\ No newline at end of file
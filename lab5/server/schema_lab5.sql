@@ -6,6 +6,7 @@ DROP TABLE IF EXISTS images;
 CREATE TABLE images (
        image_id INTEGER PRIMARY KEY AUTOINCREMENT,
        s3key text(1023) UNIQUE NOT NULL,
+       thumb_s3key text(1023),
        linked_message_id INTEGER,
        created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
        created_by INTEGER NOT NULL,
@@ -21,3 +22,5 @@ CREATE TABLE images (
 );
 
 CREATE UNIQUE INDEX s3key_index ON images(s3key);
+CREATE INDEX linked_message_id_index ON images(linked_message_id);
+CREATE INDEX validated_index ON images(validated);
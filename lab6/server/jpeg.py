@@ -0,0 +1 @@
+../../lab5/server/jpeg.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../lab5/server/presigned_urls.py
\ No newline at end of file
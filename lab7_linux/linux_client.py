@@ -15,9 +15,30 @@ COURSE_KEY = ""                 # enter your course key here
 TIMEOUT = 30
 ENDPOINT = "https://leaderboard.csci-e-11.org/"
 MAX_SLEEP = 5                   # maximum number of seconds to sleep
+WATCH_SECONDS = 20              # longest that the server holds an api/watch request
 
 URL_REGISTER = ENDPOINT + "api/register"
 URL_UPDATE = ENDPOINT + "api/update"
+URL_WATCH = ENDPOINT + "api/watch"
+
+def apply_update(leaders, data):
+    """Apply a response from api/update to leaders, a dictionary of leaders by name.
+    The response is either the whole 'leaderboard', or the leaders that 'changed' and
+    the names that 'expired' since the version we sent, or 'unchanged'.
+    """
+    if 'leaderboard' in data:
+        leaders.clear()
+        leaders.update({leader['name']:leader for leader in data['leaderboard']})
+    for leader in data.get('changed', []):
+        leaders[leader['name']] = leader
+    for expired in data.get('expired', []):
+        leaders.pop(expired, None)
+    # Rows may be deleted before we hear that they expired
+    now = int(time.time())
+    for leader in list(leaders.values()):
+        if int(leader.get('expires', now + 1)) <= now:
+            del leaders[leader['name']]
+    return data.get('version')
 
 if __name__=='__main__':
     import argparse
@@ -30,6 +51,8 @@ if __name__=='__main__':
                         help='how many seconds to run the leaderboard')
     parser.add_argument("--method",default='GET',help='method to use')
     parser.add_argument("--user_agent")
+    parser.add_argument('--watch',action='store_true',
+                        help='instead of polling, wait for the server to report changes')
     parser.add_argument('endpoint',default=ENDPOINT,nargs='?')
     args = parser.parse_args()
     headers = {}
@@ -53,9 +76,23 @@ if __name__=='__main__':
     print(f"name={name} opaque={opaque} type={type(opaque)}" )
 
     t0 = time.time()
+    leaders = {}
+    version = None
     while True:
-        response = requests.post(URL_UPDATE,
-                                 data={'opaque': opaque},
+        time_till_timeout = (t0 + args.seconds) - time.time()
+        post_data = {'opaque': opaque}
+        if version is not None:
+            post_data['since'] = version
+        # In watch mode, the server holds the request until the leaderboard changes.
+        # The request is also our heartbeat, so we only need to sleep if the server
+        # did not hold it (servers on Lambda answer at once).
+        url = URL_UPDATE
+        if args.watch and version is not None:
+            url = URL_WATCH
+            post_data['timeout'] = max(1, min(WATCH_SECONDS, int(time_till_timeout)))
+        sent = time.time()
+        response = requests.post(url,
+                                 data=post_data,
                                  headers = headers,
                                  timeout = TIMEOUT )
         if args.debug:
@@ -64,8 +101,17 @@ if __name__=='__main__':
         try:
             data = response.json()
         except json.decoder.JSONDecodeError:
-            print(f"Invalid JSON from {URL_UPDATE}: {response.text}")
+            print(f"Invalid JSON from {url}: {response.text}")
             sys.exit(1)
+        since = version
+        version = apply_update(leaders, data)
+        # A watch that comes back early without a new version was not held
+        if url == URL_WATCH and version == since and time.time() - sent < post_data['timeout']:
+            time.sleep( max(0, min(MAX_SLEEP, (t0 + args.seconds) - time.time())) )
+        if args.watch and data.get('unchanged'):
+            if (t0 + args.seconds) <= time.time():
+                break
+            continue
         print("Message: ",data['message'])
         print("Leaderboard:")
         now = int(time.time())
@@ -75,7 +121,7 @@ if __name__=='__main__':
                 print("Active Leaders:")
             else:
                 print("Inactive:")
-            for leader in data['leaderboard']:
+            for leader in sorted(leaders.values(), key=lambda leader:leader['first_seen']):
                 if leader.get('active',False) == active:
                     me  = 'me -->' if leader['name']==name else ''
                     age = now - int(leader['first_seen'])
@@ -90,5 +136,6 @@ if __name__=='__main__':
         print("time_till_timeout=",time_till_timeout)
         if time_till_timeout <= 0:
             break
-        time.sleep( min(MAX_SLEEP, time_till_timeout) )
+        if not args.watch:
+            time.sleep( min(MAX_SLEEP, time_till_timeout) )
     print("Timeout expired.")
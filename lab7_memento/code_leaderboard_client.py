@@ -67,15 +67,30 @@ def run_leaderboard():
     (name,opaque) = register()
     run = 0
     count = 0
+    leaders = {}                # by name
+    version = None
     while True:
         run += 1
         print("\nrun:",run)
-        response = requests.post(URL_UPDATE, data={"opaque": opaque}, timeout=TIMEOUT)
+        post_data = {"opaque": opaque}
+        if version is not None:
+            post_data["since"] = version
+        response = requests.post(URL_UPDATE, data=post_data, timeout=TIMEOUT)
         data = response.json()
-        # The leaderboard API returns an array of leaders
-        # Check it to see if it is active.
+        # The first response has the whole "leaderboard". After that, we send the
+        # version we have and only get the leaders that "changed" or "expired".
+        if "leaderboard" in data:
+            leaders = {}
+            for row in data["leaderboard"]:
+                leaders[row["name"]] = row
+        for row in data.get("changed", []):
+            leaders[row["name"]] = row
+        for expired in data.get("expired", []):
+            leaders.pop(expired, None)
+        version = data.get("version")
+        # Check each leader to see if it is active.
         # Then check to see if it is this particular MEMENTO!
-        for row in data["leaderboard"]:
+        for row in leaders.values():
             if row.get("active", False):
                 if row["name"] == name:
                     me = "me -->"
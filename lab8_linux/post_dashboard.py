@@ -1,62 +1,110 @@
 """
-Python 3.13 code that posts an image to the dashboard.
+Python 3.13 code that posts images to the dashboard.
 Taken from e11/main.py.
+
+Give it JPEG files, or directories of them. It gets presigned posts for a batch of images
+with one post-images call, then uploads them to S3 a few at a time. Each upload thread
+keeps its own requests.Session.
 """
 
 
 import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import requests
 
+from multipart import MultipartEncoder
+
 TIMEOUT = 10
+# This program runs without the e11 package, so these copy e11core.constants.API_ENDPOINT
+# and e11core.constants.MAX_PRESIGNED_POSTS. Keep them in sync.
+ENDPOINT = "https://csci-e-11.org/api/v1"
+MAX_PRESIGNED_POSTS = 20        # the most that post-images returns
+UPLOAD_ATTEMPTS = 3
+
+# requests does not say that a Session is thread-safe, so each upload thread has its own.
+sessions = threading.local()
+
+def get_session():
+    """Return this thread's requests.Session"""
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+
+def upload(presigned_data, imagefile):
+    """Upload imagefile with a presigned post, trying again if the connection or S3 fails.
+    Return the status code of the last attempt, or None if it could not connect."""
+    session = get_session()
+    status = None
+    for attempt in range(UPLOAD_ATTEMPTS):
+        time.sleep(attempt)
+        try:
+            # The file must come after the fields, and is streamed from disk.
+            with imagefile.open('rb') as f:
+                body = MultipartEncoder(presigned_data['fields'], 'file', str(imagefile), f, 'image/jpeg')
+                r = session.post(presigned_data['url'], data=body, headers=body.headers(), timeout=TIMEOUT)
+        except requests.RequestException as e:
+            print(f"{imagefile}: {e}")
+            continue
+        status = r.status_code
+        if status < 500:
+            break
+    return status
 
 if __name__=='__main__':
     import argparse
     parser = argparse.ArgumentParser(description="Test program for leaderboard",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--debug',action='store_true')
+    parser.add_argument('--jobs',type=int,default=4,help='number of images to upload at once')
     parser.add_argument('email',help='Enter your CSCI-E-11 email')
     parser.add_argument('course_key',help='Your course_key')
-    parser.add_argument("imagefile",type=Path)
+    parser.add_argument("imagefiles",type=Path,nargs='+',help='JPEG files or directories of them')
     args = parser.parse_args()
 
-    if not args.imagefile.exists():
-        print(f"{args.imagefile} does not exist")
-        sys.exit(1)
-    if not str(args.imagefile).endswith(".jpeg"):
-        print(f"{args.imagefile} does end with .jpeg")
-        sys.exit(1)
-    print(f"uploading {args.imagefile}...")
+    imagefiles = []
+    for path in args.imagefiles:
+        if path.is_dir():
+            imagefiles.extend(sorted(path.glob("*.jpeg")))
+            continue
+        if not path.exists():
+            print(f"{path} does not exist")
+            sys.exit(1)
+        if not str(path).endswith(".jpeg"):
+            print(f"{path} does end with .jpeg")
+            sys.exit(1)
+        imagefiles.append(path)
+    print(f"uploading {len(imagefiles)} images...")
     auth = {"email":args.email,
             "course_key":args.course_key}
 
     print(auth)
-    r = requests.post("https://csci-e-11.org/api/v1",
-                      json={'action':'post-image', 'auth':auth},
-                      timeout = TIMEOUT )
-    result = r.json()
-    print(result)
-    if result.get('error'):
-        print("Cannot continue.")
+    failures = 0
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        for start in range(0, len(imagefiles), MAX_PRESIGNED_POSTS):
+            batch = imagefiles[start:start + MAX_PRESIGNED_POSTS]
+            r = session.post(ENDPOINT,
+                             json={'action':'post-images', 'auth':auth, 'count':len(batch)},
+                             timeout = TIMEOUT )
+            if r.status_code != 200:
+                print("post-images failed:", r.status_code, r.text)
+                print("Cannot continue.")
+                sys.exit(1)
+            result = r.json()
+            if result.get('error'):
+                print(result)
+                print("Cannot continue.")
+                sys.exit(1)
+            futures = {pool.submit(upload, presigned_data, imagefile): imagefile
+                       for (presigned_data, imagefile) in zip(result['presigned_posts'], batch)}
+            for future in as_completed(futures):
+                status = future.result()
+                print(f"Posted {futures[future]} to S3. Result: ", status)
+                if status is None or status >= 400:
+                    failures += 1
+    print(f"{len(imagefiles) - failures} of {len(imagefiles)} posted")
+    if failures:
         sys.exit(1)
-    presigned_data= result['presigned_post']
-    url = presigned_data['url']
-    fields = presigned_data['fields']
-    files = []
-
-    # Construct the multipart form data
-    # The 'file' MUST be the last element in the dictionary/list
-    for key, value in fields.items():
-        files.append((key, (None, value)))
-
-    # Add the actual file data
-    files.append(('file', (str(args.imagefile), args.imagefile.read_bytes())))
-
-    # Perform the POST to S3
-    # Note: No 'headers=headers' here; requests handles the Content-Type for multipart
-    r = requests.post(url, files=files, timeout=TIMEOUT)
-
-    print("Posted to S3. Result: ", r.status_code)
-    if r.status_code >= 400:
-        print("Error:", r.text)
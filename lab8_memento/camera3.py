@@ -20,6 +20,7 @@ import os
 import ssl
 import sys
 import re
+import time
 
 import adafruit_ntp
 import adafruit_pycamera
@@ -29,6 +30,8 @@ import socketpool
 import wifi
 from displayio import Bitmap
 
+from multipart import MultipartEncoder
+
 # 1. SETUP WIFI AND NTP
 
 SSID = os.getenv("CIRCUITPY_WIFI_SSID")
@@ -89,43 +92,11 @@ def presigned_post_to_s3(presigned_data, jpeg_to_post):
     print("url:",url)
     print("fields:",fields)
 
-    # now upload to S3 using the presigned post and a hand-drafted file POST
-    boundary = '----FormBoundary'
-    eboundary = boundary.encode()
-    eol  = b'\r\n'
-    body = bytearray()
-
-    def add_part(name, value):
-        body.extend(b"--" + eboundary + eol)
-        body.extend((f'Content-Disposition: form-data; name="{name}"').encode("utf-8"))
-        body.extend(eol + eol)
-        body.extend(str(value).encode("utf-8"))
-        body.extend(eol)
-
-
-    for k, v in fields.items():
-        add_part(k, v)
-
-    # Add the file itself
-    body.extend(b'--' + eboundary + eol)
-    body.extend(b'Content-Disposition: form-data; name="file"; filename="image.jpg"' + eol)
-    body.extend(b'Content-type: image/jpeg' + eol*2)
-    body.extend(bytes(jpeg_to_post))
-    body.extend(eol)
-
-    # *** required closing boundary ***
-    body.extend(b"--" + eboundary + b"--" + eol)
-
-
-    # prepare the headers
-    headers = {
-        'Content-Type': 'multipart/form-data; boundary=' + boundary,
-        'Content-Length': str(len(body))
-    }
-
-    # build the multipart form
-
-    r = requests.post(url, data=body, headers=headers, timeout=10)
+    # now upload to S3 using the presigned post. adafruit_requests sends a file-like
+    # body 36 bytes at a time, but bytes in one piece. jpeg_to_post is already in
+    # memory, so we build the whole body once; that costs one more copy of the image.
+    body = MultipartEncoder(fields, 'file', 'image.jpg', jpeg_to_post, 'image/jpeg')
+    r = requests.post(url, data=body.read(), headers=body.headers(), timeout=10)
 
     print("Status Code:", r.status_code)
     if r.status_code >= 400:
@@ -148,17 +119,41 @@ def post_to_dashboard(jpeg_to_post):
     pycam.tone(1100,0.1)
     return
 
+# The imageboard verifies API_KEY and API_SECRET_KEY once and gives us a token
+# that is cheap for it to check. We use it until shortly before it expires.
+api_token = {'token': None, 'expires': 0}
+
+def get_api_token(imageboard):
+    """Return a token for the imageboard, getting a new one if needed"""
+    if api_token['token'] and time.monotonic() < api_token['expires']:
+        return api_token['token']
+    r = requests.post(imageboard + "/api/token",
+                      data={'api_key': API_KEY, 'api_secret_key': API_SECRET_KEY},
+                      timeout=10)
+    if r.status_code//100 !=2:
+        print("api/token failed. r=",r," text==",r.text)
+        return None
+    result = r.json()
+    api_token['token'] = result['api_token']
+    api_token['expires'] = time.monotonic() + result['expires_in'] - 60
+    return api_token['token']
+
 def post_to_imageboard(jpeg_to_post):
     """send the jpeg to the student imageboard"""
     pycam.tone(2000,0.1)
-    url = f"https://{smash_email(EMAIL)}-{LAB}.csci-e-11.org/api/post-image"
-    form_data = { 'api_key': API_KEY,
-                  'api_secret_key' : API_SECRET_KEY,
-                  'message' : "sent from MEMENTO"}
+    imageboard = f"https://{smash_email(EMAIL)}-{LAB}.csci-e-11.org"
+    token = get_api_token(imageboard)
+    if not token:
+        return
+    url = imageboard + "/api/post-image"
+    form_data = { 'message' : "sent from MEMENTO"}
     print("url",url)
     r = requests.post(url,
                       data=form_data,
+                      headers={'Authorization': 'Bearer ' + token},
                       timeout=10)
+    if r.status_code == 401:
+        api_token['token'] = None   # get a new token next time
     if r.status_code//100 !=2:
         print("post to imageboard failed. r=",r," text==",r.text)
         return
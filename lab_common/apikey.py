@@ -14,16 +14,62 @@ STUDENTS - You do not need to modify this file.
 
 import os
 import re
-from hashlib import pbkdf2_hmac
+import hmac
+import functools
+import threading
+from collections import OrderedDict
+from hashlib import pbkdf2_hmac, sha256
 
 import click
 import flask
+from itsdangerous import TimestampSigner, BadSignature, SignatureExpired
 from . import db                # pylint: disable=no-name-in-module
 
 # APIKEY Management Tools
 
 ALGORITHM = "sha256"
 ITERATIONS = 10000
+API_TOKEN_SALT = "api-token"
+API_TOKEN_MAX_AGE = 3600        # seconds that a token from new_api_token() is valid
+API_TOKEN_SECRET_FILE = "api_token_secret"  # in the instance folder; used while SECRET_KEY is "dev"
+DEV_SECRET_KEY = "dev"
+
+# Verified credentials, so that repeat requests skip PBKDF2.
+# api_key -> (api_key_id, api_secret_key_hash, keyed digest of the api_secret_key)
+# An entry is only used while api_secret_key_hash is still the one in the database,
+# so deleting or rotating a key invalidates it. The digest key never leaves this process.
+VERIFIED_CACHE_SIZE = 1024
+_verified = OrderedDict()
+_verified_lock = threading.Lock()
+_VERIFIED_DIGEST_KEY = os.urandom(32)
+
+
+def secret_digest(api_secret_key):
+    """Return a fast keyed digest of api_secret_key for the verified cache"""
+    return hmac.new(_VERIFIED_DIGEST_KEY, api_secret_key.encode("utf-8"), sha256).digest()
+
+
+def check_verified(api_key, api_key_id, api_secret_key_hash, api_secret_key):
+    """Return True if api_key was verified with this api_secret_key and its stored hash is unchanged"""
+    with _verified_lock:
+        entry = _verified.get(api_key)
+        if entry is None:
+            return False
+        if entry[:2] != (api_key_id, api_secret_key_hash):
+            del _verified[api_key]  # the key was deleted and re-created, or rotated
+            return False
+        _verified.move_to_end(api_key)
+    return hmac.compare_digest(entry[2], secret_digest(api_secret_key))
+
+
+def remember_verified(api_key, api_key_id, api_secret_key_hash, api_secret_key):
+    """Remember that api_secret_key is valid for api_key, evicting the least recently used entry if full"""
+    entry = (api_key_id, api_secret_key_hash, secret_digest(api_secret_key))
+    with _verified_lock:
+        _verified[api_key] = entry
+        _verified.move_to_end(api_key)
+        while len(_verified) > VERIFIED_CACHE_SIZE:
+            _verified.popitem(last=False)
 
 
 def lab_number():
@@ -63,25 +109,32 @@ def new_apikey():
     return (api_key, api_secret_key)
 
 
+def get_api_key_hash(api_key):
+    """Return (api_key_id, api_secret_key_hash) for api_key. Abort if there is no such key."""
+    conn = db.get_db_conn()
+    rows = conn.execute(
+        "select api_key_id, api_secret_key_hash from api_keys where api_key=? ",
+        (api_key,),
+    ).fetchall()
+    if len(rows) != 1:
+        flask.abort(401, description="Unknown API_KEY")
+    return (rows[0]["api_key_id"], rows[0]["api_secret_key_hash"])
+
+
 def validate_api_key(api_key, api_secret_key):
     """Given an api_key and the secret key:
     1. Pull the api_secret_key's hash and hash parameters from the database.
     2. Hash the provided api_secret_key.
     3. See if the two hashes match.
+    Steps 2 and 3 are skipped if this api_secret_key was already verified against the same hash.
     :param api_key: the key provided by the user as a string
     :param api_secret_key:  the secret key provided by the user as a string
     :returns: api_key_id of the api_key if the api_key and api_secret_key are valid.
     """
-    conn = db.get_db_conn()
-    cur = conn.cursor()
-
     # Get the hashed password and stored salt and iteration count
-    rows = cur.execute(
-        "select api_key_id, api_secret_key_hash from api_keys where api_key=? ",
-        (api_key,),
-    ).fetchall()
-    if len(rows) != 1:
-        flask.abort(401, description="Unknown API_KEY")
+    (api_key_id, api_secret_key_hash) = get_api_key_hash(api_key)
+    if check_verified(api_key, api_key_id, api_secret_key_hash, api_secret_key):
+        return api_key_id
 
     # Get the hash parameters for the stored hash
     # pylint: disable=line-too-long
@@ -91,7 +144,7 @@ def validate_api_key(api_key, api_secret_key):
         stored_iterations_dec,
         stored_salt_hex,
         stored_hash_hex,
-    ) = rows[0]["api_secret_key_hash"].split(":")
+    ) = api_secret_key_hash.split(":")
     assert check == "pbkdf2"
     stored_iterations = int(stored_iterations_dec)  # turn to integer
     stored_salt = bytes.fromhex(stored_salt_hex)
@@ -103,7 +156,69 @@ def validate_api_key(api_key, api_secret_key):
     )
     if hashed.hex() != stored_hash_hex:
         flask.abort(401, description="Invalid API_SECRET_KEY")
-    return rows[0]["api_key_id"]
+    remember_verified(api_key, api_key_id, api_secret_key_hash, api_secret_key)
+    return api_key_id
+
+
+@functools.lru_cache(maxsize=None)
+def instance_secret(instance_path):
+    """Return the random secret in the instance folder, creating it the first time.
+    All of the server's processes read the same file."""
+    path = os.path.join(instance_path, API_TOKEN_SECRET_FILE)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}"
+        with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmp, path)  # fails if another process created it first
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(tmp)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def api_token_server_secret():
+    """Return the server-side secret for API tokens: the app's SECRET_KEY, or a random
+    secret in the instance folder while SECRET_KEY is the development default."""
+    app = flask.current_app
+    secret_key = app.config.get("SECRET_KEY")
+    if not secret_key or secret_key == DEV_SECRET_KEY:
+        return instance_secret(app.instance_path)
+    return secret_key.encode("utf-8") if isinstance(secret_key, str) else secret_key
+
+
+def api_token_signer(api_secret_key_hash):
+    """Return the signer for API tokens. It is keyed with the server secret and the stored
+    hash of the secret key. The hash alone (for example, from a copy of the database) is
+    not enough to make a token, and rotating or deleting the key invalidates its tokens."""
+    signing_key = hmac.new(api_token_server_secret(), api_secret_key_hash.encode("utf-8"), sha256).digest()
+    return TimestampSigner(signing_key, salt=API_TOKEN_SALT)
+
+
+def new_api_token(api_key, api_secret_key):
+    """Verify api_key and api_secret_key and return a signed token for api_key
+    that validate_api_token() accepts for API_TOKEN_MAX_AGE seconds."""
+    validate_api_key(api_key, api_secret_key)
+    (_, api_secret_key_hash) = get_api_key_hash(api_key)
+    return api_token_signer(api_secret_key_hash).sign(api_key).decode("utf-8")
+
+
+def validate_api_token(api_token):
+    """Given a token from new_api_token(), check its signature and age with a single HMAC.
+    :returns: api_key_id of the token's api_key if the token is valid.
+    """
+    # The token is api_key.timestamp.signature
+    api_key = api_token.rsplit(".", 2)[0]
+    (api_key_id, api_secret_key_hash) = get_api_key_hash(api_key)
+    try:
+        api_token_signer(api_secret_key_hash).unsign(api_token, max_age=API_TOKEN_MAX_AGE)
+    except SignatureExpired:
+        flask.abort(401, description="API token expired")
+    except BadSignature:
+        flask.abort(401, description="Invalid API token")
+    return api_key_id
 
 
 @click.command("new-apikey")
@@ -18,6 +18,7 @@ import re
 import os
 import sqlite3
 import glob
+import threading
 from datetime import datetime
 from os.path import join
 
@@ -27,6 +28,18 @@ from flask import current_app, g
 
 DBFILE_NAME = "message_board.db"
 
+# Each gunicorn worker (and each thread within it) keeps its connections open between requests.
+# WAL lets readers and a writer in different workers run at the same time. busy_timeout makes
+# a writer wait for the lock instead of failing with "database is locked".
+BUSY_TIMEOUT_MS = 5000
+CACHED_STATEMENTS = 256         # prepared statements kept per connection
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+]
+_worker = threading.local()     # connections by database path, for this process and thread
+
 #
 # This allows sqlite3 to directly handle Python datetime object
 # It runs when db.py is imported
@@ -48,27 +61,62 @@ def get_lab_name():
         return m.group(1)
     return ""                   # no lab name
 
-def get_db_conn():
-    """Return either a new database connection or the cached
-    per-instance connection.
+def connect(database):
+    """Return a new connection to database with the pragmas set.
 
     Note that the connection is modified so all records are returned
     as dictionaries, rather than tuples.
     """
+    conn = sqlite3.connect(
+        database,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_worker_conn(database):
+    """Return this worker's connection to database, opening it the first time.
+    Connections are not shared across a fork, so a new process opens its own.
+    """
+    if getattr(_worker, "pid", None) != os.getpid():
+        _worker.pid = os.getpid()
+        _worker.conns = {}
+    if database not in _worker.conns:
+        _worker.conns[database] = connect(database)
+    return _worker.conns[database]
+
+
+def close_worker_conns():
+    """Close this worker's connections (e.g. before the database file is deleted)."""
+    if getattr(_worker, "pid", None) == os.getpid():
+        for conn in _worker.conns.values():
+            conn.close()
+    _worker.pid = None
+    _worker.conns = {}
+
+
+def get_db_conn():
+    """Return the connection for this request, which is the worker's
+    connection to the app's database.
+    """
     if "db" not in g:
-        g.conn = sqlite3.connect(
-            current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.conn.row_factory = sqlite3.Row
-    return g.conn
+        g.db = get_worker_conn(current_app.config["DATABASE"])
+    return g.db
 
 
 # pylint: disable=unused-argument
 def close_db(e=None):
-    """Close the database connection if one was set through g.db=<foo>"""
+    """Finish with the request's connection. The connection stays open for the
+    next request, so roll back anything the request did not commit.
+    """
     conn = g.pop("db", None)
-    if conn is not None:
-        conn.close()
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
 
 
 def init_db():
@@ -81,6 +129,7 @@ def init_db():
         with open(fname, "r", encoding="utf8") as f:
             conn.executescript(f.read())
             conn.commit()
+    upgrade_conn(conn)
 
 
 @click.command("init-db")
@@ -116,10 +165,68 @@ def dump_db_command():
 def wipe_db_command():
     """Delete the database file. Note that we have to guess where the 'instance' is"""
     dbfile_path = join(current_app.instance_path, DBFILE_NAME)
+    close_worker_conns()
+    # In WAL mode, sqlite3 also keeps a write-ahead log and a shared-memory index
+    for path in (dbfile_path, dbfile_path + "-wal", dbfile_path + "-shm"):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+# Columns that were added to a table after the lab was released, as (table, column, type).
+# init-db would erase a database's data, so upgrade_db() adds them to an existing one instead.
+ADDED_COLUMNS = [
+    ("images", "thumb_s3key", "text(1023)"),
+]
+
+# Triggers count every insert, update and delete in these tables in table_versions,
+# so that an ETag changes when any worker changes a row, without reading the table.
+VERSIONED_TABLES = ("messages", "images")
+
+
+def upgrade_conn(conn):
+    """Add the ADDED_COLUMNS that the existing tables are missing, and the table_versions
+    triggers for the existing VERSIONED_TABLES. Safe to repeat.
+    """
+    # Every gunicorn worker runs this as it starts; the write lock makes them take turns
+    conn.execute("BEGIN IMMEDIATE")
+    tables = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    # Note we can't prepare the table and column names in the statements below
+    for (table, column, column_type) in ADDED_COLUMNS:
+        columns = [row["name"] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if table in tables and column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE TABLE IF NOT EXISTS table_versions "
+                 "(table_name text PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    for table in VERSIONED_TABLES:
+        if table not in tables:
+            continue
+        # Start at the current time, so a database made after wipe-db does not reuse old versions
+        conn.execute("INSERT OR IGNORE INTO table_versions (table_name, version) "
+                     "VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table} "
+                         f"BEGIN UPDATE table_versions SET version = version + 1 WHERE table_name = '{table}'; END")
+    conn.commit()
+
+
+def upgrade_db(database):
+    """Bring an existing database up to date with upgrade_conn()."""
+    if not os.path.exists(database):
+        return
+    conn = connect(database)
     try:
-        os.unlink(dbfile_path)
-    except FileNotFoundError:
-        pass
+        upgrade_conn(conn)
+    finally:
+        conn.close()
+
+
+def table_version(table):
+    """Return a number that changes whenever a row of table (one of VERSIONED_TABLES)
+    is added, changed or deleted."""
+    row = get_db_conn().execute("SELECT version FROM table_versions WHERE table_name=?", (table,)).fetchone()
+    return row["version"] if row else 0
 
 
 def init_app(app):
@@ -127,6 +234,9 @@ def init_app(app):
     # always call close_db when connection is finished.
     app.teardown_appcontext(close_db)
 
+    # bring a database made by an earlier version of the lab up to date
+    upgrade_db(app.config["DATABASE"])
+
     # Register CLI commands
     app.cli.add_command(init_db_command)
     app.cli.add_command(dump_db_command)
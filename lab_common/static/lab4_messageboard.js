@@ -2,6 +2,28 @@
  * This version shows all uploaded movies and requires no authentication.
  */
 const REFRESH_RATE = 5000;
+const MAX_MESSAGES = 100; // the server's default page size
+
+// What we have. We send the ETag back with If-None-Match, so an idle board costs a 304,
+// and ask only for the messages after the newest one we have (since=). The ETag does not
+// depend on since=, so the ETag of one poll is good for the next.
+let messages = [];
+let messagesEtag = null;
+
+function fetch_messages(url) {
+    const headers = messagesEtag ? { "If-None-Match": messagesEtag } : {};
+    return fetch(url, { method: "GET", headers }).then((r) => {
+        if (r.status === 304) {
+            return null;
+        }
+        if (!r.ok) {
+            return Promise.reject(new Error(`${r.status} ${r.statusText}`));
+        }
+        messagesEtag = r.headers.get("ETag");
+        return r.json();
+    });
+}
+
 function show_messages() {
     console.log("lab4 show_messages");
     const container = document.querySelector("#message-container");
@@ -9,24 +31,28 @@ function show_messages() {
         throw new Error("no #message-container");
     }
 
-    fetch("api/get-messages", { method: "GET" })
-        .then((r) => {
-            if (!r.ok) {
-                container.textContent = `Error: ${r.status} ${r.statusText}`;
-                return Promise.reject(new Error(r.statusText));
+    const since = messages.length ? messages[0].message_id : 0;
+    fetch_messages(`api/get-messages?since=${since}`)
+        .then((obj) => {
+            if (obj === null || (since && !obj.length)) {
+                return null; // nothing new
             }
-            return r.json();
+            return obj.concat(messages).slice(0, MAX_MESSAGES);
         })
         .then((obj) => {
+            if (obj === null) {
+                return;
+            }
+            messages = obj;
             // Clear or update the Tabulator table
             let table = Tabulator.findTable("#message-table")[0];
             if (table) {
                 // Table exists: update its data
-                table.replaceData(obj);
+                table.replaceData(messages);
             } else {
                 // Table doesn't exist: create it
                 table = new Tabulator("#message-table", {
-                    data: obj,
+                    data: messages,
                     layout: "fitColumns",
                     columns: [
                         { title: "Posted", field: "created" },
@@ -37,7 +63,7 @@ function show_messages() {
             }
         })
         .catch((error) => {
-            container.textContent = `Uncaught error: ${error.message}`;
+            container.textContent = `Error: ${error.message}`;
             console.error(error);
         });
 }
@@ -40,20 +40,33 @@ function prettyJsonFormatter(cell) {
 }
 
 
-/** lab5 and lab6 show_images() function. */
-/** lab5 and lab6 show_images() function. */
+/** lab5 and lab6 show_images() function.
+ * We send the ETag of the last response back with If-None-Match, so an idle board costs a 304.
+ * We always get the whole list rather than asking for since=: images are validated in the
+ * background, so an older image can appear (or be deleted) after a newer one.
+ */
+let imagesEtag = null;
+
 function show_images() {
     console.log("lab5 show_images");
 
-    fetch("api/get-images", { method: "GET" })
+    const headers = imagesEtag ? { "If-None-Match": imagesEtag } : {};
+    fetch("api/get-images", { method: "GET", headers })
         .then((r) => {
+            if (r.status === 304) {
+                return null;
+            }
             if (!r.ok) {
                 setText("#message-container", `Error: ${r.status} ${r.statusText}`);
                 return Promise.reject(new Error(r.statusText));
             }
+            imagesEtag = r.headers.get("ETag");
             return r.json();
         })
         .then((obj) => {
+            if (obj === null) {
+                return; // not modified
+            }
             // Destroy existing table so we can change column definitions
             const existing = Tabulator.findTable("#message-table")[0];
             if (existing) {
@@ -133,13 +146,16 @@ function show_images() {
                 });
             }
 
+            // The table shows the thumbnail; the popup shows the original.
             columns.push({
                 title: "Photo",
-                field: "url",
+                field: "thumb_url",
                 formatter: (cell) => {
-                    const url = cell.getValue();
-                    if (!url) return "n/a";
-                    return `<img src="${url}" alt="Image" style="width:auto; height:115px;" class="clickable-image">`;
+                    const row = cell.getRow().getData();
+                    const thumbUrl = cell.getValue() || row.url;
+                    if (!thumbUrl) return "n/a";
+                    return `<img src="${thumbUrl}" data-full="${row.url || thumbUrl}" alt="Image" `
+                        + `style="width:auto; height:115px;" class="clickable-image" loading="lazy">`;
                 },
             });
 
@@ -186,7 +202,7 @@ function initImagePopups() {
     document.addEventListener("click", (evt) => {
         const img = evt.target.closest(".clickable-image");
         if (img) {
-            popupImg.src = img.getAttribute("src");
+            popupImg.src = img.dataset.full || img.getAttribute("src");
             popup.style.display = "block";
         } else if (evt.target.closest("#image-popup")) {
             popup.style.display = "none";
@@ -255,7 +271,7 @@ function upload_image_post(imageFile) {
         })
         .finally(() => {
             enable_disable_submit_button();
-            // Note - do not show_images() until the image is uploaded! Otherwise the database will be cleared.
+            // The server validates the image in the background; it appears on a later refresh.
             show_images();
         });
 }